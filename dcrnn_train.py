@@ -8,21 +8,32 @@ import pandas as pd
 import tensorflow as tf
 
 from lib import log_helper
-from lib.dcrnn_utils import load_graph_data
+from lib.dcrnn_utils import load_graph_data, threshold_adj_mx
+from lib.hdf_utils import HDFChunkReader
 from model.dcrnn_supervisor import DCRNNSupervisor
 
 # flags
 flags = tf.app.flags
 FLAGS = flags.FLAGS
 
+flags.DEFINE_bool('async_checkpoint', None, 'Set to true to write the checkpoints as .npz files in the background '
+                                            'instead of TensorFlow checkpoints, keeping the best keep_best_checkpoints '
+                                            'and the latest one instead of max_to_keep.')
+flags.DEFINE_bool('async_eval', None, 'Set to true to validate and test in the background while training continues, '
+                                      'requires async_checkpoint.')
 flags.DEFINE_integer('batch_size', -1, 'Batch size')
 flags.DEFINE_integer('cl_decay_steps', -1,
                      'Parameter to control the decay speed of probability of feeding groundth instead of model output.')
 flags.DEFINE_string('config_filename', None, 'Configuration filename for restoring the model.')
+flags.DEFINE_string('data_cache_dir', None, 'Directory to cache the prepared train/val/test data.')
 flags.DEFINE_integer('epochs', -1, 'Maximum number of epochs to train.')
 flags.DEFINE_string('filter_type', None, 'laplacian/random_walk/dual_random_walk.')
+flags.DEFINE_integer('hdf_chunk_size', 0,
+                     'Number of rows per chunk to read the traffic data out-of-core. 0: load the whole DataFrame.')
+flags.DEFINE_integer('halo_depth', -1, 'Number of hops of the halo of the training subgraphs, see num_clusters.')
 flags.DEFINE_string('graph_pkl_filename', 'data/sensor_graph/adj_mx.pkl',
-                    'Pickle file containing: sensor_ids, sensor_id_to_ind_map, dist_matrix')
+                    'Pickle file containing: sensor_ids, sensor_id_to_ind_map, dist_matrix, or .npz file of the sparse '
+                    'graph format, see gen_adj_mx.py.')
 flags.DEFINE_integer('horizon', -1, 'Maximum number of timestamps to prediction.')
 flags.DEFINE_float('l1_decay', -1.0, 'L1 Regularization')
 flags.DEFINE_float('lr_decay', -1.0, 'Learning rate decay.')
@@ -32,10 +43,14 @@ flags.DEFINE_float('learning_rate', -1, 'Learning rate. -1: select by hyperopt t
 flags.DEFINE_string('log_dir', None, 'Log directory for restoring the model from a checkpoint.')
 flags.DEFINE_string('loss_func', None, 'MSE/MAPE/RMSE_MAPE: loss function.')
 flags.DEFINE_float('min_learning_rate', -1, 'Minimum learning rate')
+flags.DEFINE_integer('num_clusters', -1, 'Number of clusters of the graph, > 1 to train on sampled clusters.')
 flags.DEFINE_integer('nb_weeks', 17, 'How many week\'s data should be used for train/test.')
+flags.DEFINE_integer('num_workers', -1, 'Number of data-parallel training processes.')
 flags.DEFINE_integer('patience', -1,
                      'Maximum number of epochs allowed for non-improving validation error before early stopping.')
 flags.DEFINE_integer('seq_len', -1, 'Sequence length.')
+flags.DEFINE_integer('steps_per_run', -1, 'Number of training steps per session run, > 1 requires the queue '
+                     'input_pipeline.')
 flags.DEFINE_integer('test_every_n_epochs', -1, 'Run model on the testing dataset every n epochs.')
 flags.DEFINE_string('traffic_df_filename', 'data/df_highway_2012_4mon_sample.h5',
                     'Path to hdf5 pandas.DataFrame.')
@@ -51,14 +66,27 @@ def main():
         logger = log_helper.get_logger(supervisor_config.get('base_dir'), 'info.log')
         logger.info('Loading graph from: ' + FLAGS.graph_pkl_filename)
         sensor_ids, sensor_id_to_ind, adj_mx = load_graph_data(FLAGS.graph_pkl_filename)
-        adj_mx[adj_mx < 0.1] = 0
+        adj_mx = threshold_adj_mx(adj_mx, 0.1)
         logger.info('Loading traffic data from: ' + FLAGS.traffic_df_filename)
         traffic_df_filename = FLAGS.traffic_df_filename
-        traffic_reading_df = pd.read_hdf(traffic_df_filename)
-        traffic_reading_df = traffic_reading_df.ix[:, sensor_ids]
+        # Casts the readings when loading, see the dtype option of the supervisor.
+        dtype = supervisor_config.get('dtype', 'float32')
+        if FLAGS.hdf_chunk_size > 0:
+            traffic_reading_df = HDFChunkReader(traffic_df_filename, columns=sensor_ids,
+                                                chunk_size=FLAGS.hdf_chunk_size, dtype=dtype)
+        else:
+            traffic_reading_df = pd.read_hdf(traffic_df_filename)
+            traffic_reading_df = traffic_reading_df.ix[:, sensor_ids].astype(dtype)
+        supervisor_config['traffic_df_filename'] = traffic_df_filename
         supervisor_config['use_cpu_only'] = FLAGS.use_cpu_only
+        if FLAGS.data_cache_dir:
+            supervisor_config['data_cache_dir'] = FLAGS.data_cache_dir
         if FLAGS.log_dir:
             supervisor_config['log_dir'] = FLAGS.log_dir
+        if FLAGS.async_checkpoint is not None:
+            supervisor_config['async_checkpoint'] = FLAGS.async_checkpoint
+        if FLAGS.async_eval is not None:
+            supervisor_config['async_eval'] = FLAGS.async_eval
         if FLAGS.use_curriculum_learning is not None:
             supervisor_config['use_curriculum_learning'] = FLAGS.use_curriculum_learning
         if FLAGS.loss_func:
@@ -66,9 +94,10 @@ def main():
         if FLAGS.filter_type:
             supervisor_config['filter_type'] = FLAGS.filter_type
         # Overwrites space with specified parameters.
-        for name in ['batch_size', 'cl_decay_steps', 'epochs', 'horizon', 'learning_rate', 'l1_decay',
+        for name in ['batch_size', 'cl_decay_steps', 'epochs', 'halo_depth', 'horizon', 'learning_rate', 'l1_decay',
                      'lr_decay', 'lr_decay_epoch', 'lr_decay_interval', 'learning_rate', 'min_learning_rate',
-                     'patience', 'seq_len', 'test_every_n_epochs', 'verbose']:
+                     'num_clusters', 'num_workers', 'patience', 'seq_len', 'steps_per_run', 'test_every_n_epochs',
+                     'verbose']:
             if getattr(FLAGS, name) >= 0:
                 supervisor_config[name] = getattr(FLAGS, name)
 
@@ -77,6 +106,12 @@ def main():
             tf_config = tf.ConfigProto(device_count={'GPU': 0})
         tf_config.gpu_options.allow_growth = True
         print('STRAT train!!!!!!!!!!!!!')
+        if supervisor_config.get('num_workers', 1) > 1:
+            # The workers are forked before any session is created.
+            supervisor = DCRNNSupervisor(traffic_reading_df=traffic_reading_df, adj_mx=adj_mx,
+                                         config=supervisor_config)
+            supervisor.train_data_parallel(session_config=tf_config)
+            return
         with tf.Session(config=tf_config) as sess:
             supervisor = DCRNNSupervisor(traffic_reading_df=traffic_reading_df, adj_mx=adj_mx,
                                          config=supervisor_config)
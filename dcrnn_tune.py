@@ -0,0 +1,156 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from hyperopt import hp
+from hyperopt.pyll.stochastic import sample
+
+from lib import log_helper
+from lib import tuning
+from lib.dcrnn_utils import load_graph_data, threshold_adj_mx
+from model.dcrnn_supervisor import DCRNNSupervisor
+
+flags = tf.app.flags
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('config_filename', None, 'Configuration filename of the trials, whose parameters in the search '
+                                             'space are replaced.')
+flags.DEFINE_string('data_cache_dir', None, 'Directory of the prepared data cache shared by the trials, defaults to '
+                                            'data_cache in the directory of the search.')
+flags.DEFINE_integer('epochs', -1, 'Maximum number of epochs of each trial.')
+flags.DEFINE_string('graph_pkl_filename', 'data/sensor_graph/adj_mx.pkl',
+                    'Pickle file containing: sensor_ids, sensor_id_to_ind_map, dist_matrix.')
+flags.DEFINE_float('learning_rate', -1, 'Learning rate of all the trials. -1: select by hyperopt tuning.')
+flags.DEFINE_integer('min_epochs', 1, 'Number of epochs of every trial before the scheduler may stop it.')
+flags.DEFINE_integer('num_trials', 20, 'Number of sampled configurations.')
+flags.DEFINE_integer('num_workers', 2, 'Number of trials running in parallel processes.')
+flags.DEFINE_integer('reduction_factor', 3, 'About 1 / reduction_factor of the trials continue at each rung of the '
+                                            'scheduler, whose rungs are at min_epochs * reduction_factor ** k epochs.')
+flags.DEFINE_integer('seed', 0, 'Random seed of the sampled configurations.')
+flags.DEFINE_string('traffic_df_filename', 'data/df_highway_2012_4mon_sample.h5',
+                    'Path to hdf5 pandas.DataFrame.')
+flags.DEFINE_bool('use_cpu_only', False, 'Set to true to only use cpu.')
+
+
+def get_search_space():
+    """
+    :return: hyperopt search space of the parameters of the model and the training, which do not change the prepared
+    data, i.e., all the trials load the same cache entry.
+    """
+    space = {
+        'cl_decay_steps': hp.choice('cl_decay_steps', [1000, 2000, 4000]),
+        'max_diffusion_step': hp.choice('max_diffusion_step', [1, 2, 3]),
+        'num_rnn_layers': hp.choice('num_rnn_layers', [1, 2, 3]),
+        'rnn_units': hp.choice('rnn_units', [16, 32, 64, 128]),
+    }
+    if FLAGS.learning_rate < 0:
+        space['learning_rate'] = hp.loguniform('learning_rate', np.log(1e-3), np.log(3e-2))
+    return space
+
+
+def sample_configs(space, num_trials, seed):
+    """
+    Samples the configurations randomly, as successive halving compares the trials by their early epochs.
+    """
+    rng = np.random.RandomState(seed)
+    configs = []
+    for _ in range(num_trials):
+        # Converts numpy scalars, which are not json serializable.
+        configs.append({name: np.asarray(value).item() for name, value in sample(space, rng=rng).items()})
+    return configs
+
+
+def get_session_config():
+    session_config = tf.ConfigProto()
+    if FLAGS.use_cpu_only:
+        session_config = tf.ConfigProto(device_count={'GPU': 0})
+    # Concurrent trials share the GPUs.
+    session_config.gpu_options.allow_growth = True
+    return session_config
+
+
+def prepare_data_cache(traffic_reading_df, adj_mx, config):
+    """
+    Prepares the data once into the cache, from which the trials load memory-mapped arrays. It runs in a child
+    process, so that the search process starts no tensorflow threads before forking the trials.
+    """
+    with tf.Graph().as_default():
+        DCRNNSupervisor(traffic_reading_df=traffic_reading_df, adj_mx=adj_mx, config=config)
+
+
+def main(_):
+    with open(FLAGS.config_filename) as f:
+        base_config = json.load(f)
+    tune_dir = os.path.join(base_config.get('base_dir'), 'tune_%s' % time.strftime('%m%d%H%M%S'))
+    os.makedirs(tune_dir)
+    logger = log_helper.get_logger(tune_dir, 'tune')
+    logger.info('Loading graph from: ' + FLAGS.graph_pkl_filename)
+    sensor_ids, sensor_id_to_ind, adj_mx = load_graph_data(FLAGS.graph_pkl_filename)
+    adj_mx = threshold_adj_mx(adj_mx, 0.1)
+    # Loaded once, the trials share it copy-on-write.
+    logger.info('Loading traffic data from: ' + FLAGS.traffic_df_filename)
+    dtype = base_config.get('dtype', 'float32')
+    traffic_reading_df = pd.read_hdf(FLAGS.traffic_df_filename)
+    traffic_reading_df = traffic_reading_df.ix[:, sensor_ids].astype(dtype)
+
+    base_config['traffic_df_filename'] = FLAGS.traffic_df_filename
+    base_config['use_cpu_only'] = FLAGS.use_cpu_only
+    base_config['data_cache_dir'] = FLAGS.data_cache_dir or os.path.join(tune_dir, 'data_cache')
+    # The trials only report epochs which have been validated, and run in one process each.
+    base_config['async_eval'] = False
+    base_config['num_workers'] = 1
+    for name in ['epochs', 'learning_rate']:
+        if getattr(FLAGS, name) >= 0:
+            base_config[name] = getattr(FLAGS, name)
+
+    context = multiprocessing.get_context('fork')
+    process = context.Process(target=prepare_data_cache, args=(traffic_reading_df, adj_mx, dict(
+        base_config, base_dir=os.path.join(tune_dir, 'data'))))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError('Preparing the data failed with exit code %d.' % process.exitcode)
+
+    def run_trial(trial_id, config, report):
+        trial_config = dict(base_config)
+        trial_config.update(config)
+        trial_config['base_dir'] = os.path.join(tune_dir, 'trial_%02d' % trial_id)
+        epochs = []
+
+        def epoch_callback(epoch, val_mae):
+            epochs.append(epoch + 1)
+            return report(epoch + 1, val_mae)
+
+        with tf.Graph().as_default(), tf.Session(config=get_session_config()) as sess:
+            supervisor = DCRNNSupervisor(traffic_reading_df=traffic_reading_df, adj_mx=adj_mx, config=trial_config)
+            val_mae = supervisor.train(sess=sess, epoch_callback=epoch_callback)
+        return {'epochs': epochs[-1] if epochs else 0, 'log_dir': supervisor.log_dir, 'val_mae': float(val_mae)}
+
+    configs = sample_configs(get_search_space(), FLAGS.num_trials, FLAGS.seed)
+    scheduler = tuning.AsyncSuccessiveHalving(min_epochs=FLAGS.min_epochs, reduction_factor=FLAGS.reduction_factor)
+    start_time = time.time()
+    trials = tuning.run_trials(configs, run_trial, scheduler, num_workers=FLAGS.num_workers)
+    logger.info('%d trials in %ds, %d stopped by the scheduler.' % (len(trials), time.time() - start_time,
+                                                                    len(scheduler.stopped)))
+    trials = sorted(trials, key=lambda trial: trial['result']['val_mae'] if trial['result'] else np.inf)
+    for trial in trials:
+        if trial['error'] is not None:
+            logger.warn('Trial %d %s failed: %s' % (trial['trial_id'], trial['config'], trial['error']))
+        else:
+            logger.info('Trial %d %s val_mae: %.4f after %d epochs, %s' % (
+                trial['trial_id'], trial['config'], trial['result']['val_mae'], trial['result']['epochs'],
+                trial['result']['log_dir']))
+    with open(os.path.join(tune_dir, 'trials.json'), 'w') as f:
+        json.dump(trials, f, indent=2)
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -5,8 +5,11 @@ from __future__ import print_function
 import numpy as np
 import pandas as pd
 import pickle
+import scipy.sparse as sp
 import tensorflow as tf
 
+from lib.dcrnn_utils import convert_graph_pkl_to_npz, save_graph_data
+
 flags = tf.app.flags
 FLAGS = flags.FLAGS
 
@@ -17,6 +20,12 @@ flags.DEFINE_string('distances_filename', 'data/sensor_graph/distances_la_2012.c
 flags.DEFINE_float('normalized_k', 0.1, 'Entries that become lower than normalized_k after normalization '
                                         'are set to zero for sparsity.')
 flags.DEFINE_string('output_pkl_filename', 'data/sensor_graph/adj_mat.pkl', 'Path of the output file.')
+flags.DEFINE_string('output_npz_filename', None,
+                    'If specified, saves the graph in the sparse .npz format to this path instead of the pickle file.')
+flags.DEFINE_string('convert_pkl_filename', None,
+                    'If specified, converts this existing graph pickle file to output_npz_filename.')
+flags.DEFINE_string('lambda_max_method', 'eigsh', 'eigsh/lanczos/power: method to compute the lambda_max of the '
+                                                  'laplacian filter, which is saved in the .npz file. Empty: none.')
 
 
 def get_adjacency_matrix(distance_df, sensor_ids, normalized_k=0.1):
@@ -53,11 +62,56 @@ def get_adjacency_matrix(distance_df, sensor_ids, normalized_k=0.1):
     return sensor_ids, sensor_id_to_ind, adj_mx
 
 
+def get_sparse_adjacency_matrix(distance_df, sensor_ids, normalized_k=0.1):
+    """
+    Same as get_adjacency_matrix, but maps sensor ids with vectorized categorical codes and only computes the kernel
+    weights of existing edges, i.e., time and memory grow with the number of edges instead of num_sensors ** 2.
+
+    :param distance_df: data frame with three columns: [from, to, distance].
+    :param sensor_ids: list of sensor ids.
+    :param normalized_k: entries that become lower than normalized_k after normalization are set to zero for sparsity.
+    :return: sensor_ids, sensor_id_to_ind, adj_mx as scipy.sparse.csr_matrix.
+    """
+    num_sensors = len(sensor_ids)
+    sensor_id_to_ind = dict((sensor_id, i) for i, sensor_id in enumerate(sensor_ids))
+
+    # Sensors that are not in sensor_ids are mapped to -1.
+    rows = pd.Categorical(distance_df.iloc[:, 0], categories=sensor_ids).codes.astype(np.int64)
+    cols = pd.Categorical(distance_df.iloc[:, 1], categories=sensor_ids).codes.astype(np.int64)
+    distances = distance_df.iloc[:, 2].values.astype(np.float32)
+    valid = (rows >= 0) & (cols >= 0) & ~np.isinf(distances)
+    rows, cols, distances = rows[valid], cols[valid], distances[valid]
+
+    # Keeps the last distance of duplicated edges, same as filling the dense matrix row by row.
+    _, last_inds = np.unique((rows * num_sensors + cols)[::-1], return_index=True)
+    inds = np.sort(len(rows) - 1 - last_inds)
+    rows, cols, distances = rows[inds], cols[inds], distances[inds]
+
+    # Calculates the standard deviation as theta.
+    std = distances.std()
+    weights = np.exp(-np.square(distances / std))
+
+    # Only keeps entries that are not lower than a threshold, i.e., k, for sparsity.
+    keep = weights >= normalized_k
+    adj_mx = sp.csr_matrix((weights[keep], (rows[keep], cols[keep])), shape=(num_sensors, num_sensors),
+                           dtype=np.float32)
+    return sensor_ids, sensor_id_to_ind, adj_mx
+
+
 if __name__ == '__main__':
-    with open(FLAGS.sensor_ids_filename) as f:
-        sensor_ids = f.read().strip().split(',')
-    distance_df = pd.read_csv(FLAGS.distances_filename, dtype={'from': 'str', 'to': 'str'})
-    _, sensor_id_to_ind, adj_mx = get_adjacency_matrix(distance_df, sensor_ids)
-    # Save to pickle file.
-    with open(FLAGS.output_pkl_filename, 'wb') as f:
-        pickle.dump([sensor_ids, sensor_id_to_ind, adj_mx], f)
+    if FLAGS.convert_pkl_filename:
+        convert_graph_pkl_to_npz(FLAGS.convert_pkl_filename, FLAGS.output_npz_filename,
+                                 lambda_max_method=FLAGS.lambda_max_method or None)
+    else:
+        with open(FLAGS.sensor_ids_filename) as f:
+            sensor_ids = f.read().strip().split(',')
+        distance_df = pd.read_csv(FLAGS.distances_filename, dtype={'from': 'str', 'to': 'str'})
+        _, sensor_id_to_ind, adj_mx = get_sparse_adjacency_matrix(distance_df, sensor_ids,
+                                                                  normalized_k=FLAGS.normalized_k)
+        if FLAGS.output_npz_filename:
+            save_graph_data(FLAGS.output_npz_filename, sensor_ids, adj_mx,
+                            lambda_max_method=FLAGS.lambda_max_method or None)
+        else:
+            # Save to pickle file.
+            with open(FLAGS.output_pkl_filename, 'wb') as f:
+                pickle.dump([sensor_ids, sensor_id_to_ind, adj_mx.toarray()], f)
@@ -0,0 +1,151 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def _write_atomic(filename, write):
+    """
+    Writes a file through write(f) into a temporary file, which is then renamed, i.e., readers either see the complete
+    file or nothing.
+    """
+    tmp_filename = filename + '.tmp'
+    try:
+        with open(tmp_filename, 'wb') as f:
+            write(f)
+        os.rename(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def load_checkpoint(filename):
+    """
+    :return: dict of the arrays of a checkpoint written by AsyncCheckpointWriter.
+    """
+    with np.load(filename) as data:
+        return {name: data[name] for name in data.files}
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Writes checkpoints, i.e., dicts of arrays such as variable values, to .npz files from a background thread, so that
+    the caller only waits for taking the snapshot of the values.
+    The best keep_best checkpoints by loss and the latest one are kept, the others are removed.
+    """
+
+    def __init__(self, keep_best=5, compress=False, max_pending=2):
+        """
+        :param keep_best:
+        :param compress: whether to write compressed .npz files, which are smaller but slower to write.
+        :param max_pending: maximum number of checkpoints waiting to be written, `save` blocks beyond.
+        """
+        self._keep_best = keep_best
+        self._compress = compress
+        self._queue = queue.Queue(maxsize=max_pending)
+        # (loss, path, extra filenames) of the written checkpoints, from the oldest to the latest.
+        self._checkpoints = []
+        self._error = None
+        self._num_written = 0
+        self._write_time = 0.
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, values, path, loss, extra_files=None):
+        """
+        Schedules writing a checkpoint.
+        :param values: dict of arrays, which must not be modified afterwards, e.g., fetched with sess.run.
+        :param path: filename of the checkpoint, ending with .npz.
+        :param loss: e.g., validation loss, lower is better.
+        :param extra_files: dict from filename to json serializable content, e.g., the configuration, which are
+        written after the checkpoint and removed with it.
+        :return: path
+        """
+        self._raise_error()
+        self._queue.put((values, path, loss, dict(extra_files or {})))
+        return path
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                if self._error is None:
+                    self._write(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, values, path, loss, extra_files):
+        start_time = time.time()
+        savez = np.savez_compressed if self._compress else np.savez
+        _write_atomic(path, lambda f: savez(f, **values))
+        for filename, content in extra_files.items():
+            _write_atomic(filename, lambda f: f.write(json.dumps(content).encode('utf-8')))
+        # A checkpoint written again to the same path replaces the previous one.
+        self._checkpoints = [checkpoint for checkpoint in self._checkpoints if checkpoint[1] != path]
+        self._checkpoints.append((loss, path, sorted(extra_files.keys())))
+        self._remove_checkpoints()
+        self._num_written += 1
+        self._write_time += time.time() - start_time
+
+    def _remove_checkpoints(self):
+        best = sorted(self._checkpoints, key=lambda checkpoint: checkpoint[0])[:self._keep_best]
+        kept = []
+        for checkpoint in self._checkpoints:
+            if checkpoint in best or checkpoint is self._checkpoints[-1]:
+                kept.append(checkpoint)
+                continue
+            for filename in [checkpoint[1]] + checkpoint[2]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+        self._checkpoints = kept
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def wait(self):
+        """
+        Blocks until all the scheduled checkpoints have been written.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    @property
+    def checkpoints(self):
+        """
+        Paths of the written checkpoints, from the best to the worst.
+        """
+        return [checkpoint[1] for checkpoint in sorted(self._checkpoints, key=lambda checkpoint: checkpoint[0])]
+
+    @property
+    def num_written(self):
+        return self._num_written
+
+    @property
+    def write_time(self):
+        """
+        Total time in seconds spent writing checkpoints in the background, i.e., that synchronous saving would have
+        added to training.
+        """
+        return self._write_time
@@ -0,0 +1,63 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from lib import checkpoint_utils
+from lib.checkpoint_utils import AsyncCheckpointWriter
+
+
+class AsyncCheckpointWriterTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _path(self, i):
+        return os.path.join(self._dir, 'models-%d.npz' % i)
+
+    def test_save_load(self):
+        for compress in [False, True]:
+            writer = AsyncCheckpointWriter(compress=compress)
+            values = {'DCRNN/weights': np.arange(6, dtype=np.float32).reshape((2, 3)), 'global_step': np.int64(3)}
+            config_filename = os.path.join(self._dir, 'config_01.json')
+            path = writer.save(values, self._path(1), loss=1., extra_files={config_filename: {'epoch': 1}})
+            writer.close()
+            self.assertEqual(1, writer.num_written)
+            loaded = checkpoint_utils.load_checkpoint(path)
+            self.assertListEqual(sorted(values.keys()), sorted(loaded.keys()))
+            self.assertTrue(np.array_equal(values['DCRNN/weights'], loaded['DCRNN/weights']))
+            self.assertEqual(3, loaded['global_step'])
+            with open(config_filename) as f:
+                self.assertEqual(1, json.load(f)['epoch'])
+        # No temporary files are left.
+        self.assertListEqual(['config_01.json', 'models-1.npz'], sorted(os.listdir(self._dir)))
+
+    def test_keep_best(self):
+        writer = AsyncCheckpointWriter(keep_best=2)
+        losses = [5., 3., 4., 1., 2., 6.]
+        for i, loss in enumerate(losses):
+            extra_files = {os.path.join(self._dir, 'config_%02d.json' % i): {'epoch': i}}
+            writer.save({'x': np.array([i])}, self._path(i), loss=loss, extra_files=extra_files)
+        writer.wait()
+        # The best two and the latest one.
+        self.assertListEqual([self._path(3), self._path(4), self._path(5)], writer.checkpoints)
+        self.assertListEqual(['config_03.json', 'config_04.json', 'config_05.json', 'models-3.npz', 'models-4.npz',
+                              'models-5.npz'], sorted(os.listdir(self._dir)))
+        writer.close()
+
+    def test_error(self):
+        writer = AsyncCheckpointWriter()
+        writer.save({'x': np.zeros(1)}, os.path.join(self._dir, 'missing', 'models.npz'), loss=1.)
+        with self.assertRaises(IOError):
+            writer.wait()
+        with self.assertRaises(IOError):
+            writer.save({'x': np.zeros(1)}, self._path(0), loss=1.)
+
+
+if __name__ == '__main__':
+    unittest.main()
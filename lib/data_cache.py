@@ -0,0 +1,149 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+_META_FILENAME = 'meta.json'
+
+
+def file_fingerprint(filename):
+    """
+    Identifies a file by its absolute path, size and modification time, which avoids reading very large files.
+    """
+    stat = os.stat(filename)
+    return '%s:%d:%d' % (os.path.abspath(filename), stat.st_size, int(stat.st_mtime * 1e6))
+
+
+def dataframe_fingerprint(df):
+    """
+    Identifies a DataFrame by hashing its index, columns and values.
+    """
+    sha1 = hashlib.sha1()
+    sha1.update(np.ascontiguousarray(df.index.values).view(np.uint8))
+    sha1.update(str(list(df.columns)).encode('utf-8'))
+    sha1.update(np.ascontiguousarray(df.values).view(np.uint8))
+    return sha1.hexdigest()
+
+
+def make_cache_key(**kwargs):
+    """
+    Hashes the keyword arguments, which should be json serializable, to a cache key.
+    """
+    content = json.dumps(kwargs, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class DatasetCache(object):
+    """
+    On-disk cache of prepared datasets.
+    Each entry is a directory named by its key containing one .npy file per array, which are loaded as read-only
+    memory-mapped arrays, and a meta.json file, whose modification time records the last access for eviction.
+    """
+
+    def __init__(self, cache_dir, max_size_bytes=None):
+        """
+        :param cache_dir:
+        :param max_size_bytes: least recently used entries are evicted when the cache grows beyond this size.
+        """
+        self._cache_dir = cache_dir
+        self._max_size_bytes = max_size_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def load(self, key):
+        """
+        Loads an entry.
+        :param key:
+        :return: (arrays, meta), where arrays is a dict of read-only memory-mapped arrays, or None if not cached.
+        """
+        entry_dir = os.path.join(self._cache_dir, key)
+        meta_filename = os.path.join(entry_dir, _META_FILENAME)
+        if not os.path.exists(meta_filename):
+            return None
+        with open(meta_filename) as f:
+            meta = json.load(f)
+        arrays = {}
+        for name in meta['arrays']:
+            arrays[name] = np.load(os.path.join(entry_dir, '%s.npy' % name), mmap_mode='r')
+        # Marks as recently used.
+        os.utime(meta_filename, None)
+        return arrays, meta['meta']
+
+    def save(self, key, arrays, meta=None):
+        """
+        Saves an entry atomically, i.e., concurrent readers either see the complete entry or nothing, and then evicts
+        least recently used entries if the cache is too large.
+        :param key:
+        :param arrays: dict of arrays.
+        :param meta: json serializable information of the entry.
+        """
+        entry_dir = os.path.join(self._cache_dir, key)
+        tmp_dir = tempfile.mkdtemp(prefix='.%s.' % key, dir=self._cache_dir)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_dir, '%s.npy' % name), array)
+            with open(os.path.join(tmp_dir, _META_FILENAME), 'w') as f:
+                json.dump({'arrays': sorted(arrays.keys()), 'meta': meta or {}, 'created': time.time()}, f)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # The entry has been created by another process in the meantime.
+            if not os.path.exists(os.path.join(entry_dir, _META_FILENAME)):
+                raise
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+        if self._max_size_bytes is not None:
+            self.evict(self._max_size_bytes, keep=(key,))
+
+    def entries(self):
+        """
+        :return: a list of (key, size in bytes, last access time), most recently used first.
+        """
+        entries = []
+        for key in os.listdir(self._cache_dir):
+            entry_dir = os.path.join(self._cache_dir, key)
+            meta_filename = os.path.join(entry_dir, _META_FILENAME)
+            if key.startswith('.') or not os.path.exists(meta_filename):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, filename)) for filename in os.listdir(entry_dir))
+            entries.append((key, size, os.path.getmtime(meta_filename)))
+        return sorted(entries, key=lambda entry: entry[2], reverse=True)
+
+    def evict(self, max_size_bytes, keep=()):
+        """
+        Removes the least recently used entries until the total size is at most max_size_bytes.
+        :param max_size_bytes:
+        :param keep: keys that are never evicted.
+        :return: evicted keys.
+        """
+        evicted = []
+        total_size = 0
+        for key, size, _ in self.entries():
+            total_size += size
+            if total_size > max_size_bytes and key not in keep:
+                self.invalidate(key)
+                total_size -= size
+                evicted.append(key)
+        return evicted
+
+    def invalidate(self, key=None):
+        """
+        Removes an entry, or all the entries if key is None.
+        """
+        keys = [key] if key is not None else [entry[0] for entry in self.entries()]
+        for key in keys:
+            entry_dir = os.path.join(self._cache_dir, key)
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir)
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
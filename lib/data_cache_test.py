@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from lib import data_cache
+from lib.data_cache import DatasetCache
+
+
+class DatasetCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_save_load(self):
+        cache = DatasetCache(self._dir)
+        key = data_cache.make_cache_key(seq_len=12, horizon=12)
+        self.assertIsNone(cache.load(key))
+        data = np.arange(12, dtype=np.float32).reshape((3, 4))
+        cache.save(key, {'train': data}, meta={'scaler_mean': 1.})
+        arrays, meta = cache.load(key)
+        self.assertTrue(np.array_equal(data, arrays['train']))
+        self.assertFalse(arrays['train'].flags.writeable)
+        self.assertEqual(1., meta['scaler_mean'])
+
+    def test_make_cache_key(self):
+        self.assertEqual(data_cache.make_cache_key(seq_len=12, horizon=3),
+                         data_cache.make_cache_key(horizon=3, seq_len=12))
+        self.assertNotEqual(data_cache.make_cache_key(seq_len=12, horizon=3),
+                            data_cache.make_cache_key(seq_len=12, horizon=6))
+
+    def test_evict_and_invalidate(self):
+        data = np.zeros((1024,), dtype=np.float64)
+        cache = DatasetCache(self._dir, max_size_bytes=20000)
+        # Each entry takes about 8KB, i.e., at most two entries are kept.
+        for i, key in enumerate(['a', 'b']):
+            cache.save(key, {'train': data})
+            # Makes the access time distinguishable.
+            os.utime(os.path.join(self._dir, key, 'meta.json'), (time.time() - 10 + i,) * 2)
+        cache.load('a')
+        cache.save('c', {'train': data})
+        self.assertListEqual(['a', 'c'], sorted(entry[0] for entry in cache.entries()))
+        cache.invalidate('a')
+        self.assertListEqual(['c'], [entry[0] for entry in cache.entries()])
+        cache.invalidate()
+        self.assertListEqual([], cache.entries())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,111 @@
+import collections
+import hashlib
 import pickle
+import struct
+import weakref
+import zipfile
+
 import numpy as np
 import scipy.sparse as sp
+import tensorflow as tf
 
 from scipy.sparse import linalg
+from lib import tf_utils
 from lib.tf_utils import sparse_matrix_to_tf_sparse_tensor
 
 
 def load_graph_data(pkl_filename):
+    """
+    Loads the graph from a pickle file with a dense adj_mx, or from a sparse .npz file saved by save_graph_data, in
+    which case adj_mx is a scipy.sparse.csr_matrix backed by memory-mapped arrays, and the lambda_max saved with the
+    graph is passed to support_registry.
+    :param pkl_filename:
+    :return: sensor_ids, sensor_id_to_ind, adj_mx
+    """
+    if pkl_filename.endswith('.npz'):
+        arrays = load_npz_mmap(pkl_filename)
+        sensor_ids = arrays['sensor_ids'].tolist()
+        sensor_id_to_ind = dict((sensor_id, i) for i, sensor_id in enumerate(sensor_ids))
+        adj_mx = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                               shape=tuple(arrays['shape']))
+        if 'lambda_max' in arrays:
+            support_registry.set_lambda_max(adj_mx, float(arrays['lambda_max']),
+                                            lambda_max_method=str(arrays['lambda_max_method']))
+        return sensor_ids, sensor_id_to_ind, adj_mx
     with open(pkl_filename,'rb') as f:
         sensor_ids, sensor_id_to_ind, adj_mx = pickle.load(f)
     return sensor_ids, sensor_id_to_ind, adj_mx
 
 
+def save_graph_data(npz_filename, sensor_ids, adj_mx, lambda_max_method=None):
+    """
+    Saves the graph as an uncompressed .npz file containing the sensor ids and the CSR arrays of adj_mx, i.e., the
+    size grows with the number of edges instead of num_nodes ** 2.
+    :param npz_filename:
+    :param sensor_ids:
+    :param adj_mx: dense or sparse adjacency matrix.
+    :param lambda_max_method: if not None, the lambda_max of the graph is computed with this method and saved with
+    it, i.e., processes which load the graph do not compute it again, see calculate_lambda_max.
+    """
+    adj_mx = sp.csr_matrix(adj_mx, dtype=np.float32)
+    adj_mx.sort_indices()
+    arrays = {}
+    if lambda_max_method is not None:
+        arrays['lambda_max'] = np.array(calculate_lambda_max(adj_mx, method=lambda_max_method))
+        arrays['lambda_max_method'] = np.array(lambda_max_method)
+    np.savez(npz_filename, sensor_ids=np.array([str(sensor_id) for sensor_id in sensor_ids]),
+             data=adj_mx.data, indices=adj_mx.indices, indptr=adj_mx.indptr, shape=np.array(adj_mx.shape), **arrays)
+
+
+def convert_graph_pkl_to_npz(pkl_filename, npz_filename, lambda_max_method=None):
+    """
+    Converts a graph pickle file, e.g., adj_mx.pkl, to the sparse .npz format.
+    """
+    sensor_ids, _, adj_mx = load_graph_data(pkl_filename)
+    save_graph_data(npz_filename, sensor_ids, adj_mx, lambda_max_method=lambda_max_method)
+
+
+def load_npz_mmap(filename):
+    """
+    Loads the arrays of an .npz file, where arrays that are stored without compression are memory-mapped.
+    :return: dict of arrays.
+    """
+    arrays = {}
+    with zipfile.ZipFile(filename) as zip_file, open(filename, 'rb') as f:
+        for info in zip_file.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type == zipfile.ZIP_STORED:
+                # Local file header: 30 bytes, followed by the file name and the extra field.
+                f.seek(info.header_offset + 26)
+                name_length, extra_length = struct.unpack('<HH', f.read(4))
+                f.seek(info.header_offset + 30 + name_length + extra_length)
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                if not dtype.hasobject and np.prod(shape) > 0:
+                    arrays[name] = np.memmap(filename, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                             order='F' if fortran_order else 'C')
+                    continue
+            arrays[name] = np.lib.format.read_array(zip_file.open(info))
+    return arrays
+
+
+def threshold_adj_mx(adj_mx, threshold):
+    """
+    Sets the entries of adj_mx that are lower than threshold to zero, dense adj_mx is modified in place.
+    :return: adj_mx, which is a new sparse matrix without explicit zeros for sparse adj_mx.
+    """
+    if sp.issparse(adj_mx):
+        adj_mx = sp.csr_matrix(adj_mx, copy=True)
+        adj_mx.data[adj_mx.data < threshold] = 0
+        adj_mx.eliminate_zeros()
+    else:
+        adj_mx[adj_mx < threshold] = 0
+    return adj_mx
+
+
 def calculate_normalized_laplacian(adj):
     """
     # L = D^-1/2 (D-A) D^-1/2 = I - D^-1/2 A D^-1/2
@@ -42,15 +136,548 @@ def calculate_reverse_random_walk_matrix(adj_mx):
     return calculate_random_walk_matrix(np.transpose(adj_mx))
 
 
-def calculate_scaled_laplacian(adj_mx, lambda_max=2, undirected=True):
+def calculate_scaled_laplacian(adj_mx, lambda_max=2, undirected=True, lambda_max_method='eigsh'):
+    """
+    Scales the normalized laplacian to [-1, 1], i.e., 2 / lambda_max * L - I.
+    :param adj_mx: dense or sparse adjacency matrix.
+    :param lambda_max: largest eigenvalue of L, None to compute it with lambda_max_method, see calculate_lambda_max.
+    :param undirected: if True, the graph is symmetrized with the element-wise maximum of adj_mx and its transpose.
+    :param lambda_max_method: see estimate_lambda_max.
+    :return:
+    """
     if undirected:
-        adj_mx = np.maximum.reduce([adj_mx, adj_mx.T])
+        # Symmetrizes sparsely, which avoids dense copies of large graphs.
+        adj_mx = sp.csr_matrix(adj_mx)
+        adj_mx = adj_mx.maximum(adj_mx.T)
     L = calculate_normalized_laplacian(adj_mx)
     if lambda_max is None:
-        lambda_max, _ = linalg.eigsh(L, 1, which='LM')
-        lambda_max = lambda_max[0]
+        lambda_max = estimate_lambda_max(L, method=lambda_max_method, upper_bound=lambda_max_method != 'eigsh')
     L = sp.csr_matrix(L)
     M, _ = L.shape
     I = sp.identity(M, format='csr', dtype=L.dtype)
     L = (2 / lambda_max * L) - I
     return L.astype(np.float32)
+
+
+def calculate_lambda_max(adj_mx, undirected=True, method='eigsh'):
+    """
+    Computes the lambda_max of calculate_scaled_laplacian, approximate methods return an upper bound, so that the
+    spectrum of the scaled laplacian stays within [-1, 1].
+    :param adj_mx: dense or sparse adjacency matrix.
+    :param undirected: see calculate_scaled_laplacian.
+    :param method: see estimate_lambda_max.
+    :return: float
+    """
+    if undirected:
+        adj_mx = _symmetrize(adj_mx)
+    L = calculate_normalized_laplacian(adj_mx)
+    return estimate_lambda_max(L, method=method, upper_bound=method != 'eigsh')
+
+
+def estimate_lambda_max(L, method='eigsh', num_iters=100, tol=1e-3, upper_bound=False, seed=0):
+    """
+    Computes or estimates the largest eigenvalue of the symmetric positive semi-definite matrix L, e.g., the
+    normalized laplacian.
+    :param L: sparse matrix.
+    :param method:
+        - "eigsh": ARPACK solver, up to machine precision.
+        - "lanczos": ARPACK solver with tolerance tol and at most num_iters restarts, usually much faster, falls back
+        to "power" if it does not converge.
+        - "power": power iteration, i.e., at most num_iters sparse matrix-vector products, until the residual norm
+        |L v - lambda v| is at most tol * lambda. The Rayleigh quotient never exceeds the exact value.
+    :param upper_bound: if True, L must be a normalized laplacian, whose eigenvalues are at most 2. The residual norm is
+    added to a converged estimate, which is then within it of the largest eigenvalue, otherwise 2 is returned, i.e.,
+    the scaled laplacian stays within [-1, 1].
+    :return: float
+    """
+    L = sp.csr_matrix(L)
+    if L.shape[0] <= 2:
+        # Too small for ARPACK, e.g., tiny subgraphs, see GraphPartition.
+        return float(np.linalg.eigvalsh(L.toarray())[-1])
+    # The residual only bounds the distance to some eigenvalue, i.e., it is only added once the estimate has converged.
+    converged = True
+    if method == 'eigsh':
+        lambda_max, v = linalg.eigsh(L, 1, which='LM')
+    elif method == 'lanczos':
+        try:
+            lambda_max, v = linalg.eigsh(L, 1, which='LA', tol=tol, maxiter=num_iters)
+        except linalg.ArpackNoConvergence:
+            return estimate_lambda_max(L, method='power', num_iters=num_iters, tol=tol, upper_bound=upper_bound,
+                                       seed=seed)
+    elif method == 'power':
+        v = np.random.RandomState(seed).rand(L.shape[0])
+        v /= np.linalg.norm(v)
+        lambda_max = 0.
+        converged = False
+        for _ in range(num_iters):
+            Lv = L.dot(v)
+            lambda_max = float(v.dot(Lv))
+            # E.g., L v = 0 converges with lambda_max = 0.
+            if np.linalg.norm(Lv - lambda_max * v) <= tol * abs(lambda_max):
+                converged = True
+                break
+            v = Lv / np.linalg.norm(Lv)
+    else:
+        raise ValueError('Unknown method to estimate lambda_max: %s' % method)
+    lambda_max, v = float(np.ravel(lambda_max)[0]), np.ravel(v)
+    if upper_bound:
+        if not converged:
+            return 2.
+        lambda_max += float(np.linalg.norm(L.dot(v) - lambda_max * v) / np.linalg.norm(v))
+        lambda_max = min(lambda_max, 2.)
+    return lambda_max
+
+
+def calculate_supports(adj_mx, filter_type='laplacian', lambda_max_method='eigsh', lambda_max=None):
+    """
+    Calculates the diffusion supports of the graph convolution.
+    :param adj_mx: dense or sparse adjacency matrix.
+    :param filter_type: "laplacian", "random_walk", "dual_random_walk".
+    :param lambda_max_method: see estimate_lambda_max.
+    :param lambda_max: lambda_max of the laplacian filter, None to compute it with lambda_max_method.
+    :return: list of sparse matrices.
+    """
+    supports = []
+    if filter_type == "laplacian":
+        supports.append(calculate_scaled_laplacian(adj_mx, lambda_max=lambda_max, lambda_max_method=lambda_max_method))
+    elif filter_type == "random_walk":
+        supports.append(calculate_random_walk_matrix(adj_mx).T)
+    elif filter_type == "dual_random_walk":
+        supports.append(calculate_random_walk_matrix(adj_mx).T)
+        supports.append(calculate_random_walk_matrix(adj_mx.T).T)
+    else:
+        supports.append(calculate_scaled_laplacian(adj_mx))
+    return supports
+
+
+def adj_mx_fingerprint(adj_mx):
+    """
+    Identifies a dense or sparse adjacency matrix by hashing its content.
+    """
+    sha1 = hashlib.sha1()
+    if sp.issparse(adj_mx):
+        adj_mx = sp.csr_matrix(adj_mx)
+        if not adj_mx.has_canonical_format:
+            # Copies, as the matrix may be backed by read-only memory maps.
+            adj_mx = adj_mx.copy()
+            adj_mx.sum_duplicates()
+        sha1.update(('sparse:%s:%s' % (adj_mx.shape, adj_mx.dtype)).encode('utf-8'))
+        for array in [adj_mx.indptr, adj_mx.indices, adj_mx.data]:
+            sha1.update(np.ascontiguousarray(array).view(np.uint8))
+    else:
+        adj_mx = np.ascontiguousarray(adj_mx)
+        sha1.update(('dense:%s:%s' % (adj_mx.shape, adj_mx.dtype)).encode('utf-8'))
+        sha1.update(adj_mx.view(np.uint8))
+    return sha1.hexdigest()
+
+
+class SupportRegistry(object):
+    """
+    Cache of the diffusion supports keyed by the fingerprint of the adjacency matrix, the filter type and the method to
+    compute lambda_max.
+    Each support is computed once with SciPy, and each tf.Graph holds a single constant of it, which is shared by all
+    the cells, e.g., of the encoder and the decoder of the train/val/test models.
+    The fingerprint is computed once per adjacency matrix object, i.e., matrices must not be modified in place after
+    they have been passed to the registry.
+    """
+
+    def __init__(self):
+        # id of the adjacency matrix -> (weak reference to it, fingerprint).
+        self._fingerprints = {}
+        # (fingerprint, lambda_max_method) -> lambda_max, see calculate_lambda_max.
+        self._lambda_max = {}
+        self._supports = {}
+        # (fingerprint, filter_type, lambda_max_method, backend) -> the selected backend of each support.
+        self._backends = {}
+        # tf.Graph -> {(fingerprint, filter_type, lambda_max_method, backend): list of support tensors}
+        self._tensors = weakref.WeakKeyDictionary()
+
+    def get_supports(self, adj_mx, filter_type='laplacian', lambda_max_method='eigsh'):
+        """
+        :return: list of sparse matrices, see calculate_supports, which must not be modified.
+        """
+        return self._get_supports((self.get_fingerprint(adj_mx), filter_type, lambda_max_method), adj_mx)
+
+    def get_support_tensors(self, adj_mx, filter_type='laplacian', backend='auto', lambda_max_method='eigsh'):
+        """
+        :param backend: see lib.tf_utils.select_support_backend.
+        :param lambda_max_method: see estimate_lambda_max.
+        :return: list of the support tensors in the default graph, i.e., tf.SparseTensor or dense tensors, which are
+        multiplied with lib.tf_utils.support_matmul.
+        """
+        key = (self.get_fingerprint(adj_mx), filter_type, lambda_max_method)
+        graph = tf.get_default_graph()
+        tensors = self._tensors.setdefault(graph, {})
+        if key + (backend,) not in tensors:
+            supports = self._get_supports(key, adj_mx)
+            backends = self._get_backends(key, adj_mx, backend)
+            # Created at the top level of the graph, i.e., outside of any name scope, control dependencies or
+            # control flow context of the caller, so that they can be used everywhere in the graph.
+            with tf.name_scope(None), tf.control_dependencies(None):
+                with tf.name_scope('diffusion_supports'):
+                    tensors[key + (backend,)] = [tf_utils.build_support_tensor(support, support_backend)
+                                                 for support, support_backend in zip(supports, backends)]
+        return tensors[key + (backend,)]
+
+    def get_backends(self, adj_mx, filter_type='laplacian', backend='auto', lambda_max_method='eigsh'):
+        """
+        :return: list of the selected backend, i.e., 'dense' or 'sparse', of each support.
+        """
+        return self._get_backends((self.get_fingerprint(adj_mx), filter_type, lambda_max_method), adj_mx, backend)
+
+    def get_fingerprint(self, adj_mx):
+        """
+        :return: adj_mx_fingerprint(adj_mx), which is only computed the first time the matrix is passed, as hashing
+        large dense matrices is slow and every cell of every model looks up its supports.
+        """
+        entry = self._fingerprints.get(id(adj_mx))
+        if entry is not None and entry[0]() is adj_mx:
+            return entry[1]
+        fingerprint = adj_mx_fingerprint(adj_mx)
+        key = id(adj_mx)
+        # The entry is removed when the matrix is garbage collected, before its id can be reused.
+        reference = weakref.ref(adj_mx, lambda _: self._fingerprints.pop(key, None))
+        self._fingerprints[key] = (reference, fingerprint)
+        return fingerprint
+
+    def get_lambda_max(self, adj_mx, lambda_max_method='eigsh'):
+        """
+        :return: calculate_lambda_max(adj_mx), which is computed once per graph.
+        """
+        key = (self.get_fingerprint(adj_mx), lambda_max_method)
+        if key not in self._lambda_max:
+            self._lambda_max[key] = calculate_lambda_max(adj_mx, method=lambda_max_method)
+        return self._lambda_max[key]
+
+    def set_lambda_max(self, adj_mx, lambda_max, lambda_max_method='eigsh'):
+        """
+        Sets the lambda_max of a graph which has been computed before, e.g., saved with the graph or in the data cache.
+        """
+        self._lambda_max[(self.get_fingerprint(adj_mx), lambda_max_method)] = float(lambda_max)
+
+    def _get_supports(self, key, adj_mx):
+        if key not in self._supports:
+            lambda_max = None
+            if key[1] == 'laplacian':
+                lambda_max = self.get_lambda_max(adj_mx, lambda_max_method=key[2])
+            self._supports[key] = calculate_supports(adj_mx, filter_type=key[1], lambda_max_method=key[2],
+                                                     lambda_max=lambda_max)
+        return self._supports[key]
+
+    def _get_backends(self, key, adj_mx, backend):
+        if key + (backend,) not in self._backends:
+            self._backends[key + (backend,)] = [tf_utils.select_support_backend(support, backend=backend)
+                                                for support in self._get_supports(key, adj_mx)]
+        return self._backends[key + (backend,)]
+
+    def clear(self):
+        self._fingerprints.clear()
+        self._lambda_max.clear()
+        self._supports.clear()
+        self._backends.clear()
+        self._tensors.clear()
+
+
+# Registry used by the DCRNN cells.
+support_registry = SupportRegistry()
+
+
+def _symmetrize(adj_mx):
+    adj_mx = sp.csr_matrix(adj_mx)
+    return adj_mx.maximum(adj_mx.T)
+
+
+def partition_graph(adj_mx, num_clusters, method='bfs'):
+    """
+    Partitions the nodes into clusters of roughly equal size, ignoring the direction of the edges.
+    :param adj_mx: dense or sparse adjacency matrix.
+    :param num_clusters:
+    :param method:
+        - "bfs": grows each cluster by breadth-first search from the first unassigned node.
+        - "spectral": recursive spectral bisection, i.e., splits the nodes by their order in the Fiedler vector.
+    :return: list of num_clusters sorted arrays of node indices.
+    """
+    adj_mx = _symmetrize(adj_mx)
+    num_nodes = adj_mx.shape[0]
+    if not 0 < num_clusters <= num_nodes:
+        raise ValueError('num_clusters must be in [1, %d], got: %d' % (num_nodes, num_clusters))
+    if method == 'bfs':
+        return _bfs_partition(adj_mx, num_clusters)
+    elif method == 'spectral':
+        return _spectral_partition(adj_mx, num_clusters)
+    raise ValueError('Unknown partition method: %s' % method)
+
+
+def _bfs_partition(adj_mx, num_clusters):
+    num_nodes = adj_mx.shape[0]
+    assigned = np.zeros(num_nodes, dtype=bool)
+    clusters = []
+    for i in range(num_clusters):
+        # Spreads the remaining nodes evenly over the remaining clusters.
+        cluster_size = (num_nodes - assigned.sum()) // (num_clusters - i)
+        cluster = []
+        queue = collections.deque()
+        while len(cluster) < cluster_size:
+            if not queue:
+                # Starts from the next unassigned node, e.g., in another connected component.
+                start = int(np.argmin(assigned))
+                assigned[start] = True
+                queue.append(start)
+            node = queue.popleft()
+            cluster.append(node)
+            for neighbor in adj_mx.indices[adj_mx.indptr[node]: adj_mx.indptr[node + 1]]:
+                if not assigned[neighbor]:
+                    assigned[neighbor] = True
+                    queue.append(neighbor)
+        # Nodes reached but not added are returned to the unassigned ones.
+        assigned[list(queue)] = False
+        clusters.append(np.sort(np.array(cluster, dtype=np.int64)))
+    return clusters
+
+
+def _spectral_partition(adj_mx, num_clusters, nodes=None):
+    if nodes is None:
+        nodes = np.arange(adj_mx.shape[0])
+    if num_clusters == 1:
+        return [nodes]
+    L = calculate_normalized_laplacian(adj_mx[nodes][:, nodes])
+    if len(nodes) > 2:
+        # The smallest eigenvalues of L are the largest of 2I - L, which ARPACK finds quickly. Eigenvalues are in
+        # ascending order, i.e., the first eigenvector is the Fiedler vector.
+        _, v = linalg.eigsh(2 * sp.identity(len(nodes)) - L, 2, which='LA')
+        fiedler = v[:, 0]
+    else:
+        fiedler = np.arange(len(nodes))
+    order = np.argsort(fiedler, kind='mergesort')
+    # Splits the clusters between both parts in proportion to their sizes.
+    num_left_clusters = num_clusters // 2
+    split = len(nodes) * num_left_clusters // num_clusters
+    return (_spectral_partition(adj_mx, num_left_clusters, np.sort(nodes[order[:split]])) +
+            _spectral_partition(adj_mx, num_clusters - num_left_clusters, np.sort(nodes[order[split:]])))
+
+
+def _expand_halo(adj_mx, nodes, depth):
+    """
+    :param adj_mx: symmetric sparse adjacency matrix in csr format.
+    :return: nodes followed by the nodes within depth hops of them, ordered by distance.
+    """
+    in_subgraph = np.zeros(adj_mx.shape[0], dtype=bool)
+    in_subgraph[nodes] = True
+    frontier = nodes
+    subgraph = [nodes]
+    for _ in range(depth):
+        neighbors = np.unique(adj_mx[frontier].indices)
+        frontier = neighbors[~in_subgraph[neighbors]]
+        if len(frontier) == 0:
+            break
+        in_subgraph[frontier] = True
+        subgraph.append(frontier)
+    return np.concatenate(subgraph)
+
+
+def _pad_support(support, num_nodes):
+    """
+    Zero-pads a support to (num_nodes, num_nodes).
+    """
+    support = sp.coo_matrix(support)
+    return sp.coo_matrix((support.data, (support.row, support.col)), shape=(num_nodes, num_nodes), dtype=np.float32)
+
+
+def get_num_supports(filter_type):
+    """
+    :return: number of supports of the filter type, see calculate_supports.
+    """
+    return 2 if filter_type == 'dual_random_walk' else 1
+
+
+class Subgraph(object):
+    """
+    Induced subgraph of core nodes and their halo, zero-padded to a fixed number of nodes, so that subgraphs of
+    different sizes are run by the same model. Padding nodes are isolated, i.e., they do not affect the other nodes.
+    """
+
+    def __init__(self, nodes, num_core_nodes, supports, num_nodes):
+        """
+        :param nodes: indices of the nodes in the full graph, the core nodes followed by the halo nodes.
+        :param num_core_nodes:
+        :param supports: list of sparse supports of the subgraph with size (num_nodes, num_nodes).
+        :param num_nodes: number of nodes after padding.
+        """
+        self._nodes = nodes
+        self._num_core_nodes = num_core_nodes
+        self._supports = supports
+        self._num_nodes = num_nodes
+        self._node_indices = None
+        self._support_values = None
+
+    def take(self, x, axis=-2):
+        """
+        Takes the features of the subgraph nodes from x along the node axis, and zero-pads them to num_nodes nodes.
+        """
+        axis = axis % x.ndim
+        shape = list(x.shape)
+        shape[axis] = self._num_nodes
+        result = np.zeros(shape, dtype=x.dtype)
+        index = (slice(None),) * axis + (slice(0, len(self._nodes)),)
+        result[index] = np.take(x, self._nodes, axis=axis)
+        return result
+
+    @property
+    def node_indices(self):
+        """
+        Indices of the nodes in the full graph, padded with 0.
+        """
+        if self._node_indices is None:
+            self._node_indices = np.pad(self._nodes, (0, self._num_nodes - len(self._nodes)), mode='constant')
+        return self._node_indices
+
+    @property
+    def nodes(self):
+        return self._nodes
+
+    @property
+    def num_core_nodes(self):
+        return self._num_core_nodes
+
+    @property
+    def num_nodes(self):
+        return self._num_nodes
+
+    @property
+    def supports(self):
+        return self._supports
+
+    @property
+    def support_values(self):
+        """
+        tf.SparseTensorValue of each support, e.g., to feed sparse placeholders, which is converted once.
+        """
+        if self._support_values is None:
+            self._support_values = [tf.SparseTensorValue(*tf_utils.sparse_matrix_to_tf_sparse_tensor(support))
+                                    for support in self._supports]
+        return self._support_values
+
+
+class GraphPartition(object):
+    """
+    Partitions the graph into clusters for mini-batch training on very large graphs: each step samples a union of
+    clusters, whose nodes are the core nodes, expands it with a halo of neighbors, which provides the core nodes with
+    the context of the diffusion, and builds the supports of the induced subgraph.
+    """
+
+    def __init__(self, adj_mx, num_clusters, halo_depth=1, clusters_per_step=1, method='bfs', filter_type='laplacian',
+                 lambda_max_method='eigsh', seed=None, max_cached_subgraphs=1024):
+        """
+        :param adj_mx: dense or sparse adjacency matrix.
+        :param num_clusters:
+        :param halo_depth: number of hops of the halo, usually max_diffusion_step, 0 for no halo.
+        :param clusters_per_step: number of clusters sampled per step.
+        :param method: see partition_graph.
+        :param filter_type: see calculate_supports.
+        :param lambda_max_method: see estimate_lambda_max.
+        :param seed:
+        :param max_cached_subgraphs: number of sampled subgraphs which are kept, least recently used first out, e.g.,
+        all the num_clusters subgraphs for clusters_per_step=1.
+        """
+        self._adj_mx = sp.csr_matrix(adj_mx)
+        self._symmetric_adj_mx = _symmetrize(adj_mx)
+        self._clusters = partition_graph(self._symmetric_adj_mx, num_clusters, method=method)
+        self._halo_depth = halo_depth
+        self._clusters_per_step = min(clusters_per_step, num_clusters)
+        self._filter_type = filter_type
+        self._lambda_max_method = lambda_max_method
+        self._rng = np.random.RandomState(seed)
+        # Sorted tuple of cluster ids -> Subgraph, i.e., the halo, supports and their conversion for feeding are only
+        # computed the first time a union of clusters is sampled.
+        self._subgraphs = collections.OrderedDict()
+        self._max_cached_subgraphs = max_cached_subgraphs
+        # The union of clusters with their halos is at most as large as the sum of the largest clusters with halos.
+        sizes = sorted(len(_expand_halo(self._symmetric_adj_mx, cluster, halo_depth)) for cluster in self._clusters)
+        self._num_nodes = int(sum(sizes[-self._clusters_per_step:]))
+
+    def sample(self):
+        """
+        Samples a union of clusters.
+        :return: Subgraph
+        """
+        cluster_ids = tuple(sorted(self._rng.choice(len(self._clusters), self._clusters_per_step, replace=False)))
+        subgraph = self._subgraphs.pop(cluster_ids, None)
+        if subgraph is None:
+            subgraph = self.get_subgraph(np.concatenate([self._clusters[i] for i in cluster_ids]))
+        # The most recently used subgraph is the last one.
+        self._subgraphs[cluster_ids] = subgraph
+        while len(self._subgraphs) > self._max_cached_subgraphs:
+            self._subgraphs.popitem(last=False)
+        return subgraph
+
+    def get_subgraph(self, core_nodes):
+        """
+        :param core_nodes: indices of the core nodes.
+        :return: Subgraph
+        """
+        nodes = _expand_halo(self._symmetric_adj_mx, core_nodes, self._halo_depth)
+        supports = [_pad_support(support, self._num_nodes) for support in
+                    calculate_supports(self._adj_mx[nodes][:, nodes], filter_type=self._filter_type,
+                                       lambda_max_method=self._lambda_max_method)]
+        return Subgraph(nodes, num_core_nodes=len(core_nodes), supports=supports, num_nodes=self._num_nodes)
+
+    @property
+    def clusters(self):
+        return self._clusters
+
+    @property
+    def halo_depth(self):
+        return self._halo_depth
+
+    @property
+    def num_clusters(self):
+        return len(self._clusters)
+
+    @property
+    def num_nodes(self):
+        """
+        Number of nodes of every subgraph after padding.
+        """
+        return self._num_nodes
+
+
+class ReceptiveFieldExtractor(object):
+    """
+    Extracts the subgraph that the outputs of target nodes depend on, i.e., the target nodes and the nodes within
+    the receptive field, so that running the model on the subgraph gives the same outputs for the target nodes as
+    running it on the full graph.
+    The supports of the subgraph are sliced from the supports of the full graph, which keeps the normalization of the
+    full graph, e.g., degrees and lambda_max. Rows of the nodes at the border of the receptive field are incomplete,
+    which does not affect the target nodes.
+    """
+
+    def __init__(self, adj_mx, num_hops, filter_type='laplacian', lambda_max_method='eigsh'):
+        """
+        :param adj_mx: dense or sparse adjacency matrix.
+        :param num_hops: number of hops of the receptive field, e.g., DCRNNModel.get_receptive_field_hops.
+        :param filter_type: see calculate_supports.
+        :param lambda_max_method: see estimate_lambda_max.
+        """
+        self._num_hops = num_hops
+        self._symmetric_adj_mx = _symmetrize(adj_mx)
+        self._supports = [sp.csr_matrix(support) for support in
+                          support_registry.get_supports(adj_mx, filter_type=filter_type,
+                                                        lambda_max_method=lambda_max_method)]
+
+    def get_subgraph(self, target_nodes, min_num_nodes=64):
+        """
+        :param target_nodes: indices of the target nodes.
+        :param min_num_nodes: the subgraph is padded to the next power of two of at least min_num_nodes nodes, or to
+        the number of nodes of the full graph, which bounds the number of different sizes, e.g., of models.
+        :return: Subgraph, whose core nodes are the target nodes.
+        """
+        target_nodes = np.asarray(target_nodes, dtype=np.int64)
+        nodes = _expand_halo(self._symmetric_adj_mx, target_nodes, self._num_hops)
+        num_nodes = max(min_num_nodes, 1 << int(np.ceil(np.log2(len(nodes)))))
+        num_nodes = min(num_nodes, self._symmetric_adj_mx.shape[0])
+        supports = [_pad_support(support[nodes][:, nodes], num_nodes) for support in self._supports]
+        return Subgraph(nodes, num_core_nodes=len(target_nodes), supports=supports, num_nodes=num_nodes)
+
+    @property
+    def num_hops(self):
+        return self._num_hops
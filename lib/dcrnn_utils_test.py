@@ -0,0 +1,247 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import scipy.sparse as sp
+import tensorflow as tf
+
+from lib import dcrnn_utils
+
+
+class GraphDataTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_save_load_graph_data(self):
+        adj_mx = np.array([
+            [1, 0.5, 0],
+            [0, 1, 0.05],
+            [0.2, 0, 1]
+        ], dtype=np.float32)
+        sensor_ids = ['400001', '400017', '400030']
+        filename = os.path.join(self._dir, 'adj_mx.npz')
+        dcrnn_utils.save_graph_data(filename, sensor_ids, adj_mx)
+        loaded_sensor_ids, sensor_id_to_ind, loaded_adj_mx = dcrnn_utils.load_graph_data(filename)
+        self.assertListEqual(sensor_ids, loaded_sensor_ids)
+        self.assertEqual(2, sensor_id_to_ind['400030'])
+        self.assertTrue(sp.issparse(loaded_adj_mx))
+        self.assertTrue(np.array_equal(adj_mx, loaded_adj_mx.toarray()))
+
+    def test_save_load_lambda_max(self):
+        adj_mx = sp.random(50, 50, density=0.1, random_state=np.random.RandomState(0), format='csr',
+                           dtype=np.float32)
+        filename = os.path.join(self._dir, 'adj_mx.npz')
+        dcrnn_utils.save_graph_data(filename, [str(i) for i in range(50)], adj_mx, lambda_max_method='lanczos')
+        dcrnn_utils.support_registry.clear()
+        _, _, loaded_adj_mx = dcrnn_utils.load_graph_data(filename)
+        # Loaded with the graph instead of computed.
+        lambda_max = dcrnn_utils.support_registry._lambda_max[
+            (dcrnn_utils.support_registry.get_fingerprint(loaded_adj_mx), 'lanczos')]
+        self.assertAlmostEqual(dcrnn_utils.calculate_lambda_max(adj_mx), lambda_max, delta=1e-2)
+        dcrnn_utils.support_registry.clear()
+
+    def test_threshold_adj_mx(self):
+        adj_mx = np.array([
+            [1, 0.5, 0],
+            [0, 1, 0.05],
+            [0.2, 0, 1]
+        ], dtype=np.float32)
+        sparse_adj_mx = dcrnn_utils.threshold_adj_mx(sp.csr_matrix(adj_mx), 0.1)
+        dense_adj_mx = dcrnn_utils.threshold_adj_mx(adj_mx, 0.1)
+        self.assertEqual(5, sparse_adj_mx.nnz)
+        self.assertTrue(np.array_equal(dense_adj_mx, sparse_adj_mx.toarray()))
+
+
+class LambdaMaxTest(unittest.TestCase):
+    def setUp(self):
+        adj_mx = sp.random(500, 500, density=0.02, random_state=np.random.RandomState(0), format='csr')
+        self._adj_mx = adj_mx
+        self._L = dcrnn_utils.calculate_normalized_laplacian(adj_mx.maximum(adj_mx.T))
+        self._lambda_max = np.linalg.eigvalsh(self._L.toarray())[-1]
+
+    def test_estimate_lambda_max(self):
+        self.assertAlmostEqual(self._lambda_max, dcrnn_utils.estimate_lambda_max(self._L), delta=1e-6)
+        lanczos = dcrnn_utils.estimate_lambda_max(self._L, method='lanczos')
+        self.assertAlmostEqual(self._lambda_max, lanczos, delta=1e-2)
+        # The Rayleigh quotient never exceeds the largest eigenvalue.
+        power = dcrnn_utils.estimate_lambda_max(self._L, method='power', num_iters=200)
+        self.assertLessEqual(power, self._lambda_max + 1e-6)
+        self.assertAlmostEqual(self._lambda_max, power, delta=0.05)
+        upper_bound = dcrnn_utils.estimate_lambda_max(self._L, method='lanczos', upper_bound=True)
+        self.assertGreaterEqual(upper_bound, self._lambda_max - 1e-6)
+        self.assertLessEqual(upper_bound, self._lambda_max + 0.01)
+        with self.assertRaises(ValueError):
+            dcrnn_utils.estimate_lambda_max(self._L, method='unknown')
+
+    def test_upper_bound(self):
+        # Power iteration rarely converges within the default num_iters, i.e., mostly falls back to 2.
+        for seed in range(5):
+            adj_mx = sp.random(500, 500, density=0.02, random_state=np.random.RandomState(seed), format='csr')
+            lambda_max = dcrnn_utils.calculate_lambda_max(adj_mx)
+            for method in ['lanczos', 'power']:
+                upper_bound = dcrnn_utils.calculate_lambda_max(adj_mx, method=method)
+                self.assertGreaterEqual(upper_bound, lambda_max - 1e-6)
+                self.assertLessEqual(upper_bound, 2.)
+                scaled_laplacian = dcrnn_utils.calculate_scaled_laplacian(adj_mx, lambda_max=upper_bound)
+                self.assertLessEqual(np.linalg.eigvalsh(scaled_laplacian.toarray())[-1], 1. + 1e-5)
+
+    def test_calculate_scaled_laplacian(self):
+        dense = dcrnn_utils.calculate_scaled_laplacian(self._adj_mx.toarray(), lambda_max=None)
+        sparse = dcrnn_utils.calculate_scaled_laplacian(self._adj_mx, lambda_max=None)
+        self.assertTrue(np.allclose(dense.toarray(), sparse.toarray(), atol=1e-6))
+        self.assertAlmostEqual(self._lambda_max, dcrnn_utils.calculate_lambda_max(self._adj_mx), delta=1e-6)
+        registry = dcrnn_utils.SupportRegistry()
+        registry.set_lambda_max(self._adj_mx, self._lambda_max)
+        supports = registry.get_supports(self._adj_mx, filter_type='laplacian')
+        self.assertTrue(np.allclose(sparse.toarray(), supports[0].toarray(), atol=1e-6))
+        # The approximate scaling keeps the spectrum within [-1, 1].
+        scaled = dcrnn_utils.calculate_scaled_laplacian(self._adj_mx, lambda_max=None, lambda_max_method='lanczos')
+        self.assertLessEqual(np.linalg.eigvalsh(scaled.toarray())[-1], 1 + 1e-5)
+
+
+class GraphPartitionTest(unittest.TestCase):
+    def setUp(self):
+        # 10 x 10 grid.
+        index = np.arange(100).reshape((10, 10))
+        rows = np.concatenate([index[:, :-1].ravel(), index[:-1, :].ravel()])
+        cols = np.concatenate([index[:, 1:].ravel(), index[1:, :].ravel()])
+        self._adj_mx = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(100, 100))
+
+    def test_partition_graph(self):
+        for method in ['bfs', 'spectral']:
+            clusters = dcrnn_utils.partition_graph(self._adj_mx, num_clusters=3, method=method)
+            self.assertListEqual(list(range(100)), sorted(np.concatenate(clusters).tolist()))
+            self.assertListEqual([33, 33, 34], sorted(len(cluster) for cluster in clusters))
+        with self.assertRaises(ValueError):
+            dcrnn_utils.partition_graph(self._adj_mx, num_clusters=3, method='unknown')
+        with self.assertRaises(ValueError):
+            dcrnn_utils.partition_graph(self._adj_mx, num_clusters=101)
+
+    def test_get_subgraph(self):
+        partition = dcrnn_utils.GraphPartition(self._adj_mx, num_clusters=4, halo_depth=1,
+                                               filter_type='dual_random_walk', seed=0)
+        subgraph = partition.get_subgraph(np.array([0, 1]))
+        # Neighbors of nodes 0 and 1 in the grid.
+        self.assertListEqual([0, 1, 2, 10, 11], subgraph.nodes.tolist())
+        self.assertEqual(2, subgraph.num_core_nodes)
+        self.assertEqual(partition.num_nodes, subgraph.num_nodes)
+        self.assertEqual(2, len(subgraph.supports))
+        sub_adj_mx = self._adj_mx[subgraph.nodes][:, subgraph.nodes]
+        expected = dcrnn_utils.calculate_supports(sub_adj_mx, filter_type='dual_random_walk')
+        for support, expected_support in zip(subgraph.supports, expected):
+            self.assertTupleEqual((partition.num_nodes, partition.num_nodes), support.shape)
+            self.assertTrue(np.allclose(expected_support.toarray(), support.toarray()[:5, :5]))
+            self.assertEqual(0, abs(support.toarray()[5:]).sum())
+        x = np.random.rand(2, 3, 100, 1)
+        x_subgraph = subgraph.take(x)
+        self.assertTupleEqual((2, 3, partition.num_nodes, 1), x_subgraph.shape)
+        self.assertTrue(np.array_equal(x[:, :, [0, 1, 2, 10, 11]], x_subgraph[:, :, :5]))
+        self.assertEqual(0, x_subgraph[:, :, 5:].sum())
+
+    def test_sample(self):
+        partition = dcrnn_utils.GraphPartition(self._adj_mx, num_clusters=4, halo_depth=2, clusters_per_step=2,
+                                               seed=0)
+        for _ in range(5):
+            subgraph = partition.sample()
+            self.assertEqual(50, subgraph.num_core_nodes)
+            self.assertLessEqual(len(subgraph.nodes), partition.num_nodes)
+            self.assertEqual(len(subgraph.nodes), len(np.unique(subgraph.nodes)))
+
+    def test_sample_cache(self):
+        partition = dcrnn_utils.GraphPartition(self._adj_mx, num_clusters=4, halo_depth=1, seed=0)
+        subgraphs = {}
+        for _ in range(20):
+            subgraph = partition.sample()
+            # Each cluster is sampled with the same subgraph.
+            self.assertIs(subgraph, subgraphs.setdefault(subgraph.nodes[0], subgraph))
+        self.assertEqual(4, len(subgraphs))
+        partition = dcrnn_utils.GraphPartition(self._adj_mx, num_clusters=4, halo_depth=1, seed=0,
+                                               max_cached_subgraphs=2)
+        for _ in range(20):
+            partition.sample()
+        self.assertEqual(2, len(partition._subgraphs))
+
+
+class ReceptiveFieldExtractorTest(unittest.TestCase):
+    def test_get_subgraph(self):
+        adj_mx = sp.random(300, 300, density=0.005, random_state=np.random.RandomState(0), format='csr')
+        num_hops = 3
+        extractor = dcrnn_utils.ReceptiveFieldExtractor(adj_mx, num_hops=num_hops, filter_type='dual_random_walk')
+        target_nodes = [5, 42]
+        subgraph = extractor.get_subgraph(target_nodes, min_num_nodes=8)
+        self.assertListEqual(target_nodes, subgraph.nodes[:2].tolist())
+        self.assertGreaterEqual(subgraph.num_nodes, len(subgraph.nodes))
+        # Diffusing num_hops times on the subgraph gives the same target outputs as on the full graph.
+        supports = dcrnn_utils.calculate_supports(adj_mx, filter_type='dual_random_walk')
+        x = np.random.rand(300, 2)
+        h = x
+        h_subgraph = subgraph.take(x, axis=0)
+        x_subgraph = h_subgraph
+        for _ in range(num_hops):
+            h = np.tanh(sum(support.dot(h) for support in supports) + x)
+            h_subgraph = np.tanh(sum(support.dot(h_subgraph) for support in subgraph.supports) + x_subgraph)
+        self.assertTrue(np.allclose(h[target_nodes], h_subgraph[:2]))
+
+
+class SupportRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self._adj_mx = np.array([
+            [1, 0.5, 0],
+            [0, 1, 0.05],
+            [0.2, 0, 1]
+        ], dtype=np.float32)
+
+    def test_adj_mx_fingerprint(self):
+        fingerprint = dcrnn_utils.adj_mx_fingerprint(self._adj_mx)
+        self.assertEqual(fingerprint, dcrnn_utils.adj_mx_fingerprint(self._adj_mx.copy()))
+        self.assertNotEqual(fingerprint, dcrnn_utils.adj_mx_fingerprint(self._adj_mx.T))
+        sparse_fingerprint = dcrnn_utils.adj_mx_fingerprint(sp.csr_matrix(self._adj_mx))
+        self.assertEqual(sparse_fingerprint, dcrnn_utils.adj_mx_fingerprint(sp.coo_matrix(self._adj_mx)))
+
+    def test_get_fingerprint(self):
+        registry = dcrnn_utils.SupportRegistry()
+        adj_mx = self._adj_mx.copy()
+        self.assertEqual(dcrnn_utils.adj_mx_fingerprint(adj_mx), registry.get_fingerprint(adj_mx))
+        self.assertEqual(1, len(registry._fingerprints))
+        # Computed once per matrix object.
+        adj_mx[0, 0] = 2
+        self.assertEqual(dcrnn_utils.adj_mx_fingerprint(self._adj_mx), registry.get_fingerprint(adj_mx))
+        self.assertNotEqual(registry.get_fingerprint(adj_mx), registry.get_fingerprint(adj_mx.copy()))
+        del adj_mx
+        self.assertEqual(0, len(registry._fingerprints))
+
+    def test_get_supports(self):
+        registry = dcrnn_utils.SupportRegistry()
+        supports = registry.get_supports(self._adj_mx, filter_type='dual_random_walk')
+        self.assertIs(supports, registry.get_supports(self._adj_mx.copy(), filter_type='dual_random_walk'))
+        expected = dcrnn_utils.calculate_supports(self._adj_mx, filter_type='dual_random_walk')
+        self.assertEqual(2, len(supports))
+        for support, expected_support in zip(supports, expected):
+            self.assertTrue(np.allclose(expected_support.toarray(), support.toarray()))
+        self.assertIsNot(supports, registry.get_supports(self._adj_mx, filter_type='random_walk'))
+
+    def test_get_support_tensors(self):
+        registry = dcrnn_utils.SupportRegistry()
+        with tf.Graph().as_default():
+            with tf.name_scope('Train'):
+                tensors = registry.get_support_tensors(self._adj_mx, filter_type='laplacian', backend='sparse')
+            with tf.name_scope('Test'):
+                self.assertIs(tensors, registry.get_support_tensors(self._adj_mx, filter_type='laplacian',
+                                                                    backend='sparse'))
+            self.assertIsInstance(tensors[0], tf.SparseTensor)
+            dense_tensors = registry.get_support_tensors(self._adj_mx, filter_type='laplacian', backend='dense')
+            self.assertNotIsInstance(dense_tensors[0], tf.SparseTensor)
+        with tf.Graph().as_default():
+            self.assertIsNot(tensors, registry.get_support_tensors(self._adj_mx, filter_type='laplacian',
+                                                                   backend='sparse'))
+        # Small graphs use dense supports.
+        self.assertListEqual(['dense'], registry.get_backends(self._adj_mx, filter_type='laplacian'))
+
+
+if __name__ == '__main__':
+    unittest.main()
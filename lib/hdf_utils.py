@@ -0,0 +1,83 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import pandas as pd
+
+
+class HDFChunkReader(object):
+    """
+    Reads a pandas DataFrame stored in HDF5 by row ranges and column subsets, so that the whole DataFrame
+    never needs to be loaded into memory.
+    Column subsets are selected on disk for stores in `table` format, and chunk by chunk for `fixed` format.
+    """
+
+    def __init__(self, filename, key=None, columns=None, chunk_size=10000, dtype=None):
+        """
+        :param filename: path of the hdf5 file.
+        :param key: key of the DataFrame in the store, can be omitted if the store only contains one DataFrame.
+        :param columns: columns to read, e.g., sensor ids, None to read all the columns.
+        :param chunk_size: number of rows per chunk.
+        :param dtype: if specified, the values are cast to dtype when read, e.g., np.float32.
+        """
+        self._filename = filename
+        self._chunk_size = chunk_size
+        self._dtype = dtype
+        with pd.HDFStore(filename, mode='r') as store:
+            if key is None:
+                keys = store.keys()
+                if len(keys) != 1:
+                    raise ValueError('key must be specified for stores with multiple datasets: %s' % keys)
+                key = keys[0]
+            storer = store.get_storer(key)
+            self._is_table = storer.is_table
+            if self._is_table:
+                self._num_rows = int(storer.nrows)
+            else:
+                # Fixed format DataFrame: axis0 stores the columns and axis1 stores the index.
+                self._num_rows = int(storer.group.axis1.shape[0])
+        self._key = key
+        if columns is None:
+            columns = list(pd.read_hdf(filename, key, start=0, stop=0).columns)
+        self._columns = list(columns)
+
+    def read(self, start=0, stop=None):
+        """
+        Reads rows [start, stop) of the selected columns.
+        :return: pandas.DataFrame
+        """
+        if stop is None:
+            stop = self._num_rows
+        if self._is_table:
+            df = pd.read_hdf(self._filename, self._key, start=start, stop=stop, columns=self._columns)
+        else:
+            df = pd.read_hdf(self._filename, self._key, start=start, stop=stop)
+        df = df.loc[:, self._columns]
+        if self._dtype is not None:
+            df = df.astype(self._dtype)
+        return df
+
+    def iter_chunks(self, start=0, stop=None):
+        """
+        Iterates over rows [start, stop) in chunks of at most `chunk_size` rows.
+        """
+        if stop is None:
+            stop = self._num_rows
+        for chunk_start in range(start, stop, self._chunk_size):
+            yield self.read(chunk_start, min(chunk_start + self._chunk_size, stop))
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def shape(self):
+        return self._num_rows, len(self._columns)
@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from lib.hdf_utils import HDFChunkReader
+
+
+class HDFChunkReaderTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._df = pd.DataFrame(np.arange(60, dtype=np.float32).reshape((20, 3)), columns=['a', 'b', 'c'],
+                                index=pd.date_range('2012-03-01', periods=20, freq='5min'))
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _test_read(self, fmt):
+        filename = os.path.join(self._dir, '%s.h5' % fmt)
+        self._df.to_hdf(filename, key='df', format=fmt)
+        reader = HDFChunkReader(filename, columns=['c', 'a'], chunk_size=6)
+        self.assertTupleEqual((20, 2), reader.shape)
+        chunks = list(reader.iter_chunks(2, 17))
+        self.assertListEqual([6, 6, 3], [chunk.shape[0] for chunk in chunks])
+        self.assertTrue(pd.concat(chunks).equals(self._df.iloc[2:17][['c', 'a']]))
+
+    def test_read_fixed(self):
+        self._test_read('fixed')
+
+    def test_read_table(self):
+        self._test_read('table')
+
+    def test_read_dtype(self):
+        filename = os.path.join(self._dir, 'df.h5')
+        self._df.astype(np.float64).to_hdf(filename, key='df')
+        reader = HDFChunkReader(filename, dtype=np.float32)
+        self.assertTrue(all(dtype == np.float32 for dtype in reader.read(0, 5).dtypes))
+
+
+if __name__ == '__main__':
+    unittest.main()
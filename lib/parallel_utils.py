@@ -0,0 +1,190 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import threading
+
+import numpy as np
+
+
+class SharedMemoryAllReduce(object):
+    """
+    Averages float32 vectors over the worker processes on one machine through shared memory, e.g., the gradients of
+    data-parallel replicas. It must be created before the workers are forked, see run_workers.
+    Each worker writes its vector into its row of a shared buffer, then averages its slice of all the rows and finally
+    copies the whole average, i.e., the reduction is spread over the workers and each call waits on two barriers.
+    """
+
+    def __init__(self, num_workers, size, timeout=None):
+        """
+        :param num_workers:
+        :param size: maximum size of the vectors.
+        :param timeout: seconds to wait for the other workers at each barrier, None to wait forever.
+        """
+        self._num_workers = num_workers
+        self._size = size
+        self._barrier = multiprocessing.Barrier(num_workers, timeout=timeout)
+        # The views refer to the same shared memory in all the forked workers.
+        self._inputs = np.frombuffer(multiprocessing.RawArray('f', num_workers * size), dtype=np.float32).reshape(
+            (num_workers, size))
+        self._outputs = np.frombuffer(multiprocessing.RawArray('f', size), dtype=np.float32)
+
+    def all_reduce(self, rank, x):
+        """
+        Averages x over the workers, every worker must call all_reduce in the same order.
+        :param rank: rank of the calling worker in [0, num_workers).
+        :param x: vector with at most size elements.
+        :return: the average.
+        """
+        x = np.asarray(x, dtype=np.float32).ravel()
+        n = x.shape[0]
+        self._inputs[rank, :n] = x
+        self._barrier.wait()
+        start, stop = rank * n // self._num_workers, (rank + 1) * n // self._num_workers
+        np.mean(self._inputs[:, start:stop], axis=0, out=self._outputs[start:stop])
+        # The outputs are only written again after every worker has entered the next call, i.e., copied them.
+        self._barrier.wait()
+        return self._outputs[:n].copy()
+
+    def broadcast(self, rank, x, root=0):
+        """
+        Sends x of the root worker to all the workers.
+        :param x: vector with at most size elements, only used by the root, whose shape the others must pass too.
+        """
+        x = np.asarray(x, dtype=np.float32).ravel()
+        n = x.shape[0]
+        # The row of the root is only written by the root, after the other workers have read it.
+        if rank == root:
+            self._inputs[root, :n] = x
+        self._barrier.wait()
+        result = self._inputs[root, :n].copy()
+        self._barrier.wait()
+        return result
+
+    def abort(self):
+        """
+        Breaks the barrier, i.e., workers waiting for a failed worker raise threading.BrokenBarrierError.
+        """
+        self._barrier.abort()
+
+    @property
+    def num_workers(self):
+        return self._num_workers
+
+    @property
+    def size(self):
+        return self._size
+
+
+class BackgroundEvaluator(object):
+    """
+    Runs evaluate(snapshot) in a background thread while the caller continues, e.g., validates snapshots of the
+    variables while training goes on. If evaluating is slower than submitting, only the newest snapshot is evaluated
+    next, i.e., older snapshots which have not been started are skipped.
+    """
+
+    def __init__(self, evaluate):
+        """
+        :param evaluate: evaluate(snapshot) returns the result, called in the background thread.
+        """
+        self._evaluate = evaluate
+        self._condition = threading.Condition()
+        self._pending = None
+        self._results = []
+        self._error = None
+        self._closed = False
+        self._num_skipped = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, snapshot):
+        with self._condition:
+            self._raise_error()
+            if self._pending is not None:
+                self._num_skipped += 1
+            self._pending = snapshot
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                snapshot, self._pending = self._pending, None
+            try:
+                result = self._evaluate(snapshot)
+            except Exception as e:
+                with self._condition:
+                    self._error = e
+                return
+            with self._condition:
+                self._results.append(result)
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def poll(self):
+        """
+        :return: list of the results finished since the last call, from the oldest to the newest.
+        """
+        with self._condition:
+            self._raise_error()
+            results, self._results = self._results, []
+        return results
+
+    def close(self):
+        """
+        Waits for the pending evaluations and stops the thread.
+        :return: see poll.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        return self.poll()
+
+    @property
+    def num_skipped(self):
+        return self._num_skipped
+
+
+def _run_worker(target, rank, all_reduce):
+    try:
+        return target(rank)
+    except BaseException:
+        if all_reduce is not None:
+            all_reduce.abort()
+        raise
+
+
+def run_workers(num_workers, target, all_reduce=None):
+    """
+    Runs target(rank) for rank 0 in the calling process and for the other ranks in forked processes, which share the
+    memory of the calling process, e.g., the training data, copy-on-write.
+    Nothing may have started threads in the calling process which the workers rely on, e.g., tensorflow sessions,
+    which should be created by target.
+    :param num_workers:
+    :param target:
+    :param all_reduce: SharedMemoryAllReduce of the workers, which is aborted if any worker fails.
+    :return: the result of target(0).
+    """
+    context = multiprocessing.get_context('fork')
+    processes = []
+    for rank in range(1, num_workers):
+        process = context.Process(target=_run_worker, args=(target, rank, all_reduce), name='worker_%d' % rank)
+        process.start()
+        processes.append(process)
+    try:
+        result = _run_worker(target, 0, all_reduce)
+    finally:
+        for process in processes:
+            process.join()
+    for rank, process in enumerate(processes, start=1):
+        if process.exitcode != 0:
+            raise RuntimeError('Worker %d failed with exit code %d.' % (rank, process.exitcode))
+    return result
@@ -0,0 +1,79 @@
+import threading
+import unittest
+
+import numpy as np
+
+from lib import parallel_utils
+from lib.parallel_utils import BackgroundEvaluator, SharedMemoryAllReduce
+
+
+class SharedMemoryAllReduceTest(unittest.TestCase):
+    def test_all_reduce(self):
+        num_workers, size = 3, 10
+        all_reduce = SharedMemoryAllReduce(num_workers, size=size, timeout=60)
+
+        def target(rank):
+            results = []
+            for step in range(5):
+                x = np.arange(size, dtype=np.float32) * (rank + 1) + step
+                results.append(all_reduce.all_reduce(rank, x))
+                # Vectors may be shorter than size.
+                results.append(all_reduce.all_reduce(rank, [rank]))
+            results.append(all_reduce.broadcast(rank, [rank + 1., 7.], root=1))
+            for step in range(5):
+                expected = np.arange(size, dtype=np.float32) * 2 + step
+                if not np.allclose(expected, results[2 * step]) or results[2 * step + 1][0] != 1.:
+                    raise AssertionError('Wrong average in worker %d: %s' % (rank, results[2 * step]))
+            if not np.array_equal([2., 7.], results[-1]):
+                raise AssertionError('Wrong broadcast in worker %d: %s' % (rank, results[-1]))
+            return results
+
+        results = parallel_utils.run_workers(num_workers, target, all_reduce=all_reduce)
+        self.assertEqual(11, len(results))
+
+    def test_worker_failure(self):
+        all_reduce = SharedMemoryAllReduce(2, size=1, timeout=60)
+
+        def target(rank):
+            if rank == 1:
+                raise ValueError('Worker failed.')
+            all_reduce.all_reduce(rank, [1.])
+
+        # The failed worker aborts the barrier instead of leaving the other worker waiting.
+        with self.assertRaises(threading.BrokenBarrierError):
+            parallel_utils.run_workers(2, target, all_reduce=all_reduce)
+
+
+class BackgroundEvaluatorTest(unittest.TestCase):
+    def test_newest_snapshot(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def evaluate(snapshot):
+            started.set()
+            release.wait(60)
+            return snapshot * 10
+
+        evaluator = BackgroundEvaluator(evaluate)
+        evaluator.submit(1)
+        started.wait(60)
+        # 2 is replaced by 3 while 1 is being evaluated.
+        evaluator.submit(2)
+        evaluator.submit(3)
+        self.assertListEqual([], evaluator.poll())
+        release.set()
+        self.assertListEqual([10, 30], evaluator.close())
+        self.assertEqual(1, evaluator.num_skipped)
+
+    def test_error(self):
+        def evaluate(snapshot):
+            raise ValueError('Evaluation failed.')
+
+        evaluator = BackgroundEvaluator(evaluate)
+        evaluator.submit(1)
+        with self.assertRaises(ValueError):
+            evaluator.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
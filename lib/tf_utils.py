@@ -1,5 +1,8 @@
 from __future__ import absolute_import, division, print_function
 
+import threading
+import time
+
 import numpy as np
 import scipy.sparse as sp
 import tensorflow as tf
@@ -34,15 +37,269 @@ def adj_tensor_dot(adj, y):
     y_permute_dim = list(range(len(y_shape)))
     y_permute_dim = [y_permute_dim.pop(-2)] + y_permute_dim
     yt = tf.reshape(tf.transpose(y, perm=y_permute_dim), [y_shape[-2], -1])
-    if isinstance(adj, tf.SparseTensor):
-        res = tf.sparse_tensor_dense_matmul(adj, yt)
-    else:
-        res = tf.matmul(adj, yt)
+    res = support_matmul(adj, yt)
     res = tf.reshape(res, [y_shape[-2], -1, y_shape[-1]])
     res = tf.transpose(res, perm=[1, 0, 2])
     return res
 
 
+def support_matmul(support, x):
+    """
+    Multiplies a support, i.e., a tf.SparseTensor or a dense tensor, see build_support_tensor, with the dense matrix x.
+    """
+    if isinstance(support, tf.SparseTensor):
+        return tf.sparse_tensor_dense_matmul(support, x)
+    return tf.matmul(support, x)
+
+
+def build_support_tensor(support, backend='sparse'):
+    """
+    Builds the graph constant of a scipy sparse matrix.
+    :param support:
+    :param backend: 'sparse' for a tf.SparseTensor, or 'dense' for a dense tensor, which is multiplied with tf.matmul.
+    :return:
+    """
+    if backend == 'dense':
+        return tf.constant(support.toarray())
+    if backend != 'sparse':
+        raise ValueError('Unknown support backend: %s' % backend)
+    support = support.tocoo()
+    indices = np.column_stack((support.row, support.col))
+    return tf.sparse_reorder(tf.SparseTensor(indices, support.data, support.shape))
+
+
+def select_support_backend(support, backend='auto', num_columns=4096, max_dense_nodes=4096, max_small_nodes=1024,
+                           min_dense_density=0.05):
+    """
+    Selects dense tf.matmul or tf.sparse_tensor_dense_matmul for a support.
+    :param support: scipy sparse matrix with size (num_nodes, num_nodes).
+    :param backend: 'sparse' or 'dense' to force a backend, 'auto' to use dense matrices for small or dense-ish graphs,
+    and 'benchmark' to time both on a (num_nodes, num_columns) matrix, e.g., batch_size * input_size columns.
+    :param max_dense_nodes: larger graphs always use the sparse backend, as dense supports need O(num_nodes^2) memory.
+    :param max_small_nodes: graphs up to this size use the dense backend for 'auto'.
+    :param min_dense_density: graphs with at least this fraction of non-zero entries use the dense backend for 'auto'.
+    :return: 'dense' or 'sparse'.
+    """
+    if backend in ('dense', 'sparse'):
+        return backend
+    if backend not in ('auto', 'benchmark'):
+        raise ValueError('Unknown support backend: %s' % backend)
+    num_nodes = support.shape[0]
+    if num_nodes > max_dense_nodes:
+        return 'sparse'
+    if backend == 'benchmark':
+        timings = benchmark_support_backends(support, num_columns=num_columns)
+        return min(timings, key=timings.get)
+    density = support.nnz / float(num_nodes * support.shape[1])
+    if num_nodes <= max_small_nodes or density >= min_dense_density:
+        return 'dense'
+    return 'sparse'
+
+
+def benchmark_support_backends(support, num_columns=4096, num_runs=10):
+    """
+    Times the multiplication of the support with a dense (num_nodes, num_columns) matrix for both backends.
+    :return: dict from backend to the average time in seconds.
+    """
+    x = np.random.RandomState(0).rand(support.shape[1], num_columns).astype(np.float32)
+    timings = {}
+    for backend in ['dense', 'sparse']:
+        with tf.Graph().as_default(), tf.Session() as sess:
+            product = support_matmul(build_support_tensor(support.astype(np.float32), backend), tf.constant(x))
+            # Warm up.
+            sess.run(product.op)
+            start_time = time.time()
+            for _ in range(num_runs):
+                sess.run(product.op)
+            timings[backend] = (time.time() - start_time) / num_runs
+    return timings
+
+
+class BatchPrefetcher(object):
+    """
+    Prefetches batches into a bounded in-graph FIFOQueue from a background thread, so that feeding the next batches
+    overlaps with the computation on the current one. The model reads its inputs from `dequeue()` instead of
+    placeholders, and each `sess.run` that evaluates them consumes one batch, or one batch per step of an in-graph
+    loop, see `repeat_steps`.
+    """
+
+    def __init__(self, shapes, dtypes=None, capacity=2, name='batch_queue'):
+        """
+        :param shapes: shapes of the tensors in each batch, dimensions may be None, e.g., for a variable batch size.
+        :param dtypes: dtypes of the tensors in each batch, default: tf.float32.
+        :param capacity: number of prefetched batches, 2 for double buffering.
+        :param name:
+        """
+        if dtypes is None:
+            dtypes = [tf.float32] * len(shapes)
+        with tf.name_scope(name):
+            self._placeholders = [tf.placeholder(dtype, shape=shape) for dtype, shape in zip(dtypes, shapes)]
+            if all(tf.TensorShape(shape).is_fully_defined() for shape in shapes):
+                self._queue = tf.FIFOQueue(capacity, dtypes=dtypes, shapes=shapes)
+            else:
+                # Only the padding queue accepts unknown dimensions, single batches are dequeued without padding.
+                self._queue = tf.PaddingFIFOQueue(capacity, dtypes=dtypes, shapes=shapes)
+            self._enqueue_op = self._queue.enqueue(self._placeholders)
+            self._close_op = self._queue.close(cancel_pending_enqueues=True)
+            self._size_op = self._queue.size()
+            self._drain_size = tf.placeholder(tf.int32, shape=())
+            self._drain_op = self._queue.dequeue_up_to(self._drain_size)
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._available = None
+        self._error = None
+        self._num_enqueued = 0
+        self._num_dequeued = 0
+        self._wait_time = 0.
+
+    def dequeue(self):
+        """
+        Creates a dequeue op, i.e., the ops created inside a tf.while_loop dequeue a batch per iteration.
+        """
+        return self._queue.dequeue()
+
+    def start(self, sess, batches):
+        """
+        Starts enqueueing batches in a background thread.
+        :param sess:
+        :param batches: iterable of tuples of arrays, one for each tensor.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            raise RuntimeError('The batches of the previous epoch are still being enqueued, see stop.')
+        self._available = threading.Semaphore(0)
+        self._stop_event = threading.Event()
+        self._error = None
+        self._num_enqueued = 0
+        self._num_dequeued = 0
+        self._wait_time = 0.
+        self._thread = threading.Thread(target=self._enqueue, args=(sess, batches))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _enqueue(self, sess, batches):
+        try:
+            for batch in batches:
+                if self._stop_event.is_set():
+                    break
+                sess.run(self._enqueue_op, feed_dict=dict(zip(self._placeholders, batch)))
+                self._num_enqueued += 1
+                self._available.release()
+        except Exception as e:
+            self._error = e
+            # Fails the dequeue ops which would otherwise block forever, e.g., in an in-graph loop.
+            sess.run(self._close_op)
+        finally:
+            # Wakes up the consumer, which then sees that no batch is left.
+            self._available.release()
+
+    def wait(self):
+        """
+        Blocks until the next batch is in the queue.
+        :return: False if all the batches have been consumed.
+        """
+        start_time = time.time()
+        self._available.acquire()
+        self._wait_time += time.time() - start_time
+        if self._num_dequeued >= self._num_enqueued:
+            self._thread.join()
+            if self._error is not None:
+                raise self._error
+            return False
+        self._num_dequeued += 1
+        return True
+
+    def join(self):
+        """
+        Waits until all the batches have been enqueued, for consumers which do not `wait` for each batch.
+        """
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def stop(self, sess):
+        """
+        Stops enqueueing, e.g., if the consumer fails before the end of the epoch, and removes the batches left in
+        the queue, so that the next `start` begins with an empty queue. The thread may be blocked on the full queue,
+        which is drained until the thread has finished.
+        """
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        while True:
+            finished = not self._thread.is_alive()
+            size = sess.run(self._size_op)
+            if size > 0:
+                sess.run(self._drain_op, feed_dict={self._drain_size: size})
+            if finished:
+                break
+            self._thread.join(0.01)
+        self._thread = None
+
+    @property
+    def wait_time(self):
+        """
+        Total time in seconds spent waiting for batches since `start`.
+        """
+        return self._wait_time
+
+
+def repeat_steps(num_steps, step_fn, num_outputs=0):
+    """
+    Runs step_fn num_steps times inside a tf.while_loop, i.e., a single `sess.run` performs all the steps, e.g.,
+    optimizer steps on batches from a BatchPrefetcher.
+    Each step starts after the update of the previous step. Variables read by the steps should be resource variables,
+    as reads of reference variables inside the loop may not see the updates.
+    :param num_steps: scalar int32 tensor.
+    :param step_fn: builds one step, returns (update_op, outputs), where outputs is a list of num_outputs scalars.
+    :return: list of the sums of the outputs over the steps, as tf.float32.
+    """
+    def body(i, *sums):
+        with tf.control_dependencies([i] + list(sums)):
+            update_op, outputs = step_fn()
+        with tf.control_dependencies([update_op]):
+            return [i + 1] + [total + tf.cast(output, tf.float32) for total, output in zip(sums, outputs)]
+
+    loop_vars = [tf.constant(0)] + [tf.constant(0.)] * num_outputs
+    results = tf.while_loop(lambda i, *_: i < num_steps, body, loop_vars=loop_vars, parallel_iterations=1)
+    return results[1:]
+
+
+def while_loop_rnn_decoder(decoder_inputs, initial_state, cell, loop_function=None, num_steps=None, scope=None):
+    """
+    Counterpart of tf.contrib.legacy_seq2seq.rnn_decoder, which builds the cell once inside a tf.while_loop instead of
+    once per step, so that the size of the graph does not depend on the number of steps.
+    Variables are created in the same scopes, i.e., both decoders can restore each other's checkpoints.
+    :param decoder_inputs: time-major tensor with shape (timesteps, batch_size, input_size).
+    :param initial_state:
+    :param cell:
+    :param loop_function: if not None, loop_function(prev, i) computes the input of step i > 0 from the output prev of
+    step i - 1, where i is a scalar int32 tensor, instead of using decoder_inputs[i].
+    :param num_steps: number of decoding steps, defaults to timesteps.
+    :param scope:
+    :return: (outputs, state), where outputs is a time-major tensor with shape (num_steps, batch_size, output_size).
+    """
+    with tf.variable_scope(scope or 'rnn_decoder'):
+        if num_steps is None:
+            num_steps = tf.shape(decoder_inputs)[0]
+        batch_size = decoder_inputs.get_shape()[1].value
+        if batch_size is None:
+            batch_size = tf.shape(decoder_inputs)[1]
+        outputs_ta = tf.TensorArray(decoder_inputs.dtype, size=num_steps)
+        prev = tf.zeros(tf.stack([batch_size, cell.output_size]), dtype=decoder_inputs.dtype)
+
+        def body(i, prev, state, outputs_ta):
+            inp = decoder_inputs[i]
+            if loop_function is not None:
+                inp = tf.cond(i > 0, lambda: loop_function(prev, i), lambda: decoder_inputs[i])
+                inp.set_shape(decoder_inputs.get_shape()[1:])
+            output, state = cell(inp, state)
+            return i + 1, output, state, outputs_ta.write(i, output)
+
+        _, _, state, outputs_ta = tf.while_loop(lambda i, *_: i < num_steps, body,
+                                                loop_vars=(tf.constant(0), prev, initial_state, outputs_ta))
+    return outputs_ta.stack(), state
+
+
 def dot(x, y):
     """
     Wrapper for tf.matmul for x with rank >= 2.
@@ -77,6 +334,32 @@ def get_total_trainable_parameter_size():
     return total_parameters
 
 
+def get_variable_values(sess, variables=None):
+    """
+    Takes a snapshot of the values of variables, e.g., for lib.checkpoint_utils.AsyncCheckpointWriter.
+    :param variables: default: all the global variables.
+    :return: dict from the names of the variables to their values.
+    """
+    if variables is None:
+        variables = tf.global_variables()
+    values = sess.run(variables)
+    return {variable.op.name: value for variable, value in zip(variables, values)}
+
+
+def load_variable_values(sess, values, variables=None):
+    """
+    Loads values from get_variable_values into the variables with the same names.
+    :param variables: default: all the global variables, each of which must have a value.
+    """
+    if variables is None:
+        variables = tf.global_variables()
+    missing = [variable.op.name for variable in variables if variable.op.name not in values]
+    if missing:
+        raise ValueError('No values of the variables: %s' % missing)
+    for variable in variables:
+        variable.load(values[variable.op.name], sess)
+
+
 def sparse_matrix_to_tf_sparse_tensor(sparse_mx):
     """Converts sparse matrix to tuple representation as required by tf.SparseTensor"""
 
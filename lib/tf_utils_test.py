@@ -1,6 +1,7 @@
 import unittest
 
 import numpy as np
+import scipy.sparse as sp
 import tensorflow as tf
 
 from lib import tf_utils
@@ -23,6 +24,175 @@ class TensorDotTest(unittest.TestCase):
             result_ = sess.run(result)
             self.assertTrue(np.array_equal(expected_result, result_))
 
+    def test_adj_tensor_dot_backends(self):
+        support = sp.random(5, 5, density=0.3, random_state=np.random.RandomState(0), dtype=np.float32)
+        y = np.random.RandomState(1).rand(3, 5, 2).astype(np.float32)
+        with tf.Graph().as_default(), tf.Session() as sess:
+            results = [sess.run(tf_utils.adj_tensor_dot(tf_utils.build_support_tensor(support, backend),
+                                                        tf.constant(y)))
+                       for backend in ['dense', 'sparse']]
+        expected_result = np.stack([support.dot(y_i) for y_i in y])
+        for result in results:
+            self.assertTrue(np.allclose(expected_result, result))
+
+    def test_select_support_backend(self):
+        rng = np.random.RandomState(0)
+        small = sp.random(100, 100, density=0.01, random_state=rng)
+        self.assertEqual('dense', tf_utils.select_support_backend(small))
+        self.assertEqual('sparse', tf_utils.select_support_backend(small, backend='sparse'))
+        large_sparse = sp.random(2000, 2000, density=0.001, random_state=rng)
+        self.assertEqual('sparse', tf_utils.select_support_backend(large_sparse))
+        large_dense = sp.random(2000, 2000, density=0.1, random_state=rng)
+        self.assertEqual('dense', tf_utils.select_support_backend(large_dense))
+        self.assertEqual('sparse', tf_utils.select_support_backend(large_dense, max_dense_nodes=1000))
+        self.assertIn(tf_utils.select_support_backend(small, backend='benchmark'), ['dense', 'sparse'])
+        with self.assertRaises(ValueError):
+            tf_utils.select_support_backend(small, backend='gpu')
+
+
+class BatchPrefetcherTest(unittest.TestCase):
+    def test_prefetch(self):
+        with tf.Graph().as_default():
+            prefetcher = tf_utils.BatchPrefetcher(shapes=[(2,), (1,)], capacity=2)
+            x, y = prefetcher.dequeue()
+            batches = [(np.array([i, i + 1], dtype=np.float32), np.array([i], dtype=np.float32)) for i in range(5)]
+            results = []
+            with tf.Session() as sess:
+                for _ in range(2):
+                    prefetcher.start(sess, batches)
+                    while prefetcher.wait():
+                        results.append(sess.run([x, y]))
+            self.assertEqual(10, len(results))
+            for i, (x_, y_) in enumerate(results):
+                self.assertTrue(np.array_equal(batches[i % 5][0], x_))
+                self.assertTrue(np.array_equal(batches[i % 5][1], y_))
+
+    def test_prefetch_variable_batch_size(self):
+        with tf.Graph().as_default():
+            prefetcher = tf_utils.BatchPrefetcher(shapes=[(None, 2), (None,)], capacity=2)
+            x, _ = prefetcher.dequeue()
+            batches = [(np.ones((batch_size, 2), dtype=np.float32), np.ones(batch_size, dtype=np.float32))
+                       for batch_size in [3, 1, 2]]
+            with tf.Session() as sess:
+                prefetcher.start(sess, batches)
+                results = []
+                while prefetcher.wait():
+                    results.append(sess.run(x))
+            self.assertListEqual([(3, 2), (1, 2), (2, 2)], [result.shape for result in results])
+
+    def test_repeat_steps(self):
+        with tf.Graph().as_default():
+            prefetcher = tf_utils.BatchPrefetcher(shapes=[(2,), (1,)], capacity=2)
+            total = tf.get_variable('total', shape=(), initializer=tf.zeros_initializer(), use_resource=True)
+            num_steps = tf.placeholder(tf.int32, shape=())
+
+            def step_fn():
+                x, _ = prefetcher.dequeue()
+                # The value before the update, i.e., the sum of the previous batches.
+                value = total.read_value()
+                with tf.control_dependencies([value]):
+                    update_op = total.assign_add(tf.reduce_sum(x))
+                return update_op, [value, tf.reduce_sum(x)]
+
+            prefix_sum, batch_sum = tf_utils.repeat_steps(num_steps, step_fn, num_outputs=2)
+            batches = [(np.array([i, i], dtype=np.float32), np.array([i], dtype=np.float32)) for i in range(1, 6)]
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                prefetcher.start(sess, batches)
+                results = [sess.run([prefix_sum, batch_sum], feed_dict={num_steps: n}) for n in [3, 2]]
+                prefetcher.join()
+                self.assertEqual(30., sess.run(total))
+        # Batch sums 2, 4, 6 then 8, 10.
+        self.assertListEqual([[0. + 2. + 6., 12.], [12. + 20., 18.]], [list(result) for result in results])
+
+    def test_join_error(self):
+        with tf.Graph().as_default():
+            prefetcher = tf_utils.BatchPrefetcher(shapes=[(2,), (1,)], capacity=2)
+            x, _ = prefetcher.dequeue()
+            batches = [(np.ones(2, dtype=np.float32), np.ones(1, dtype=np.float32)),
+                       (np.ones(3, dtype=np.float32), np.ones(1, dtype=np.float32))]
+            with tf.Session() as sess:
+                prefetcher.start(sess, batches)
+                sess.run(x)
+                # The second batch can not be enqueued, which closes the queue instead of blocking the dequeue.
+                with self.assertRaises(tf.errors.OutOfRangeError):
+                    sess.run(x)
+                with self.assertRaises(ValueError):
+                    prefetcher.join()
+
+    def test_stop(self):
+        with tf.Graph().as_default():
+            prefetcher = tf_utils.BatchPrefetcher(shapes=[(1,)], capacity=2)
+            x, = prefetcher.dequeue()
+            with tf.Session() as sess:
+                prefetcher.start(sess, [(np.array([i], dtype=np.float32),) for i in range(10)])
+                self.assertTrue(prefetcher.wait())
+                self.assertEqual(0, sess.run(x)[0])
+                # The thread is blocked on the full queue.
+                with self.assertRaises(RuntimeError):
+                    prefetcher.start(sess, [])
+                prefetcher.stop(sess)
+                # The next epoch does not see the batches left from the previous one.
+                prefetcher.start(sess, [(np.array([i], dtype=np.float32),) for i in range(10, 12)])
+                self.assertTrue(prefetcher.wait())
+                self.assertEqual(10, sess.run(x)[0])
+                self.assertTrue(prefetcher.wait())
+                self.assertEqual(11, sess.run(x)[0])
+                self.assertFalse(prefetcher.wait())
+                prefetcher.stop(sess)
+
+
+class WhileLoopRNNDecoderTest(unittest.TestCase):
+    def test_while_loop_rnn_decoder(self):
+        timesteps, batch_size, input_size = 4, 3, 2
+        decoder_inputs = np.random.rand(timesteps, batch_size, input_size).astype(np.float32)
+        with tf.Graph().as_default():
+            cell = tf.contrib.rnn.BasicRNNCell(input_size)
+            initial_state = tf.constant(np.random.rand(batch_size, input_size).astype(np.float32))
+
+            def loop_function(prev, i):
+                return prev * tf.cast(i, tf.float32)
+
+            with tf.variable_scope('decoder'):
+                static_outputs, static_state = tf.contrib.legacy_seq2seq.rnn_decoder(
+                    tf.unstack(decoder_inputs), initial_state, cell, loop_function=loop_function)
+            with tf.variable_scope('decoder', reuse=True):
+                outputs, state = tf_utils.while_loop_rnn_decoder(tf.constant(decoder_inputs), initial_state, cell,
+                                                                 loop_function=loop_function)
+                teacher_outputs, _ = tf_utils.while_loop_rnn_decoder(tf.constant(decoder_inputs), initial_state, cell,
+                                                                     num_steps=2)
+            with tf.variable_scope('decoder', reuse=True):
+                static_teacher_outputs, _ = tf.contrib.legacy_seq2seq.rnn_decoder(tf.unstack(decoder_inputs)[:2],
+                                                                                  initial_state, cell)
+            # The decoders share the variables.
+            self.assertEqual(2, len(tf.trainable_variables()))
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                results = sess.run([tf.stack(static_outputs), static_state, outputs, state,
+                                    tf.stack(static_teacher_outputs), teacher_outputs])
+        self.assertTupleEqual((timesteps, batch_size, input_size), results[2].shape)
+        self.assertTrue(np.allclose(results[0], results[2], atol=1e-6))
+        self.assertTrue(np.allclose(results[1], results[3], atol=1e-6))
+        self.assertTrue(np.allclose(results[4], results[5], atol=1e-6))
+
+
+class VariableValuesTest(unittest.TestCase):
+    def test_get_load_variable_values(self):
+        with tf.Graph().as_default():
+            with tf.variable_scope('model'):
+                weights = tf.get_variable('weights', initializer=np.arange(6, dtype=np.float32).reshape((2, 3)))
+                step = tf.get_variable('step', initializer=np.int64(3), trainable=False)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                values = tf_utils.get_variable_values(sess)
+                self.assertListEqual(['model/step', 'model/weights'], sorted(values.keys()))
+                sess.run([weights.assign(tf.zeros_like(weights)), step.assign(0)])
+                tf_utils.load_variable_values(sess, values)
+                self.assertTrue(np.array_equal(np.arange(6).reshape((2, 3)), sess.run(weights)))
+                self.assertEqual(3, sess.run(step))
+                with self.assertRaises(ValueError):
+                    tf_utils.load_variable_values(sess, {'model/weights': values['model/weights']})
+
 
 if __name__ == '__main__':
     unittest.main()
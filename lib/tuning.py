@@ -0,0 +1,151 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import traceback
+
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class AsyncSuccessiveHalving(object):
+    """
+    Asynchronous successive halving (ASHA) early stopping of hyperparameter search trials, lower metrics are better.
+    The rungs are at min_epochs * reduction_factor ** k epochs. A trial reaching a rung continues only if its best
+    metric so far is among the best 1 / reduction_factor of the metrics recorded at that rung, i.e., trials never wait
+    for each other, and the first trials at a rung are compared with those which have reached it so far.
+    """
+
+    def __init__(self, min_epochs=1, reduction_factor=3):
+        """
+        :param min_epochs: number of epochs of the first rung, i.e., every trial trains at least min_epochs.
+        :param reduction_factor: about 1 / reduction_factor of the trials continue at each rung.
+        """
+        if min_epochs < 1 or reduction_factor < 2:
+            raise ValueError('Invalid min_epochs %d or reduction_factor %d.' % (min_epochs, reduction_factor))
+        self._min_epochs = min_epochs
+        self._reduction_factor = reduction_factor
+        # Metrics recorded at each rung by number of epochs.
+        self._rungs = {}
+        # Best metric of each trial so far.
+        self._best = {}
+        # Number of epochs at which each stopped trial was stopped.
+        self._stopped = {}
+
+    def _is_rung(self, epochs):
+        rung = self._min_epochs
+        while rung < epochs:
+            rung *= self._reduction_factor
+        return rung == epochs
+
+    def report(self, trial_id, epochs, metric):
+        """
+        Records the metric of a trial after an epoch.
+        :param trial_id:
+        :param epochs: number of epochs the trial has trained.
+        :param metric: e.g., validation MAE.
+        :return: whether to stop the trial.
+        """
+        best = min(self._best.get(trial_id, np.inf), metric)
+        self._best[trial_id] = best
+        if not np.isfinite(metric):
+            # E.g., diverged.
+            self._stopped[trial_id] = epochs
+            return True
+        if not self._is_rung(epochs):
+            return False
+        recorded = self._rungs.setdefault(epochs, [])
+        recorded.append(best)
+        cutoff = np.percentile(recorded, 100. / self._reduction_factor)
+        if best > cutoff:
+            self._stopped[trial_id] = epochs
+            return True
+        return False
+
+    @property
+    def rungs(self):
+        """
+        dict from number of epochs to the metrics recorded at the rung.
+        """
+        return self._rungs
+
+    @property
+    def stopped(self):
+        """
+        dict from trial id to the number of epochs at which the trial was stopped.
+        """
+        return self._stopped
+
+
+def _run_trial(run_trial, trial_id, config, messages, replies):
+    def report(epochs, metric):
+        messages.put(('report', trial_id, (epochs, float(metric))))
+        return replies.get()
+
+    try:
+        result = run_trial(trial_id, config, report)
+    except BaseException:
+        messages.put(('error', trial_id, traceback.format_exc()))
+        return
+    messages.put(('done', trial_id, result))
+
+
+def run_trials(configs, run_trial, scheduler, num_workers=1, poll_interval=1.):
+    """
+    Runs the trials of a hyperparameter search in forked processes, at most num_workers at a time, e.g., each with
+    its own tensorflow graph and session. The processes share the memory of the calling process copy-on-write, e.g.,
+    the loaded data, which must not have started tensorflow sessions.
+    run_trial(trial_id, config, report) is called in the process of each trial, and calls report(epochs, metric)
+    after every epoch, which returns whether the scheduler in the calling process stops the trial.
+    :param configs: list of the configurations of the trials, whose ids are their indices.
+    :param run_trial: returns the result of the trial, which must be picklable.
+    :param scheduler: e.g., AsyncSuccessiveHalving.
+    :param num_workers: maximum number of concurrent trials.
+    :param poll_interval: seconds between checks for trial processes which died without a result.
+    :return: list of dicts with trial_id, config, result, and error, i.e., the traceback of failed trials or None.
+    """
+    context = multiprocessing.get_context('fork')
+    messages = context.Queue()
+    pending = list(enumerate(configs))
+    # Process and reply queue of each running trial.
+    running = {}
+    trials = [{'trial_id': trial_id, 'config': config, 'result': None, 'error': None}
+              for trial_id, config in pending]
+    try:
+        while pending or running:
+            while pending and len(running) < num_workers:
+                trial_id, config = pending.pop(0)
+                replies = context.Queue()
+                process = context.Process(target=_run_trial, args=(run_trial, trial_id, config, messages, replies),
+                                          name='trial_%d' % trial_id)
+                process.start()
+                running[trial_id] = (process, replies)
+            try:
+                kind, trial_id, value = messages.get(timeout=poll_interval)
+            except queue.Empty:
+                for trial_id, (process, _) in list(running.items()):
+                    # Finished processes have sent their result before exiting.
+                    if not process.is_alive() and process.exitcode != 0:
+                        trials[trial_id]['error'] = 'Trial %d failed with exit code %d.' % (trial_id,
+                                                                                           process.exitcode)
+                        del running[trial_id]
+                continue
+            if kind == 'report':
+                epochs, metric = value
+                running[trial_id][1].put(scheduler.report(trial_id, epochs, metric))
+                continue
+            if kind == 'done':
+                trials[trial_id]['result'] = value
+            else:
+                trials[trial_id]['error'] = value
+            running.pop(trial_id)[0].join()
+    finally:
+        for process, _ in running.values():
+            process.terminate()
+            process.join()
+    return trials
@@ -0,0 +1,67 @@
+import os
+import unittest
+
+from lib import tuning
+from lib.tuning import AsyncSuccessiveHalving
+
+
+def _run_trial(trial_id, config, report):
+    # The metric of a trial decreases by its rate every epoch.
+    metric = 10.
+    for epochs in range(1, config['epochs'] + 1):
+        if config.get('fail'):
+            raise ValueError('Trial failed.')
+        if config.get('crash'):
+            os._exit(1)
+        metric -= config['rate']
+        if report(epochs, metric):
+            return epochs, metric
+    return config['epochs'], metric
+
+
+class AsyncSuccessiveHalvingTest(unittest.TestCase):
+    def test_report(self):
+        scheduler = AsyncSuccessiveHalving(min_epochs=1, reduction_factor=2)
+        # The first trial at a rung continues.
+        self.assertFalse(scheduler.report(0, 1, 5.))
+        self.assertTrue(scheduler.report(1, 1, 6.))
+        self.assertFalse(scheduler.report(2, 1, 4.))
+        self.assertFalse(scheduler.report(0, 2, 3.))
+        # Epoch 3 is not a rung.
+        self.assertFalse(scheduler.report(0, 3, 9.))
+        # The best metric of the trial so far, 3, is compared at the rung.
+        self.assertFalse(scheduler.report(0, 4, 9.))
+        self.assertTrue(scheduler.report(2, 2, float('nan')))
+        self.assertDictEqual({1: [5., 6., 4.], 2: [3.], 4: [3.]}, scheduler.rungs)
+        self.assertDictEqual({1: 1, 2: 2}, scheduler.stopped)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            AsyncSuccessiveHalving(reduction_factor=1)
+
+
+class RunTrialsTest(unittest.TestCase):
+    def test_run_trials(self):
+        rates = [1., .5, 2., .25, 1.5]
+        configs = [{'epochs': 9, 'rate': rate} for rate in rates]
+        scheduler = AsyncSuccessiveHalving(min_epochs=1, reduction_factor=3)
+        trials = tuning.run_trials(configs, _run_trial, scheduler, num_workers=1)
+        self.assertListEqual(list(range(len(rates))), [trial['trial_id'] for trial in trials])
+        self.assertTrue(all(trial['error'] is None for trial in trials))
+        # Trials run one after the other, i.e., each is compared with all the previous ones.
+        self.assertListEqual([(9, 1.), (1, 9.5), (9, -8.), (1, 9.75), (3, 5.5)],
+                             [trial['result'] for trial in trials])
+        self.assertDictEqual({1: 1, 3: 1, 4: 3}, scheduler.stopped)
+
+    def test_parallel(self):
+        configs = [{'epochs': 3, 'rate': 1.}, {'epochs': 3, 'rate': 1., 'fail': True},
+                   {'epochs': 3, 'rate': 1., 'crash': True}, {'epochs': 3, 'rate': 1.}]
+        trials = tuning.run_trials(configs, _run_trial, AsyncSuccessiveHalving(), num_workers=3, poll_interval=.1)
+        self.assertEqual((3, 7.), trials[0]['result'])
+        self.assertIn('Trial failed.', trials[1]['error'])
+        self.assertIn('exit code 1', trials[2]['error'])
+        self.assertEqual((3, 7.), trials[3]['result'])
+
+
+if __name__ == '__main__':
+    unittest.main()
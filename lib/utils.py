@@ -1,22 +1,37 @@
+import copy
 import datetime
 import numpy as np
 import pandas as pd
 
+from numpy.lib.stride_tricks import as_strided
+
 
 class StandardScaler:
     """
     Standard the input
     """
 
-    def __init__(self, mean, std):
+    def __init__(self, mean, std, dtype=None):
+        """
+        :param mean:
+        :param std:
+        :param dtype: if specified, the results are cast to dtype, e.g., np.float32, otherwise numpy type promotion
+        applies, which may turn float32 data into float64.
+        """
         self.mean = mean
         self.std = std
+        self.dtype = dtype
 
     def transform(self, data):
-        return (data - self.mean) / self.std
+        return self._cast((data - self.mean) / self.std)
 
     def inverse_transform(self, data):
-        return (data * self.std) + self.mean
+        return self._cast((data * self.std) + self.mean)
+
+    def _cast(self, data):
+        if self.dtype is None:
+            return data
+        return data.astype(self.dtype)
 
 
 def get_rush_hours_bool_index(df, hours=((7, 10), (17, 20)), weekdays=(0, 5)):
@@ -35,6 +50,32 @@ def get_rush_hours_bool_index(df, hours=((7, 10), (17, 20)), weekdays=(0, 5)):
     return weekday_predate & hour_predate
 
 
+def fit_standard_scaler(chunks, dtype=None):
+    """
+    Fits a StandardScaler over all the values in one pass, i.e., using the parallel version of Welford's algorithm to
+    combine the statistics of each chunk, so the data never needs to be in memory at the same time.
+    :param chunks: iterable of DataFrames or arrays.
+    :param dtype: dtype of the transformed data, see StandardScaler. The statistics are always accumulated in float64.
+    :return: StandardScaler
+    """
+    count, mean, m2 = 0, 0., 0.
+    for chunk in chunks:
+        values = np.asarray(chunk, dtype=np.float64)
+        n = values.size
+        if n == 0:
+            continue
+        chunk_mean = values.mean()
+        chunk_m2 = np.square(values - chunk_mean).sum()
+        delta = chunk_mean - mean
+        total = count + n
+        mean += delta * n / total
+        m2 += chunk_m2 + delta ** 2 * count * n / total
+        count = total
+    if count == 0:
+        raise ValueError('Cannot fit the scaler on empty data.')
+    return StandardScaler(mean=mean, std=np.sqrt(m2 / count), dtype=dtype)
+
+
 def generate_io_data(data, seq_len, horizon=1, scaler=None):
     """
     Generates input, output data which are
@@ -112,7 +153,7 @@ def generate_io_data_with_time(df, batch_size, seq_len, horizon, output_type='po
 
 
 def generate_graph_seq2seq_io_data_with_time(df, batch_size, seq_len, horizon, num_nodes, scaler=None,
-                                             add_time_in_day=True, add_day_in_week=False):
+                                             add_time_in_day=True, add_day_in_week=False, copy=True, dtype=None):
     """
 
     :param df: 
@@ -121,44 +162,320 @@ def generate_graph_seq2seq_io_data_with_time(df, batch_size, seq_len, horizon, n
     :param horizon: 
     :param scaler: 
     :param add_day_in_week:
+    :param copy: if False, returns read-only strided views over a single (batch_size, batch_len, num_nodes, input_dim)
+    array instead of materializing every window, i.e., memory grows with the data size instead of data size * window.
+    :param dtype: dtype of the node features, see generate_graph_features_with_time.
     :return: 
     x, y, both are 5-D tensors with size (epoch_size, batch_size, seq_len, num_sensors, input_dim).
     Adjacent batches are continuous sequence, i.e., x[i, j, :, :] is before x[i+1, j, :, :]
     """
+    num_samples, _ = df.shape
+    batch_len = num_samples // batch_size
+    data = generate_graph_features_with_time(df, num_nodes=num_nodes, scaler=scaler, add_time_in_day=add_time_in_day,
+                                             add_day_in_week=add_day_in_week, dtype=dtype)
+    data = data[:batch_size * batch_len, :, :].reshape((batch_size, batch_len, num_nodes, -1))
+    x, y = generate_seq2seq_windows(data, seq_len=seq_len, horizon=horizon)
+    if copy:
+        x, y = np.array(x), np.array(y)
+    return x, y
+
+
+def generate_time_features(index, add_time_in_day=True, add_day_in_week=False, dtype=np.float32):
+    """
+    Generates the time features once per timestep, instead of once per node.
+    :param index: pandas.DatetimeIndex
+    :param add_time_in_day:
+    :param add_day_in_week:
+    :param dtype:
+    :return: 2-D tensor with size (num_samples, num_time_features), whose columns are the time in day, i.e., fraction of
+    the day, and the day in week as integer index, e.g., 0 for Monday.
+    """
+    features = []
+    if add_time_in_day:
+        features.append((index.values - index.values.astype('datetime64[D]')) / np.timedelta64(1, 'D'))
+    if add_day_in_week:
+        features.append(np.asarray(index.dayofweek))
+    return np.stack(features, axis=-1).astype(dtype) if features else np.zeros((len(index), 0), dtype)
+
+
+def generate_graph_features_with_time(df, num_nodes, scaler=None, add_time_in_day=True, add_day_in_week=False,
+                                      compact_time_features=False, dtype=None):
+    """
+    Converts the readings to node features, optionally with time in day and day in week.
+    :param df:
+    :param num_nodes:
+    :param scaler:
+    :param add_time_in_day:
+    :param add_day_in_week:
+    :param compact_time_features: if True, the time features are not copied to every node, but returned separately,
+    see generate_time_features.
+    :param dtype: dtype of the features, e.g., np.float32, None for float64 time features and unchanged readings.
+    :return: 3-D tensor with size (num_samples, num_nodes, input_dim), and the time features with size
+    (num_samples, num_time_features) if compact_time_features.
+    """
     if scaler:
         df = scaler.transform(df)
     num_samples, _ = df.shape
-    data = df.values
-    batch_len = num_samples // batch_size
-    data = np.expand_dims(data, axis=-1)
+    data = np.expand_dims(df.values, axis=-1)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    if compact_time_features:
+        return data, generate_time_features(df.index, add_time_in_day=add_time_in_day,
+                                            add_day_in_week=add_day_in_week, dtype=dtype or np.float32)
+    time_dtype = dtype or np.float64
     data_list = [data]
     if add_time_in_day:
         time_ind = (df.index.values - df.index.values.astype('datetime64[D]')) / np.timedelta64(1, 'D')
-        time_in_day = np.tile(time_ind, [1, num_nodes, 1]).transpose((2, 1, 0))
+        time_in_day = np.tile(time_ind.astype(time_dtype), [1, num_nodes, 1]).transpose((2, 1, 0))
         data_list.append(time_in_day)
     if add_day_in_week:
-        day_in_week = np.zeros(shape=(num_samples, num_nodes, 7))
+        day_in_week = np.zeros(shape=(num_samples, num_nodes, 7), dtype=time_dtype)
         day_in_week[np.arange(num_samples), :, df.index.dayofweek] = 1
         data_list.append(day_in_week)
+    return np.concatenate(data_list, axis=-1)
 
-    data = np.concatenate(data_list, axis=-1)
-    data = data[:batch_size * batch_len, :, :].reshape((batch_size, batch_len, num_nodes, -1))
-    epoch_size = batch_len - seq_len - horizon + 1
-    x, y = [], []
-    for i in range(epoch_size):
-        x_i = data[:, i: i + seq_len, ...]
-        y_i = data[:, i + seq_len: i + seq_len + horizon, :, :]
-        x.append(x_i)
-        y.append(y_i)
-    x = np.stack(x, axis=0)
-    y = np.stack(y, axis=0)
+
+def generate_graph_features_from_chunks(chunks, num_samples, num_nodes, scaler=None, add_time_in_day=True,
+                                        add_day_in_week=False, filename=None, compact_time_features=False,
+                                        dtype=None):
+    """
+    Same as generate_graph_features_with_time, but consumes the DataFrame chunk by chunk, e.g., from
+    lib.hdf_utils.HDFChunkReader, so that only one chunk and the resulting node features are in memory.
+
+    :param chunks: iterable of DataFrames, which are consecutive in time.
+    :param num_samples: number of rows to read from the chunks.
+    :param filename: if specified, the node features are written to a memory-mapped .npy file instead of memory,
+    which allows datasets that are larger than the RAM.
+    :param dtype: dtype of the node features, default: float64.
+    :return: 3-D tensor with size (num_samples, num_nodes, input_dim), and the time features with size
+    (num_samples, num_time_features) if compact_time_features.
+    """
+    if compact_time_features:
+        input_dim = 1
+        time_data = np.empty((num_samples, int(add_time_in_day) + int(add_day_in_week)), dtype=dtype or np.float32)
+    else:
+        input_dim = 1 + int(add_time_in_day) + 7 * int(add_day_in_week)
+        time_data = None
+    shape = (num_samples, num_nodes, input_dim)
+    if filename is not None:
+        data = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype or np.float64, shape=shape)
+    else:
+        data = np.empty(shape, dtype=dtype or np.float64)
+    offset = 0
+    for chunk in chunks:
+        if offset >= num_samples:
+            break
+        features = generate_graph_features_with_time(chunk, num_nodes=num_nodes, scaler=scaler,
+                                                     add_time_in_day=add_time_in_day,
+                                                     add_day_in_week=add_day_in_week,
+                                                     compact_time_features=compact_time_features, dtype=dtype)
+        if compact_time_features:
+            features, time_features = features
+            time_features = time_features[:num_samples - offset]
+            time_data[offset: offset + time_features.shape[0]] = time_features
+        features = features[:num_samples - offset]
+        data[offset: offset + features.shape[0]] = features
+        offset += features.shape[0]
+    if offset < num_samples:
+        raise ValueError('Expect %d samples, but only %d are read.' % (num_samples, offset))
+    if compact_time_features:
+        return data, time_data
+    return data
+
+
+def generate_graph_seq2seq_io_data_from_chunks(chunks, num_samples, batch_size, seq_len, horizon, num_nodes,
+                                               scaler=None, add_time_in_day=True, add_day_in_week=False,
+                                               filename=None, dtype=None):
+    """
+    Same as generate_graph_seq2seq_io_data_with_time(..., copy=False), but consumes the DataFrame chunk by chunk.
+    See generate_graph_features_from_chunks.
+    :return:
+    x, y, read-only views with size (epoch_size, batch_size, seq_len/horizon, num_sensors, input_dim).
+    """
+    batch_len = num_samples // batch_size
+    data = generate_graph_features_from_chunks(chunks, num_samples=batch_size * batch_len, num_nodes=num_nodes,
+                                               scaler=scaler, add_time_in_day=add_time_in_day,
+                                               add_day_in_week=add_day_in_week, filename=filename, dtype=dtype)
+    data = data.reshape((batch_size, batch_len) + data.shape[1:])
+    return generate_seq2seq_windows(data, seq_len=seq_len, horizon=horizon)
+
+
+def generate_seq2seq_windows(data, seq_len, horizon):
+    """
+    Generates sliding windows over continuous sequences as read-only strided views, i.e., without copying data.
+
+    :param data: tensor with size (batch_size, batch_len, ...), data[j, :] is a continuous sequence.
+    :param seq_len:
+    :param horizon:
+    :return:
+    x: (epoch_size, batch_size, seq_len, ...), x[i, j] = data[j, i: i + seq_len]
+    y: (epoch_size, batch_size, horizon, ...), y[i, j] = data[j, i + seq_len: i + seq_len + horizon]
+    """
+    batch_size, batch_len = data.shape[:2]
+    epoch_size = max(batch_len - seq_len - horizon + 1, 0)
+    # Moving one step along the epoch axis is the same as moving one step in time.
+    strides = (data.strides[1],) + data.strides
+    x = as_strided(data, shape=(epoch_size, batch_size, seq_len) + data.shape[2:], strides=strides,
+                   writeable=False)
+    y = as_strided(data[:, seq_len:, ...], shape=(epoch_size, batch_size, horizon) + data.shape[2:],
+                   strides=strides, writeable=False)
     return x, y
 
 
+def rebatch_windows(windows, batch_size):
+    """
+    Regroups windows from generate_seq2seq_windows into batches of batch_size windows, e.g., to evaluate windows of a
+    single continuous sequence in large batches.
+
+    :param windows: (epoch_size, num_sequences, ...)
+    :param batch_size:
+    :return: list of arrays with size (batch_size, ...), except for the last one, which may be smaller. Windows are
+    ordered by sequence and then by start index, and are views of windows if num_sequences is 1.
+    """
+    windows = np.swapaxes(windows, 0, 1)
+    windows = windows.reshape((-1,) + windows.shape[2:])
+    return [windows[i: i + batch_size] for i in range(0, windows.shape[0], batch_size)]
+
+
+class WindowSampler(object):
+    """
+    Samples seq2seq windows at arbitrary start indices of a continuous series, and gathers each batch on the fly with
+    vectorized fancy indexing, i.e., changing batch_size only changes how many start indices are drawn per batch.
+    Iterating over the sampler yields (x, y) batches for one epoch, which only contains full batches.
+    A shard of the sampler only gathers its own batches, see shard.
+    """
+
+    def __init__(self, data, batch_size, seq_len, horizon, shuffle=True, seed=None, time_data=None):
+        """
+        :param data: continuous series with size (num_samples, ...), e.g., from generate_graph_features_with_time.
+        :param batch_size:
+        :param seq_len:
+        :param horizon:
+        :param shuffle: whether to shuffle the windows in every epoch.
+        :param seed:
+        :param time_data: optional time features with size (num_samples, num_time_features), in which case each batch
+        also contains the time features of the whole window, i.e., (batch_size, seq_len + horizon, num_time_features).
+        """
+        self._data = data
+        self._time_data = time_data
+        self._batch_size = batch_size
+        self._seq_len = seq_len
+        self._horizon = horizon
+        self._shuffle = shuffle
+        self._rng = np.random.RandomState(seed)
+        self._num_windows = max(data.shape[0] - seq_len - horizon + 1, 0)
+        self._rank = 0
+        self._num_shards = 1
+
+    def __len__(self):
+        return self._num_windows // self._batch_size // self._num_shards
+
+    def __iter__(self):
+        starts = np.arange(self._num_windows)
+        if self._shuffle:
+            self._rng.shuffle(starts)
+        # Start indices of the batches of all the shards, of which this shard takes every num_shards-th.
+        num_batches = len(self) * self._num_shards
+        starts = starts[:num_batches * self._batch_size].reshape((num_batches, self._batch_size))
+        offsets = np.arange(self._seq_len + self._horizon)
+        for batch_starts in starts[self._rank::self._num_shards]:
+            # (batch_size, seq_len + horizon, ...)
+            inds = batch_starts[:, np.newaxis] + offsets
+            windows = self._data[inds]
+            if self._time_data is not None:
+                yield windows[:, :self._seq_len, ...], windows[:, self._seq_len:, ...], self._time_data[inds]
+            else:
+                yield windows[:, :self._seq_len, ...], windows[:, self._seq_len:, ...]
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    def shard(self, rank, num_shards):
+        """
+        Returns the same batches as ShardedBatches(self, rank, num_shards), but shards the start indices before
+        gathering, i.e., each data-parallel worker only gathers its own batches.
+        :param rank:
+        :param num_shards:
+        :return: WindowSampler
+        """
+        if self._num_shards != 1:
+            raise ValueError('The sampler is already a shard.')
+        # Shares the random state, i.e., sharding the copies of the sampler of the workers every epoch shuffles them
+        # the same way, and differently in every epoch.
+        sampler = copy.copy(self)
+        sampler._rank = rank
+        sampler._num_shards = num_shards
+        return sampler
+
+
+class ShardedBatches(object):
+    """
+    Every num_shards-th batch of an epoch starting from the rank-th, i.e., the shards of data-parallel workers which
+    iterate over the same batches in the same order, e.g., copies of a WindowSampler with the same seed, are disjoint.
+    All the shards have the same number of batches, the remaining batches are dropped.
+    """
+
+    def __init__(self, batches, rank, num_shards):
+        """
+        :param batches: iterable of batches with a length, e.g., a list of (x, y) tuples, see also WindowSampler.shard.
+        :param rank:
+        :param num_shards:
+        """
+        self._batches = batches
+        self._rank = rank
+        self._num_shards = num_shards
+
+    def __len__(self):
+        return len(self._batches) // self._num_shards
+
+    def __iter__(self):
+        num_batches = len(self) * self._num_shards
+        for i, batch in enumerate(self._batches):
+            if i >= num_batches:
+                break
+            if i % self._num_shards == self._rank:
+                yield batch
+
+
 def round_down(num, divisor):
     return num - (num % divisor)
 
 
+def calculate_seasonal_trend(data, period, n_train, null_val=0.):
+    """
+    Calculates the average of each phase of the period over the first n_train samples, ignoring null values.
+    All the phases are computed at once by reshaping the samples to (n_cycle, period, n_sensor) and reducing over the
+    cycles.
+
+    :param data: 2-D array with size (n_sample, n_sensor).
+    :param period:
+    :param n_train: only the first n_train samples are used to calculate the average.
+    :param null_val: indicator of missing values, which are excluded as well as nan.
+    :return: (period, n_sensor), nan for phases without valid samples.
+    """
+    n_sensor = data.shape[1]
+    sums = np.zeros((period, n_sensor), dtype=np.float64)
+    counts = np.zeros((period, n_sensor), dtype=np.int64)
+
+    def accumulate(values, n_phase):
+        mask = ~np.isnan(values)
+        if not np.isnan(null_val):
+            mask &= values != null_val
+        sums[:n_phase] += np.where(mask, values, 0.).sum(axis=0)
+        counts[:n_phase] += mask.sum(axis=0)
+
+    n_cycle = n_train // period
+    if n_cycle > 0:
+        accumulate(data[:n_cycle * period].reshape((n_cycle, period, n_sensor)), period)
+    n_rest = n_train - n_cycle * period
+    if n_rest > 0:
+        accumulate(data[n_cycle * period: n_train][np.newaxis, ...], n_rest)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        seasonal_trend = sums / counts
+    return seasonal_trend.astype(np.float32)
+
+
 def separate_seasonal_trend_and_residual(df, period, test_ratio=0.2, null_val=0., epsilon=1e-4):
     """
 
@@ -172,20 +489,17 @@ def separate_seasonal_trend_and_residual(df, period, test_ratio=0.2, null_val=0.
     n_sample, n_sensor = df.shape
     n_test = int(round(n_sample * test_ratio))
     n_train = n_sample - n_test
-    seasonal_trend = np.zeros((period, n_sensor), dtype=np.float32)
-    for i in range(period):
-        inds = [j for j in range(i % period, n_train, period)]
-        historical = df.iloc[inds, :]
-        seasonal_trend[i, :] = historical[historical != null_val].mean()
+    values = df.values
+    seasonal_trend = calculate_seasonal_trend(values, period=period, n_train=n_train, null_val=null_val)
     n_repeat = (n_sample + period - 1) // period
     data = np.tile(seasonal_trend, [n_repeat, 1])[:n_sample, :]
     seasonal_df = pd.DataFrame(data, index=df.index, columns=df.columns)
-    # Records where null value is happening.
 
-    missing_ind = df == null_val
-    residual_df = df - seasonal_df
-    residual_df[residual_df == null_val] += epsilon
-    residual_df[missing_ind] = null_val
+    residual = values - data
+    residual[residual == null_val] += epsilon
+    # Records where null value is happening.
+    residual[values == null_val] = null_val
+    residual_df = pd.DataFrame(residual, index=df.index, columns=df.columns)
     return seasonal_df, residual_df
 
 
@@ -212,6 +526,16 @@ def train_test_split(x, y, test_ratio=0.2, random=False, granularity=1):
     return (x_train, y_train), (x_test, y_test)
 
 
+def train_val_test_split_ranges(n_sample, val_ratio=0.1, test_ratio=0.2):
+    """
+    Same split as train_val_test_split_df, but returns the row ranges, i.e., [(start, stop)] * 3.
+    """
+    n_val = int(round(n_sample * val_ratio))
+    n_test = int(round(n_sample * test_ratio))
+    n_train = n_sample - n_val - n_test
+    return (0, n_train), (n_train, n_train + n_val), (n_sample - n_test, n_sample)
+
+
 def train_val_test_split_df(df, val_ratio=0.1, test_ratio=0.2):
     n_sample, _ = df.shape
     n_val = int(round(n_sample * val_ratio))
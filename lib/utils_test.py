@@ -23,6 +23,18 @@ class MyTestCase(unittest.TestCase):
         self.assertTrue(np.array_equal(df_trend.values, trends))
         self.assertTrue(np.array_equal(df_residual.values, residual))
 
+    def test_calculate_seasonal_trend(self):
+        data = np.random.randint(0, 4, size=(103, 5)).astype(np.float32)
+        data[3, 1] = np.nan
+        period, n_train = 7, 90
+        # Reference: per phase masked average.
+        expected = np.zeros((period, 5), dtype=np.float32)
+        for i in range(period):
+            historical = pd.DataFrame(data[i:n_train:period])
+            expected[i, :] = historical[historical != 0].mean()
+        seasonal_trend = utils.calculate_seasonal_trend(data, period=period, n_train=n_train, null_val=0)
+        self.assertTrue(np.allclose(expected, seasonal_trend, equal_nan=True))
+
     def test_get_rush_hours_bool_index(self):
         index = pd.date_range('2017-02-27', '2017-03-06', freq='1min')
         data = np.zeros((len(index), 3))
@@ -44,6 +56,145 @@ class IODataPreparationTest(unittest.TestCase):
         self.assertTupleEqual(xs.shape, (3, 2, 9))
         self.assertTupleEqual(ys.shape, (3, 2, 6))
 
+    def test_generate_graph_seq2seq_io_data_with_time_view(self):
+        data = np.arange(48, dtype=np.float32).reshape((16, 3))
+        df = pd.DataFrame(data, index=pd.date_range('2017-10-18', '2017-10-19 23:59', freq='3h'))
+        xs, ys = utils.generate_graph_seq2seq_io_data_with_time(df, batch_size=2, seq_len=3, horizon=2, num_nodes=3)
+        x_views, y_views = utils.generate_graph_seq2seq_io_data_with_time(df, batch_size=2, seq_len=3, horizon=2,
+                                                                          num_nodes=3, copy=False)
+        self.assertTupleEqual(xs.shape, (4, 2, 3, 3, 2))
+        self.assertTupleEqual(ys.shape, (4, 2, 2, 3, 2))
+        self.assertTrue(np.array_equal(xs, x_views))
+        self.assertTrue(np.array_equal(ys, y_views))
+        self.assertFalse(x_views.flags.writeable)
+        # x[i, j] = data[j * batch_len + i: j * batch_len + i + seq_len]
+        self.assertTrue(np.array_equal(x_views[1, 1, :, :, 0], data[9:12]))
+        self.assertTrue(np.array_equal(y_views[1, 1, :, :, 0], data[12:14]))
+
+    def test_rebatch_windows(self):
+        data = np.arange(48, dtype=np.float32).reshape((1, 16, 3))
+        xs, _ = utils.generate_seq2seq_windows(data, seq_len=3, horizon=2)
+        batches = utils.rebatch_windows(xs, batch_size=5)
+        self.assertListEqual([5, 5, 2], [batch.shape[0] for batch in batches])
+        self.assertTrue(np.array_equal(xs[:, 0], np.concatenate(batches)))
+        self.assertFalse(batches[0].flags.writeable)
+        # Windows of multiple sequences are ordered by sequence.
+        xs, _ = utils.generate_seq2seq_windows(data.reshape((2, 8, 3)), seq_len=3, horizon=2)
+        windows = np.concatenate(utils.rebatch_windows(xs, batch_size=4))
+        self.assertTrue(np.array_equal(np.concatenate([xs[:, 0], xs[:, 1]]), windows))
+
+    def test_generate_graph_seq2seq_io_data_from_chunks(self):
+        data = np.arange(48, dtype=np.float32).reshape((16, 3))
+        df = pd.DataFrame(data, index=pd.date_range('2017-10-18', '2017-10-19 23:59', freq='3h'))
+        scaler = StandardScaler(mean=10., std=2.)
+        xs, ys = utils.generate_graph_seq2seq_io_data_with_time(df, batch_size=2, seq_len=3, horizon=2, num_nodes=3,
+                                                                scaler=scaler)
+        chunks = [df.iloc[i: i + 5] for i in range(0, 16, 5)]
+        x_chunks, y_chunks = utils.generate_graph_seq2seq_io_data_from_chunks(chunks, num_samples=16, batch_size=2,
+                                                                              seq_len=3, horizon=2, num_nodes=3,
+                                                                              scaler=scaler)
+        self.assertTrue(np.array_equal(xs, x_chunks))
+        self.assertTrue(np.array_equal(ys, y_chunks))
+
+    def test_generate_graph_features_dtype(self):
+        data = np.arange(48, dtype=np.float64).reshape((16, 3))
+        df = pd.DataFrame(data, index=pd.date_range('2017-10-18', '2017-10-19 23:59', freq='3h'))
+        scaler = StandardScaler(mean=np.float64(10.), std=np.float64(2.), dtype=np.float32)
+        features = utils.generate_graph_features_with_time(df, num_nodes=3, scaler=scaler, add_day_in_week=True,
+                                                           dtype=np.float32)
+        self.assertEqual(np.float32, features.dtype)
+        expected = utils.generate_graph_features_with_time(df, num_nodes=3, scaler=scaler, add_day_in_week=True)
+        self.assertTrue(np.allclose(expected, features))
+        chunks = [df.iloc[i: i + 5] for i in range(0, 16, 5)]
+        features_chunks = utils.generate_graph_features_from_chunks(chunks, num_samples=16, num_nodes=3, scaler=scaler,
+                                                                    add_day_in_week=True, dtype=np.float32)
+        self.assertEqual(np.float32, features_chunks.dtype)
+        self.assertTrue(np.array_equal(features, features_chunks))
+
+    def test_generate_compact_time_features(self):
+        data = np.arange(48, dtype=np.float32).reshape((16, 3))
+        df = pd.DataFrame(data, index=pd.date_range('2017-10-18', '2017-10-19 23:59', freq='3h'))
+        tiled = utils.generate_graph_features_with_time(df, num_nodes=3, add_day_in_week=True)
+        features, time_features = utils.generate_graph_features_with_time(df, num_nodes=3, add_day_in_week=True,
+                                                                          compact_time_features=True)
+        self.assertTupleEqual((16, 3, 1), features.shape)
+        self.assertTupleEqual((16, 2), time_features.shape)
+        self.assertTrue(np.array_equal(tiled[..., :1], features))
+        # Expands the compact time features to every node.
+        self.assertTrue(np.allclose(tiled[..., 1], np.tile(time_features[:, 0:1], (1, 3))))
+        day_in_week = np.eye(7)[time_features[:, 1].astype(np.int64)]
+        self.assertTrue(np.array_equal(tiled[:, 0, 2:], day_in_week))
+        chunks = [df.iloc[i: i + 5] for i in range(0, 16, 5)]
+        features_chunks, time_chunks = utils.generate_graph_features_from_chunks(chunks, num_samples=16, num_nodes=3,
+                                                                                 add_day_in_week=True,
+                                                                                 compact_time_features=True)
+        self.assertTrue(np.array_equal(features, features_chunks))
+        self.assertTrue(np.array_equal(time_features, time_chunks))
+
+
+class WindowSamplerTest(unittest.TestCase):
+    def test_iterate(self):
+        data = np.arange(40, dtype=np.float32).reshape((20, 2, 1))
+        sampler = utils.WindowSampler(data, batch_size=4, seq_len=3, horizon=2, shuffle=True, seed=0)
+        # 16 windows, i.e., 4 full batches.
+        self.assertEqual(4, len(sampler))
+        starts = []
+        for x, y in sampler:
+            self.assertTupleEqual((4, 3, 2, 1), x.shape)
+            self.assertTupleEqual((4, 2, 2, 1), y.shape)
+            for x_i, y_i in zip(x, y):
+                start = int(x_i[0, 0, 0]) // 2
+                self.assertTrue(np.array_equal(data[start: start + 3], x_i))
+                self.assertTrue(np.array_equal(data[start + 3: start + 5], y_i))
+                starts.append(start)
+        self.assertListEqual(list(range(16)), sorted(starts))
+        self.assertNotEqual(list(range(16)), starts)
+
+    def test_iterate_with_time_data(self):
+        data = np.arange(40, dtype=np.float32).reshape((20, 2, 1))
+        time_data = np.arange(20, dtype=np.float32).reshape((20, 1))
+        sampler = utils.WindowSampler(data, batch_size=4, seq_len=3, horizon=2, seed=0, time_data=time_data)
+        for x, y, t in sampler:
+            self.assertTupleEqual((4, 5, 1), t.shape)
+            self.assertTrue(np.array_equal(x[:, 0, 0, 0] // 2, t[:, 0, 0]))
+
+    def test_batch_size(self):
+        data = np.zeros((20, 2, 1), dtype=np.float32)
+        sampler = utils.WindowSampler(data, batch_size=5, seq_len=3, horizon=2, shuffle=False)
+        self.assertEqual(3, len(sampler))
+        self.assertEqual(3, len(list(sampler)))
+
+
+class ShardedBatchesTest(unittest.TestCase):
+    def test_shards(self):
+        data = np.arange(44, dtype=np.float32).reshape((22, 2, 1))
+        # 18 windows, i.e., 9 batches, of which 8 are split into 4 shards.
+        shards = [utils.ShardedBatches(utils.WindowSampler(data, batch_size=2, seq_len=3, horizon=2, seed=0), rank, 4)
+                  for rank in range(4)]
+        starts = []
+        for shard in shards:
+            self.assertEqual(2, len(shard))
+            self.assertEqual(2, len(list(shard)))
+            starts.extend(int(x[0, 0, 0, 0]) // 2 for x, _ in shard)
+        self.assertEqual(8, len(set(starts)))
+
+    def test_window_sampler_shard(self):
+        data = np.arange(44, dtype=np.float32).reshape((22, 2, 1))
+        samplers = [utils.WindowSampler(data, batch_size=2, seq_len=3, horizon=2, seed=0) for _ in range(8)]
+        # Two epochs, whose shuffles differ.
+        for _ in range(2):
+            for rank in range(4):
+                expected = list(utils.ShardedBatches(samplers[rank], rank, 4))
+                shard = samplers[4 + rank].shard(rank, 4)
+                self.assertEqual(2, len(shard))
+                batches = list(shard)
+                self.assertEqual(len(expected), len(batches))
+                for (x_expected, y_expected), (x, y) in zip(expected, batches):
+                    self.assertTrue(np.array_equal(x_expected, x))
+                    self.assertTrue(np.array_equal(y_expected, y))
+        with self.assertRaises(ValueError):
+            samplers[0].shard(0, 4).shard(0, 2)
+
 
 class StandardScalerTest(unittest.TestCase):
     def test_transform(self):
@@ -92,6 +243,21 @@ class StandardScalerTest(unittest.TestCase):
         result = scaler.inverse_transform(data)
         self.assertTrue(np.array_equal(expected_result, result))
 
+    def test_transform_dtype(self):
+        data = np.array([[35., 0.], [0., 17.5]], dtype=np.float32)
+        scaler = StandardScaler(mean=np.float64(35.), std=np.float64(17.5), dtype=np.float32)
+        self.assertEqual(np.float32, scaler.transform(data).dtype)
+        self.assertEqual(np.float32, scaler.inverse_transform(data).dtype)
+        df = pd.DataFrame(data.astype(np.float64))
+        self.assertTrue(all(dtype == np.float32 for dtype in scaler.transform(df).dtypes))
+
+    def test_fit_standard_scaler(self):
+        data = np.random.rand(100, 3) * 70.
+        chunks = [data[i: i + 7] for i in range(0, 100, 7)]
+        scaler = utils.fit_standard_scaler(chunks)
+        self.assertAlmostEqual(data.mean(), scaler.mean, delta=1e-8)
+        self.assertAlmostEqual(data.std(), scaler.std, delta=1e-8)
+
     def test_reverse_transform_df(self):
         df = pd.DataFrame([
             [0., -1.],
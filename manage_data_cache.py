@@ -0,0 +1,37 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import tensorflow as tf
+
+from lib.data_cache import DatasetCache
+
+flags = tf.app.flags
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('action', 'list', 'list: show cached entries, invalidate: remove entries, evict: remove least '
+                                      'recently used entries until the cache is at most max_size_gb.')
+flags.DEFINE_string('data_cache_dir', None, 'Directory of the prepared data cache.')
+flags.DEFINE_string('key', None, 'Key of the entry to invalidate, all the entries are removed if not specified.')
+flags.DEFINE_float('max_size_gb', 20, 'Maximum size of the cache for evict.')
+
+
+def main(_):
+    cache = DatasetCache(FLAGS.data_cache_dir)
+    if FLAGS.action == 'list':
+        for key, size, last_access in cache.entries():
+            print('%s %.2fGB %s' % (key, size / 1024. ** 3, time.strftime('%Y-%m-%d %H:%M:%S',
+                                                                          time.localtime(last_access))))
+    elif FLAGS.action == 'invalidate':
+        cache.invalidate(FLAGS.key)
+    elif FLAGS.action == 'evict':
+        for key in cache.evict(int(FLAGS.max_size_gb * 1024 ** 3)):
+            print('Evicted: %s' % key)
+    else:
+        raise ValueError('Unknown action: %s' % FLAGS.action)
+
+
+if __name__ == '__main__':
+    tf.app.run()
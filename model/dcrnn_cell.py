@@ -2,7 +2,6 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import numpy as np
 import tensorflow as tf
 
 from tensorflow.contrib.rnn import RNNCell
@@ -10,10 +9,86 @@ from tensorflow.contrib.rnn import RNNCell
 from tensorflow.python.platform import tf_logging as logging
 
 from lib import dcrnn_utils
+from lib import tf_utils
 from tensorflow.python.ops import init_ops
 from tensorflow.python.ops import nn_ops
 
 
+def _get_batch_size(x):
+    """
+    Returns the static batch size of x if it is known, otherwise a scalar tensor, i.e., the batch size may vary between
+    runs of the same graph.
+    """
+    batch_size = x.get_shape()[0].value
+    if batch_size is None:
+        batch_size = tf.shape(x)[0]
+    return batch_size
+
+
+def _generate_diffusion_terms(x0, supports, max_diffusion_step):
+    """
+    Generates the diffusion terms of x0, i.e., x0 itself followed by T_k(S) x0 for each support S and k = 1..K.
+    :param x0: (num_nodes, n), the diffusion is applied to each column independently.
+    """
+    yield x0
+    if max_diffusion_step > 0:
+        for support in supports:
+            x1 = tf_utils.support_matmul(support, x0)
+            yield x1
+            for k in range(2, max_diffusion_step + 1):
+                x2 = 2 * tf_utils.support_matmul(support, x1) - x0
+                yield x2
+                x1, x0 = x2, x1
+
+
+def diffusion_terms(x, supports, max_diffusion_step):
+    """
+    Computes all the diffusion terms of x at once, e.g., of the inputs of all the timesteps.
+    :param x: (batch_size, num_nodes, input_size)
+    :return: (batch_size, num_nodes, input_size, num_matrices), the layout expected by the rows of the weights of
+    diffusion_conv, i.e., reshaping it to (batch_size * num_nodes, input_size * num_matrices) gives the inputs of the
+    projection.
+    """
+    _, num_nodes, input_size = [dim.value for dim in x.get_shape()]
+    batch_size = _get_batch_size(x)
+    x0 = tf.reshape(tf.transpose(x, perm=[1, 2, 0]), shape=[num_nodes, input_size * batch_size])
+    terms = list(_generate_diffusion_terms(x0, supports, max_diffusion_step))
+    terms = tf.reshape(tf.stack(terms, axis=-1), (num_nodes, input_size, batch_size, len(terms)))
+    return tf.transpose(terms, perm=[2, 0, 1, 3])
+
+
+def diffusion_conv(x, supports, max_diffusion_step, weights):
+    """
+    Diffusion convolution, i.e., sum_m T_m(S) x W_m, where T_m(S) x is the m-th diffusion term of x.
+    Each diffusion term is multiplied with its slice of the weights and accumulated, so that the terms are never
+    concatenated into one large tensor.
+
+    :param x: (batch_size, num_nodes, input_size)
+    :param supports: list of tf.SparseTensor or dense tensors with size (num_nodes, num_nodes).
+    :param max_diffusion_step:
+    :param weights: (input_size * num_matrices, output_size), the row of input i and diffusion term m is
+    i * num_matrices + m, where num_matrices = len(supports) * max_diffusion_step + 1.
+    :return: (batch_size * num_nodes, output_size)
+    """
+    _, num_nodes, input_size = [dim.value for dim in x.get_shape()]
+    batch_size = _get_batch_size(x)
+    num_matrices = len(supports) * max_diffusion_step + 1
+    output_size = weights.get_shape()[-1].value
+    weights = tf.reshape(weights, (input_size, num_matrices, output_size))
+
+    def term_dot(term, m):
+        # (num_nodes, input_size * batch_size) -> (batch_size * num_nodes, input_size)
+        term = tf.transpose(tf.reshape(term, (num_nodes, input_size, batch_size)), perm=[2, 0, 1])
+        return tf.matmul(tf.reshape(term, (batch_size * num_nodes, input_size)), weights[:, m, :])
+
+    x0 = tf.transpose(x, perm=[1, 2, 0])  # (num_nodes, total_arg_size, batch_size)
+    x0 = tf.reshape(x0, shape=[num_nodes, input_size * batch_size])
+    result = None
+    for m, term in enumerate(_generate_diffusion_terms(x0, supports, max_diffusion_step)):
+        result = term_dot(term, m) if result is None else result + term_dot(term, m)
+    return result
+
+
 class DCGRUCell(RNNCell):
     """Graph Convolution Gated Recurrent Unit cell.
     """
@@ -25,7 +100,9 @@ class DCGRUCell(RNNCell):
         pass
 
     def __init__(self, num_units, adj_mx, max_diffusion_step, num_nodes, input_size=None, num_proj=None,
-                 activation=tf.nn.tanh, reuse=None, filter_type="laplacian"):
+                 activation=tf.nn.tanh, reuse=None, filter_type="laplacian", input_diffused=False,
+                 support_backend='auto', lambda_max_method='eigsh', supports=None, node_indices=None,
+                 num_graph_nodes=None):
         """
         :param num_units:
         :param adj_mx:
@@ -36,6 +113,16 @@ class DCGRUCell(RNNCell):
         :param activation:
         :param reuse:
         :param filter_type: "laplacian", "random_walk", "dual_random_walk".
+        :param input_diffused: if True, the inputs are already diffused, i.e., (B, num_nodes * input_dim * num_matrices)
+        from diffusion_terms, so that each step only diffuses the state.
+        :param support_backend: "auto", "benchmark", "dense" or "sparse", see lib.tf_utils.select_support_backend.
+        :param lambda_max_method: "eigsh", "lanczos" or "power", see lib.dcrnn_utils.estimate_lambda_max.
+        :param supports: list of support tensors, e.g., sparse placeholders of the supports of subgraphs, which are
+        used instead of the supports of adj_mx.
+        :param node_indices: int tensor with size (num_nodes,), the indices of the nodes in the full graph with
+        num_graph_nodes nodes if the cell runs on subgraphs, see lib.dcrnn_utils.Subgraph, which select the rows of
+        the per-node variables.
+        :param num_graph_nodes:
         """
         super(DCGRUCell, self).__init__(_reuse=reuse)
         if input_size is not None:
@@ -45,26 +132,15 @@ class DCGRUCell(RNNCell):
         self._num_proj = num_proj
         self._num_units = num_units
         self._max_diffusion_step = max_diffusion_step
-        self._supports = []
-        supports = []
-        if filter_type == "laplacian":
-            supports.append(dcrnn_utils.calculate_scaled_laplacian(adj_mx, lambda_max=None))
-        elif filter_type == "random_walk":
-            supports.append(dcrnn_utils.calculate_random_walk_matrix(adj_mx).T)
-        elif filter_type == "dual_random_walk":
-            supports.append(dcrnn_utils.calculate_random_walk_matrix(adj_mx).T)
-            supports.append(dcrnn_utils.calculate_random_walk_matrix(adj_mx.T).T)
+        self._input_diffused = input_diffused
+        self._node_indices = node_indices
+        self._num_graph_nodes = num_graph_nodes
+        if supports is not None:
+            self._supports = list(supports)
         else:
-            supports.append(dcrnn_utils.calculate_scaled_laplacian(adj_mx))
-        for support in supports:
-            self._supports.append(self._build_sparse_matrix(support))
-
-    @staticmethod
-    def _build_sparse_matrix(L):
-        L = L.tocoo()
-        indices = np.column_stack((L.row, L.col))
-        L = tf.SparseTensor(indices, L.data, L.shape)
-        return tf.sparse_reorder(L)
+            # Supports are computed once and shared by all the cells in the graph.
+            self._supports = list(dcrnn_utils.support_registry.get_support_tensors(
+                adj_mx, filter_type=filter_type, backend=support_backend, lambda_max_method=lambda_max_method))
 
     @property
     def state_size(self):
@@ -101,15 +177,27 @@ class DCGRUCell(RNNCell):
             if self._num_proj is not None:
                 with tf.variable_scope("projection"):
                     w = tf.get_variable('w', shape=(self._num_units, self._num_proj))
-                    batch_size = inputs.get_shape()[0].value
+                    batch_size = _get_batch_size(inputs)
                     output = tf.reshape(new_state, shape=(-1, self._num_units))
                     output = tf.reshape(tf.matmul(output, w), shape=(batch_size, self.output_size))
         return output, new_state
 
-    @staticmethod
-    def _concat(x, x_):
-        x_ = tf.expand_dims(x_, 0)
-        return tf.concat([x, x_], axis=0)
+    def _diffusion_conv(self, inputs, state, weights):
+        """
+        Diffusion convolution of the concatenation of inputs and state.
+        :param inputs: (batch_size, num_nodes, input_dim), or (batch_size, num_nodes, input_dim * num_matrices) if the
+        inputs are already diffused.
+        :param state: (batch_size, num_nodes, state_dim)
+        :return: (batch_size * num_nodes, output_size)
+        """
+        if not self._input_diffused:
+            inputs_and_state = tf.concat([inputs, state], axis=2)
+            return diffusion_conv(inputs_and_state, self._supports, self._max_diffusion_step, weights)
+        # The rows of the inputs come first in the weights.
+        num_input_rows = inputs.get_shape()[2].value
+        batch_size = _get_batch_size(inputs)
+        x = tf.matmul(tf.reshape(inputs, (batch_size * self._num_nodes, num_input_rows)), weights[:num_input_rows])
+        return x + diffusion_conv(state, self._supports, self._max_diffusion_step, weights[num_input_rows:])
 
     def _gconv(self, inputs, state, output_size, bias_start=0.0, scope=None):
         """Graph convolution between input and the graph matrix.
@@ -122,41 +210,23 @@ class DCGRUCell(RNNCell):
         :return:
         """
         # Reshape input and state to (batch_size, num_nodes, input_dim/state_dim)
-        batch_size = inputs.get_shape()[0].value
-        inputs = tf.reshape(inputs, (batch_size, self._num_nodes, -1))
-        state = tf.reshape(state, (batch_size, self._num_nodes, -1))
-        inputs_and_state = tf.concat([inputs, state], axis=2)
-        input_size = inputs_and_state.get_shape()[2].value
+        # The sizes are computed explicitly, as reshaping with -1 loses them if the batch size is not static.
+        batch_size = _get_batch_size(inputs)
+        inputs = tf.reshape(inputs, (batch_size, self._num_nodes, inputs.get_shape()[1].value // self._num_nodes))
+        state = tf.reshape(state, (batch_size, self._num_nodes, state.get_shape()[1].value // self._num_nodes))
         dtype = inputs.dtype
 
-        x = inputs_and_state
-        x0 = tf.transpose(x, perm=[1, 2, 0])  # (num_nodes, total_arg_size, batch_size)
-        x0 = tf.reshape(x0, shape=[self._num_nodes, input_size * batch_size])
-        x = tf.expand_dims(x0, axis=0)
-
         scope = tf.get_variable_scope()
         with tf.variable_scope(scope):
-            if self._max_diffusion_step == 0:
-                pass
-            else:
-                for support in self._supports:
-                    x1 = tf.sparse_tensor_dense_matmul(support, x0)
-                    x = self._concat(x, x1)
-
-                    for k in range(2, self._max_diffusion_step + 1):
-                        x2 = 2 * tf.sparse_tensor_dense_matmul(support, x1) - x0
-                        x = self._concat(x, x2)
-                        x1, x0 = x2, x1
-
             num_matrices = len(self._supports) * self._max_diffusion_step + 1  # Adds for x itself.
-            x = tf.reshape(x, shape=[num_matrices, self._num_nodes, input_size, batch_size])
-            x = tf.transpose(x, perm=[3, 1, 2, 0])  # (batch_size, num_nodes, input_size, order)
-            x = tf.reshape(x, shape=[batch_size * self._num_nodes, input_size * num_matrices])
-
+            input_dim = inputs.get_shape()[2].value
+            if self._input_diffused:
+                input_dim //= num_matrices
+            input_size = input_dim + state.get_shape()[2].value
             weights = tf.get_variable(
                 'weights', [input_size * num_matrices, output_size], dtype=dtype,
                 initializer=tf.contrib.layers.xavier_initializer())
-            x = tf.matmul(x, weights)  # (batch_size * self._num_nodes, output_size)
+            x = self._diffusion_conv(inputs, state, weights)
 
             biases = tf.get_variable(
                 "biases", [output_size],
@@ -167,7 +237,32 @@ class DCGRUCell(RNNCell):
         return tf.reshape(x, [batch_size, self._num_nodes * output_size])
 
 
+class FusedDCGRUCell(DCGRUCell):
+    """DCGRUCell, which diffuses the inputs once per step and shares the diffusion terms between the gates and the
+    candidate, i.e., only r * state is diffused again for the candidate. It has the same variables as DCGRUCell.
+    """
+
+    def __init__(self, num_units, adj_mx, max_diffusion_step, num_nodes, input_size=None, num_proj=None,
+                 activation=tf.nn.tanh, reuse=None, filter_type="laplacian", input_diffused=False,
+                 support_backend='auto', lambda_max_method='eigsh', supports=None, node_indices=None,
+                 num_graph_nodes=None):
+        super(FusedDCGRUCell, self).__init__(num_units, adj_mx, max_diffusion_step, num_nodes, input_size, num_proj,
+                                             activation, reuse, filter_type, input_diffused=True,
+                                             support_backend=support_backend, lambda_max_method=lambda_max_method,
+                                             supports=supports, node_indices=node_indices,
+                                             num_graph_nodes=num_graph_nodes)
+        # Whether the inputs are diffused by the caller, see DCRNNModel, otherwise at the beginning of each step.
+        self._inputs_diffused_by_caller = input_diffused
 
+    def __call__(self, inputs, state, scope=None):
+        if not self._inputs_diffused_by_caller:
+            batch_size = _get_batch_size(inputs)
+            input_size = inputs.get_shape()[1].value
+            inputs = tf.reshape(inputs, (batch_size, self._num_nodes, input_size // self._num_nodes))
+            num_matrices = len(self._supports) * self._max_diffusion_step + 1
+            inputs = tf.reshape(diffusion_terms(inputs, self._supports, self._max_diffusion_step),
+                                (batch_size, input_size * num_matrices))
+        return super(FusedDCGRUCell, self).__call__(inputs, state, scope=scope)
 
 
 class DCIndCell(DCGRUCell):
@@ -181,7 +276,9 @@ class DCIndCell(DCGRUCell):
         pass
 
     def __init__(self, num_units, adj_mx, max_diffusion_step, num_nodes, input_size=None, num_proj=None,
-                 activation=tf.nn.relu, reuse=None, filter_type="laplacian"):
+                 activation=tf.nn.relu, reuse=None, filter_type="laplacian", input_diffused=False,
+                 support_backend='auto', lambda_max_method='eigsh', supports=None, node_indices=None,
+                 num_graph_nodes=None):
         """
         :param num_units:
         :param adj_mx:
@@ -192,9 +289,16 @@ class DCIndCell(DCGRUCell):
         :param activation:
         :param reuse:
         :param filter_type: "laplacian", "random_walk", "dual_random_walk".
+        :param input_diffused: see DCGRUCell.
+        :param support_backend: see DCGRUCell.
+        :param lambda_max_method: see DCGRUCell.
+        :param supports: see DCGRUCell.
+        :param node_indices: see DCGRUCell.
+        :param num_graph_nodes: see DCGRUCell.
         """
         super(DCIndCell, self).__init__(num_units, adj_mx, max_diffusion_step, num_nodes,
-             input_size, num_proj, activation, reuse, filter_type)
+             input_size, num_proj, activation, reuse, filter_type, input_diffused, support_backend,
+             lambda_max_method, supports, node_indices, num_graph_nodes)
         
 #        self._input_kernel = self.add_variable("input_kernel",
 #                shape=[self.input_size, self.output_size],
@@ -225,9 +329,8 @@ class DCIndCell(DCGRUCell):
             #print('gate_inputs',gate_inputs.shape)
 
 
-            recurrent_kernel = tf.get_variable(
-                'recurrent_kernel', [state.shape[1].value], dtype=inputs.dtype,
-                initializer=init_ops.constant_initializer(1.))
+            recurrent_kernel = self._get_node_variable(
+                'recurrent_kernel', dtype=inputs.dtype, initializer=init_ops.constant_initializer(1.))
 
             #print('recurrent_kernel',recurrent_kernel.shape)
             recurrent_update = state * recurrent_kernel  
@@ -237,9 +340,8 @@ class DCIndCell(DCGRUCell):
             #print('gate_inputs',gate_inputs.shape)
 
             
-            bias = tf.get_variable(
-                'bias', [gate_inputs.shape[1].value], dtype=inputs.dtype,
-                initializer=init_ops.zeros_initializer(dtype=inputs.dtype)) 
+            bias = self._get_node_variable(
+                'bias', dtype=inputs.dtype, initializer=init_ops.zeros_initializer(dtype=inputs.dtype))
             
 
             #print('bias',bias.shape)
@@ -251,12 +353,24 @@ class DCIndCell(DCGRUCell):
             if self._num_proj is not None:
                 with tf.variable_scope("projection"):
                     w = tf.get_variable('w', shape=(self._num_units, self._num_proj))
-                    batch_size = inputs.get_shape()[0].value
+                    batch_size = _get_batch_size(inputs)
                     output = tf.reshape(new_state, shape=(-1, self._num_units))
                     output = tf.reshape(tf.matmul(output, w), shape=(batch_size, self.output_size))
                     
         return output, new_state
-    
+
+    def _get_node_variable(self, name, dtype, initializer):
+        """
+        Gets a variable with one value per node and unit, i.e., (num_nodes * num_units,), which is gathered from the
+        variable of the full graph if the cell runs on subgraphs.
+        """
+        if self._node_indices is None:
+            return tf.get_variable(name, [self._num_nodes * self._num_units], dtype=dtype, initializer=initializer)
+        variable = tf.get_variable(name, [self._num_graph_nodes * self._num_units], dtype=dtype,
+                                   initializer=initializer)
+        variable = tf.gather(tf.reshape(variable, (self._num_graph_nodes, self._num_units)), self._node_indices)
+        return tf.reshape(variable, [self._num_nodes * self._num_units])
+
     def _gconv(self, inputs, state, output_size, bias_start=0.0, scope=None):
         """Graph convolution between input and the graph matrix.
 
@@ -268,42 +382,25 @@ class DCIndCell(DCGRUCell):
         :return:
         """
         # Reshape input and state to (batch_size, num_nodes, input_dim/state_dim)
-        batch_size = inputs.get_shape()[0].value
-        inputs = tf.reshape(inputs, (batch_size, self._num_nodes, -1))
-        state = tf.reshape(state, (batch_size, self._num_nodes, -1))
-        inputs_and_state = tf.concat([inputs, state], axis=2)
-        input_size = inputs_and_state.get_shape()[2].value
+        # The sizes are computed explicitly, as reshaping with -1 loses them if the batch size is not static.
+        batch_size = _get_batch_size(inputs)
+        inputs = tf.reshape(inputs, (batch_size, self._num_nodes, inputs.get_shape()[1].value // self._num_nodes))
+        state = tf.reshape(state, (batch_size, self._num_nodes, state.get_shape()[1].value // self._num_nodes))
         dtype = inputs.dtype
 
-        x = inputs_and_state
-        x0 = tf.transpose(x, perm=[1, 2, 0])  # (num_nodes, total_arg_size, batch_size)
-        x0 = tf.reshape(x0, shape=[self._num_nodes, input_size * batch_size])
-        x = tf.expand_dims(x0, axis=0)
-
         scope = tf.get_variable_scope()
         with tf.variable_scope(scope):
-            if self._max_diffusion_step == 0:
-                pass
-            else:
-                for support in self._supports:
-                    x1 = tf.sparse_tensor_dense_matmul(support, x0)
-                    x = self._concat(x, x1)
-
-                    for k in range(2, self._max_diffusion_step + 1):
-                        x2 = 2 * tf.sparse_tensor_dense_matmul(support, x1) - x0
-                        x = self._concat(x, x2)
-                        x1, x0 = x2, x1
-
             num_matrices = len(self._supports) * self._max_diffusion_step + 1  # Adds for x itself.
-            x = tf.reshape(x, shape=[num_matrices, self._num_nodes, input_size, batch_size])
-            x = tf.transpose(x, perm=[3, 1, 2, 0])  # (batch_size, num_nodes, input_size, order)
-            x = tf.reshape(x, shape=[batch_size * self._num_nodes, input_size * num_matrices])
+            input_dim = inputs.get_shape()[2].value
+            if self._input_diffused:
+                input_dim //= num_matrices
+            input_size = input_dim + state.get_shape()[2].value
             with tf.variable_scope('gconv'):
                 weights = tf.get_variable(
                     'weights', [input_size * num_matrices, output_size], dtype=dtype,
                     initializer=tf.contrib.layers.xavier_initializer())
-                x = tf.matmul(x, weights)  # (batch_size * self._num_nodes, output_size)
-    
+                x = self._diffusion_conv(inputs, state, weights)
+
                 biases = tf.get_variable(
                     "biases", [output_size],
                     dtype=dtype,
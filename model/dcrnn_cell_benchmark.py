@@ -0,0 +1,100 @@
+"""
+Microbenchmarks of the diffusion convolution of the DCRNN cells, compared with the previous implementation, which
+concatenated every diffusion term onto a growing tensor, and of one step of DCGRUCell, compared with FusedDCGRUCell.
+
+Usage: python -m model.dcrnn_cell_benchmark --benchmarks=all
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import scipy.sparse as sp
+import tensorflow as tf
+
+from lib import dcrnn_utils
+from lib import tf_utils
+from model.dcrnn_cell import DCGRUCell, FusedDCGRUCell, diffusion_conv
+
+
+def concat_diffusion_conv(x, supports, max_diffusion_step, weights):
+    """
+    Previous implementation of diffusion_conv.
+    """
+    batch_size, num_nodes, input_size = [dim.value for dim in x.get_shape()]
+    x0 = tf.transpose(x, perm=[1, 2, 0])  # (num_nodes, total_arg_size, batch_size)
+    x0 = tf.reshape(x0, shape=[num_nodes, input_size * batch_size])
+    x = tf.expand_dims(x0, axis=0)
+    if max_diffusion_step > 0:
+        for support in supports:
+            x1 = tf.sparse_tensor_dense_matmul(support, x0)
+            x = tf.concat([x, tf.expand_dims(x1, 0)], axis=0)
+            for k in range(2, max_diffusion_step + 1):
+                x2 = 2 * tf.sparse_tensor_dense_matmul(support, x1) - x0
+                x = tf.concat([x, tf.expand_dims(x2, 0)], axis=0)
+                x1, x0 = x2, x1
+    num_matrices = len(supports) * max_diffusion_step + 1
+    x = tf.reshape(x, shape=[num_matrices, num_nodes, input_size, batch_size])
+    x = tf.transpose(x, perm=[3, 1, 2, 0])  # (batch_size, num_nodes, input_size, order)
+    x = tf.reshape(x, shape=[batch_size * num_nodes, input_size * num_matrices])
+    return tf.matmul(x, weights)
+
+
+class DiffusionConvBenchmark(tf.test.Benchmark):
+    batch_size = 64
+    num_nodes = 207
+    input_size = 66  # e.g., 2 input features and 64 rnn units.
+    output_size = 128
+    filter_type = 'dual_random_walk'
+
+    def _build(self, conv, max_diffusion_step):
+        rng = np.random.RandomState(0)
+        adj_mx = sp.random(self.num_nodes, self.num_nodes, density=0.05, random_state=rng, dtype=np.float32)
+        supports = [tf_utils.build_support_tensor(support.astype(np.float32), 'sparse') for support in
+                    dcrnn_utils.calculate_supports(adj_mx, filter_type=self.filter_type)]
+        num_matrices = len(supports) * max_diffusion_step + 1
+        x = tf.constant(rng.randn(self.batch_size, self.num_nodes, self.input_size).astype(np.float32))
+        weights = tf.constant(rng.randn(self.input_size * num_matrices, self.output_size).astype(np.float32))
+        outputs = conv(x, supports, max_diffusion_step, weights)
+        # Forward and backward pass, as in training.
+        grads = tf.gradients(tf.reduce_sum(outputs), [x, weights])
+        return outputs, tf.group(*grads)
+
+    def benchmark_diffusion_conv(self):
+        for max_diffusion_step in [1, 2, 3, 4]:
+            results = {}
+            for name, conv in [('concat', concat_diffusion_conv), ('accumulate', diffusion_conv)]:
+                with tf.Graph().as_default(), tf.Session() as sess:
+                    outputs, train_op = self._build(conv, max_diffusion_step)
+                    results[name] = sess.run(outputs)
+                    self.run_op_benchmark(sess, train_op, min_iters=20,
+                                          name='%s_diffusion_conv_k%d' % (name, max_diffusion_step))
+            assert np.allclose(results['concat'], results['accumulate'], atol=1e-3), 'Outputs differ.'
+
+    def benchmark_dcgru_cell(self):
+        input_dim, num_units = 2, 64
+        for max_diffusion_step in [1, 2, 3]:
+            results = {}
+            for name, cell_class in [('dcgru', DCGRUCell), ('dcgru_fused', FusedDCGRUCell)]:
+                with tf.Graph().as_default(), tf.Session() as sess:
+                    rng = np.random.RandomState(0)
+                    adj_mx = sp.random(self.num_nodes, self.num_nodes, density=0.05, random_state=rng,
+                                       dtype=np.float32)
+                    cell = cell_class(num_units, adj_mx, max_diffusion_step=max_diffusion_step,
+                                      num_nodes=self.num_nodes, filter_type=self.filter_type)
+                    inputs = tf.constant(rng.randn(self.batch_size, self.num_nodes * input_dim).astype(np.float32))
+                    state = tf.constant(rng.randn(self.batch_size, self.num_nodes * num_units).astype(np.float32))
+                    outputs, _ = cell(inputs, state)
+                    grads = tf.gradients(tf.reduce_sum(outputs), tf.trainable_variables())
+                    # Both cells have the same variables, which are set to the same values.
+                    for var in tf.global_variables():
+                        shape = var.get_shape().as_list()
+                        var.load(0.1 * np.random.RandomState(0).randn(*shape).astype(np.float32), sess)
+                    results[name] = sess.run(outputs)
+                    self.run_op_benchmark(sess, tf.group(*grads), min_iters=20,
+                                          name='%s_cell_k%d' % (name, max_diffusion_step))
+            assert np.allclose(results['dcgru'], results['dcgru_fused'], atol=1e-3), 'Outputs differ.'
+
+
+if __name__ == '__main__':
+    tf.test.main()
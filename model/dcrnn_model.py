@@ -6,107 +6,338 @@ import tensorflow as tf
 
 from tensorflow.contrib import legacy_seq2seq
 
+from lib import dcrnn_utils
+from lib import tf_utils
 from lib.metrics import masked_mse_loss, masked_mae_loss, masked_rmse_loss
-from model.dcrnn_cell import DCGRUCell,DCIndCell
+from lib.tf_utils import BatchPrefetcher, while_loop_rnn_decoder
+from model.dcrnn_cell import DCGRUCell,DCIndCell, FusedDCGRUCell, diffusion_terms
 from model.tf_model import TFModel
 
+# Values of the rnn_cell option.
+RNN_CELLS = {
+    'dcgru': DCGRUCell,
+    'dcgru_fused': FusedDCGRUCell,
+    'dcind': DCIndCell,
+}
+
+# Values of the rnn_impl option: "static" unrolls the encoder and the decoder, i.e., builds a copy of each cell per
+# step, "while_loop" builds each cell once inside a tf.while_loop.
+RNN_IMPLS = ('static', 'while_loop')
+
 
 class DCRNNModel(TFModel):
     def __init__(self, is_training, config, scaler=None, adj_mx=None):
         super(DCRNNModel, self).__init__(config, scaler=scaler)
-        batch_size = int(config.get('batch_size'))
+        add_day_in_week = bool(config.get('add_day_in_week', False))
+        add_time_in_day = bool(config.get('add_time_in_day', True))
+        # None for a variable batch size, i.e., the same graph runs batches of any size.
+        batch_size = config.get('batch_size')
+        batch_size = int(batch_size) if batch_size is not None else None
+        compact_time_features = bool(config.get('compact_time_features', False))
         max_diffusion_step = int(config.get('max_diffusion_step', 2))
         cl_decay_steps = int(config.get('cl_decay_steps', 1000))
         filter_type = config.get('filter_type', 'laplacian')
         horizon = int(config.get('horizon', 1))
         input_dim = int(config.get('input_dim', 1))
+        input_pipeline = config.get('input_pipeline', 'feed_dict')
         loss_func = config.get('loss_func', 'MSE')
         max_grad_norm = float(config.get('max_grad_norm', 5.0))
         num_nodes = int(config.get('num_nodes', 1))
         num_rnn_layers = int(config.get('num_rnn_layers', 1))
+        # Number of data-parallel training processes, see TFModelSupervisor.train_data_parallel.
+        num_workers = int(config.get('num_workers', 1))
+        # Largest eigenvalue of the laplacian, see lib.dcrnn_utils.estimate_lambda_max.
+        lambda_max_method = config.get('lambda_max_method', 'eigsh')
         output_dim = int(config.get('output_dim', 1))
+        prefetch_size = int(config.get('prefetch_size', 2))
+        # Diffuses the encoder inputs of all the timesteps up front, instead of together with the state in each step.
+        precompute_input_diffusion = bool(config.get('precompute_input_diffusion', False))
+        rnn_cell = config.get('rnn_cell', 'dcind')
+        rnn_impl = config.get('rnn_impl', 'static')
         rnn_units = int(config.get('rnn_units'))
         seq_len = int(config.get('seq_len'))
+        # Number of optimizer steps per sess.run, > 1 runs them in an in-graph loop over the input queue.
+        steps_per_run = int(config.get('steps_per_run', 1))
+        # Number of nodes of the padded subgraphs, see lib.dcrnn_utils.GraphPartition, None to run on the full graph.
+        subgraph_num_nodes = config.get('subgraph_num_nodes')
+        # Dense or sparse multiplication with the supports, see lib.tf_utils.select_support_backend.
+        support_backend = config.get('support_backend', 'auto')
         use_curriculum_learning = bool(config.get('use_curriculum_learning', False))
 
         assert input_dim == output_dim, 'input_dim: %d != output_dim: %d' % (input_dim, output_dim)
+        if rnn_cell not in RNN_CELLS:
+            raise ValueError('Unknown rnn_cell: %s, expect one of %s' % (rnn_cell, sorted(RNN_CELLS)))
+        cell_class = RNN_CELLS[rnn_cell]
+        if rnn_impl not in RNN_IMPLS:
+            raise ValueError('Unknown rnn_impl: %s, expect one of %s' % (rnn_impl, RNN_IMPLS))
+        if is_training and steps_per_run > 1 and input_pipeline != 'queue':
+            raise ValueError('steps_per_run > 1 requires the queue input pipeline.')
+        if is_training and steps_per_run > 1 and num_workers > 1:
+            raise ValueError('steps_per_run > 1 is not supported with multiple workers.')
+        if support_backend == 'benchmark' and num_workers > 1:
+            # The benchmark runs tensorflow sessions while building the model, i.e., before the workers are forked.
+            raise ValueError('support_backend benchmark is not supported with multiple workers, use auto, dense or '
+                             'sparse.')
+        # Subgraph inputs, which are fed with each batch.
+        self._subgraph_supports = None
+        self._node_indices = None
+        self._num_core_nodes = None
+        graph_num_nodes = num_nodes
+        if subgraph_num_nodes is not None:
+            if input_pipeline == 'queue':
+                raise ValueError('Subgraphs require the feed_dict input pipeline.')
+            num_nodes = int(subgraph_num_nodes)
+            with tf.name_scope('subgraph'):
+                self._subgraph_supports = [tf.sparse_placeholder(tf.float32, shape=(num_nodes, num_nodes),
+                                                                 name='support_%d' % i)
+                                           for i in range(dcrnn_utils.get_num_supports(filter_type))]
+                self._node_indices = tf.placeholder(tf.int32, shape=(num_nodes,), name='node_indices')
+                self._num_core_nodes = tf.placeholder(tf.int32, shape=(), name='num_core_nodes')
         # Input (batch_size, timesteps, num_sensor, input_dim)
-        self._inputs = tf.placeholder(tf.float32, shape=(batch_size, seq_len, num_nodes, input_dim), name='inputs')
+        input_shape = (batch_size, seq_len, num_nodes, input_dim)
         # Labels: (batch_size, timesteps, num_sensor, output_dim)
-        self._labels = tf.placeholder(tf.float32, shape=(batch_size, horizon, num_nodes, output_dim), name='labels')
-        GO_SYMBOL = tf.zeros(shape=(batch_size, num_nodes * input_dim))
-
-#        cell = DCIndCell(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=num_nodes,
-#                         filter_type=filter_type)
-#        cell_with_projection = DCIndCell(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=num_nodes,
-#                                         num_proj=output_dim, filter_type=filter_type)
-#        encoding_cells = [cell] * num_rnn_layers
-#        decoding_cells = [cell] * (num_rnn_layers - 1) + [cell_with_projection]
-        
-        encoding_cells = []
-        for i in range(num_rnn_layers):
-            encoding_cells.append(DCIndCell(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=num_nodes,
-                         filter_type=filter_type))
-        decoding_cells = []
-        for i in range(num_rnn_layers - 1):
-            decoding_cells.append(DCIndCell(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=num_nodes,
-                         filter_type=filter_type))
-        decoding_cells.append(DCIndCell(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=num_nodes,
-                                         num_proj=output_dim, filter_type=filter_type))
-        
-        encoding_cells = tf.contrib.rnn.MultiRNNCell(encoding_cells, state_is_tuple=True)
-        decoding_cells = tf.contrib.rnn.MultiRNNCell(decoding_cells, state_is_tuple=True)
-
+        label_shape = (batch_size, horizon, num_nodes, output_dim)
+        shapes = [input_shape, label_shape]
+        if compact_time_features:
+            # Time features: (batch_size, seq_len + horizon, num_time_features), shared by all the nodes.
+            shapes.append((batch_size, seq_len + horizon, int(add_time_in_day) + int(add_day_in_week)))
+        if input_pipeline == 'queue':
+            # Batches are prefetched into an input queue in the background, see TFModel.run_epoch.
+            self._prefetcher = BatchPrefetcher(shapes=shapes, capacity=prefetch_size)
+            tensors = self._prefetcher.dequeue()
+            self._inputs = tf.identity(tensors[0], name='inputs')
+            self._labels = tf.identity(tensors[1], name='labels')
+            if compact_time_features:
+                self._time_inputs = tf.identity(tensors[2], name='time_inputs')
+        else:
+            self._inputs = tf.placeholder(tf.float32, shape=input_shape, name='inputs')
+            self._labels = tf.placeholder(tf.float32, shape=label_shape, name='labels')
+            if compact_time_features:
+                self._time_inputs = tf.placeholder(tf.float32, shape=shapes[2], name='time_inputs')
         global_step = tf.train.get_or_create_global_step()
-        # Outputs: (batch_size, timesteps, num_nodes, output_dim)
-        with tf.variable_scope('DCRNN_SEQ'):
-            inputs = tf.unstack(tf.reshape(self._inputs, (batch_size, seq_len, num_nodes * input_dim)), axis=1)
-            labels = tf.unstack(tf.reshape(self._labels, (batch_size, horizon, num_nodes * output_dim)), axis=1)
-            labels.insert(0, GO_SYMBOL)
-            loop_function = None
-            if is_training:
-                if use_curriculum_learning:
+
+        def build_model(inputs, labels, time_inputs):
+            """
+            Builds the seq2seq model on a batch, and then again for each step of the multi-step training loop.
+            :return: (outputs, loss, mae)
+            """
+            batch_size = inputs.get_shape()[0].value
+            if batch_size is None:
+                batch_size = tf.shape(inputs)[0]
+            GO_SYMBOL = tf.zeros(shape=(batch_size, num_nodes * output_dim))
+
+            encoder_inputs = inputs
+            decoder_time_features = None
+            if compact_time_features:
+                # Copies the time features to every node inside the graph, instead of in the fed data.
+                time_features = self._expand_time_features(time_inputs, num_nodes, add_time_in_day=add_time_in_day,
+                                                           add_day_in_week=add_day_in_week)
+                encoder_inputs = tf.concat([encoder_inputs, time_features[:, :seq_len, ...]], axis=-1)
+                # The i-th decoder input, i.e., the GO symbol or the reading of step seq_len + i - 1, comes with the
+                # time of step seq_len + i - 1.
+                decoder_time_features = time_features[:, seq_len - 1:, ...]
+            encoder_input_dim = encoder_inputs.get_shape()[-1].value
+
+            def append_time_features(x, i):
+                """
+                Appends the time features of the i-th decoder step to x with size (batch_size, num_nodes * output_dim).
+                """
+                if decoder_time_features is None:
+                    return x
+                x = tf.concat([tf.reshape(x, (batch_size, num_nodes, output_dim)), decoder_time_features[:, i, ...]],
+                              axis=-1)
+                return tf.reshape(x, (batch_size, num_nodes * encoder_input_dim))
+
+            cell_kwargs = {
+                'filter_type': filter_type,
+                'lambda_max_method': lambda_max_method,
+                'node_indices': self._node_indices,
+                'num_graph_nodes': graph_num_nodes,
+                'support_backend': support_backend,
+                'supports': self._subgraph_supports,
+            }
+            encoding_cells = []
+            for i in range(num_rnn_layers):
+                encoding_cells.append(cell_class(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step,
+                                                 num_nodes=num_nodes,
+                                                 input_diffused=precompute_input_diffusion and i == 0, **cell_kwargs))
+            decoding_cells = []
+            for i in range(num_rnn_layers - 1):
+                decoding_cells.append(cell_class(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step,
+                                                 num_nodes=num_nodes, **cell_kwargs))
+            decoding_cells.append(cell_class(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step,
+                                             num_nodes=num_nodes, num_proj=output_dim, **cell_kwargs))
+
+            encoding_cells = tf.contrib.rnn.MultiRNNCell(encoding_cells, state_is_tuple=True)
+            decoding_cells = tf.contrib.rnn.MultiRNNCell(decoding_cells, state_is_tuple=True)
+
+            # Outputs: (batch_size, timesteps, num_nodes, output_dim)
+            with tf.variable_scope('DCRNN_SEQ'):
+                if precompute_input_diffusion:
+                    # One batched sparse matmul per diffusion term for all the timesteps, the first encoder layer then
+                    # only diffuses its state.
+                    supports = self._subgraph_supports
+                    if supports is None:
+                        supports = dcrnn_utils.support_registry.get_support_tensors(adj_mx, filter_type=filter_type,
+                                                                                    backend=support_backend,
+                                                                                    lambda_max_method=lambda_max_method)
+                    encoder_inputs = diffusion_terms(
+                        tf.reshape(encoder_inputs, (batch_size * seq_len, num_nodes, encoder_input_dim)), supports,
+                        max_diffusion_step)
+                    num_matrices = len(supports) * max_diffusion_step + 1
+                    inputs = tf.reshape(encoder_inputs,
+                                        (batch_size, seq_len, num_nodes * encoder_input_dim * num_matrices))
+                else:
+                    inputs = tf.reshape(encoder_inputs, (batch_size, seq_len, num_nodes * encoder_input_dim))
+                decoder_inputs = tf.unstack(tf.reshape(labels, (batch_size, horizon, num_nodes * output_dim)), axis=1)
+                decoder_inputs.insert(0, GO_SYMBOL)
+                decoder_inputs = [append_time_features(x, i) for i, x in enumerate(decoder_inputs)]
+                if rnn_impl == 'while_loop':
+                    # Time-major, so that the i-th decoder input can also be selected with a step tensor i.
+                    decoder_inputs = tf.stack(decoder_inputs, axis=0)
+                loop_function = None
+                if is_training:
+                    if use_curriculum_learning:
+                        def loop_function(prev, i):
+                            c = tf.random_uniform((), minval=0, maxval=1.)
+                            threshold = self._compute_sampling_threshold(global_step, cl_decay_steps)
+                            result = tf.cond(tf.less(c, threshold), lambda: decoder_inputs[i],
+                                             lambda: append_time_features(prev, i))
+                            return result
+                else:
+                    # Return the output of the model.
                     def loop_function(prev, i):
-                        c = tf.random_uniform((), minval=0, maxval=1.)
-                        threshold = self._compute_sampling_threshold(global_step, cl_decay_steps)
-                        result = tf.cond(tf.less(c, threshold), lambda: labels[i], lambda: prev)
-                        return result
+                        return append_time_features(prev, i)
+
+                if rnn_impl == 'while_loop':
+                    _, enc_state = tf.nn.dynamic_rnn(encoding_cells, inputs, dtype=tf.float32)
+                    # Only the outputs of the first horizon steps are used.
+                    outputs, final_state = while_loop_rnn_decoder(decoder_inputs, enc_state, decoding_cells,
+                                                                  loop_function=loop_function, num_steps=horizon)
+                    outputs = tf.transpose(outputs, perm=[1, 0, 2])
+                else:
+                    _, enc_state = tf.contrib.rnn.static_rnn(encoding_cells, tf.unstack(inputs, axis=1),
+                                                             dtype=tf.float32)
+                    outputs, final_state = legacy_seq2seq.rnn_decoder(decoder_inputs, enc_state, decoding_cells,
+                                                                      loop_function=loop_function)
+                    outputs = tf.stack(outputs[:-1], axis=1)
+
+            # Project the output to output_dim.
+            outputs = tf.reshape(outputs, (batch_size, horizon, num_nodes, output_dim), name='outputs')
+
+            model_outputs = outputs
+            if self._num_core_nodes is not None:
+                # Only the core nodes of subgraphs are evaluated, the halo and padding nodes only provide context.
+                outputs = outputs[:, :, :self._num_core_nodes, :]
+                labels = labels[:, :, :self._num_core_nodes, :]
+            preds = outputs[..., 0]
+
+            null_val = config.get('null_val', 0.)
+            mae = masked_mae_loss(self._scaler, null_val)(preds=preds, labels=labels[..., 0])
+
+            if loss_func == 'MSE':
+                loss = masked_mse_loss(self._scaler, null_val)(preds=outputs, labels=labels)
+            elif loss_func == 'MAE':
+                loss = masked_mae_loss(self._scaler, null_val)(preds=outputs, labels=labels)
+            elif loss_func == 'RMSE':
+                loss = masked_rmse_loss(self._scaler, null_val)(preds=outputs, labels=labels)
             else:
-                # Return the output of the model.
-                def loop_function(prev, _):
-                    return prev
-
-            _, enc_state = tf.contrib.rnn.static_rnn(encoding_cells, inputs, dtype=tf.float32)
-            outputs, final_state = legacy_seq2seq.rnn_decoder(labels, enc_state, decoding_cells,
-                                                              loop_function=loop_function)
-
-        # Project the output to output_dim.
-        outputs = tf.stack(outputs[:-1], axis=1)
-        self._outputs = tf.reshape(outputs, (batch_size, horizon, num_nodes, output_dim), name='outputs')
-
-        preds = self._outputs[..., 0]
-        labels = self._labels[..., 0]
-
-        null_val = config.get('null_val', 0.)
-        self._mae = masked_mae_loss(self._scaler, null_val)(preds=preds, labels=labels)
-
-        if loss_func == 'MSE':
-            self._loss = masked_mse_loss(self._scaler, null_val)(preds=self._outputs, labels=self._labels)
-        elif loss_func == 'MAE':
-            self._loss = masked_mae_loss(self._scaler, null_val)(preds=self._outputs, labels=self._labels)
-        elif loss_func == 'RMSE':
-            self._loss = masked_rmse_loss(self._scaler, null_val)(preds=self._outputs, labels=self._labels)
-        else:
-            self._loss = masked_mse_loss(self._scaler, null_val)(preds=self._outputs, labels=self._labels)
+                loss = masked_mse_loss(self._scaler, null_val)(preds=outputs, labels=labels)
+            return model_outputs, loss, mae
+
+        self._outputs, self._loss, self._mae = build_model(self._inputs, self._labels, self._time_inputs)
         if is_training:
             optimizer = tf.train.AdamOptimizer(self._lr)
             tvars = tf.trainable_variables()
+
+            def apply_gradients(grads, name=None):
+                grads, _ = tf.clip_by_global_norm(grads, max_grad_norm)
+                return optimizer.apply_gradients(zip(grads, tvars), global_step=global_step, name=name)
+
+            def minimize(loss, name=None):
+                return apply_gradients(tf.gradients(loss, tvars), name=name)
+
+            # Shared by the train op and the data-parallel gradients, i.e., the backward graph is built once.
             grads = tf.gradients(self._loss, tvars)
-            grads, _ = tf.clip_by_global_norm(grads, max_grad_norm)
-            self._train_op = optimizer.apply_gradients(zip(grads, tvars), global_step=global_step, name='train_op')
+            self._train_op = apply_gradients(grads, name='train_op')
+            if num_workers > 1:
+                # The gradients of the replicas are averaged outside of the graph as one flat vector, and then
+                # clipped and applied by every replica, which keeps the variables the same.
+                with tf.name_scope('data_parallel'):
+                    grads = [tf.convert_to_tensor(grad) for grad in grads]
+                    self._flat_grads = tf.concat([tf.reshape(grad, [-1]) for grad in grads], axis=0,
+                                                 name='flat_grads')
+                    self._flat_grads_input = tf.placeholder(tf.float32, shape=self._flat_grads.get_shape(),
+                                                            name='flat_grads_input')
+                    sizes = [var.get_shape().num_elements() for var in tvars]
+                    grads = [tf.reshape(grad, var.get_shape())
+                             for grad, var in zip(tf.split(self._flat_grads_input, sizes), tvars)]
+                    self._apply_grads_op = apply_gradients(grads, name='apply_grads')
+            if steps_per_run > 1:
+                # Each step rebuilds the model on a dequeued batch with the same variables, which should be resource
+                # variables, see DCRNNSupervisor, and reuses the slots of the optimizer.
+                def train_step():
+                    tensors = self._prefetcher.dequeue()
+                    time_inputs = tensors[2] if compact_time_features else None
+                    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                        _, loss, mae = build_model(tensors[0], tensors[1], time_inputs)
+                    return minimize(loss), [loss, mae]
+
+                with tf.name_scope('multi_step'):
+                    self._num_steps = tf.placeholder_with_default(steps_per_run, shape=(), name='num_steps')
+                    loss_sum, mae_sum = tf_utils.repeat_steps(self._num_steps, train_step, num_outputs=2)
+                    num_steps = tf.cast(self._num_steps, tf.float32)
+                    self._multi_step_loss = tf.identity(loss_sum / num_steps, name='loss')
+                    self._multi_step_mae = tf.identity(mae_sum / num_steps, name='mae')
 
         self._merged = tf.summary.merge_all()
 
+    def get_feed_dict(self, batch):
+        """
+        :param batch: see TFModel.get_feed_dict, followed by a lib.dcrnn_utils.Subgraph for models on subgraphs, whose
+        inputs and labels only contain the nodes of the subgraph.
+        """
+        if self._num_core_nodes is None:
+            return super(DCRNNModel, self).get_feed_dict(batch)
+        subgraph = batch[-1]
+        feed_dict = super(DCRNNModel, self).get_feed_dict(batch[:-1])
+        for placeholder, support_value in zip(self._subgraph_supports, subgraph.support_values):
+            feed_dict[placeholder] = support_value
+        feed_dict[self._node_indices] = subgraph.node_indices
+        feed_dict[self._num_core_nodes] = subgraph.num_core_nodes
+        return feed_dict
+
+    @staticmethod
+    def get_receptive_field_hops(config):
+        """
+        Computes the number of hops of the receptive field of the outputs, i.e., the outputs of a node only depend on
+        the inputs of the nodes within this number of hops.
+        Each cell diffuses its inputs and state max_diffusion_step hops, GRU cells twice, as the candidate diffuses
+        the reset state. The longest chain of cells runs through the encoder steps, and then through all the layers
+        of each decoder step, whose inputs are the outputs of the previous step.
+        """
+        max_diffusion_step = int(config.get('max_diffusion_step', 2))
+        num_rnn_layers = int(config.get('num_rnn_layers', 1))
+        rnn_cell = config.get('rnn_cell', 'dcind')
+        cell_hops = max_diffusion_step if rnn_cell == 'dcind' else 2 * max_diffusion_step
+        return cell_hops * (int(config.get('seq_len')) + int(config.get('horizon', 1)) * num_rnn_layers)
+
+    @staticmethod
+    def _expand_time_features(time_inputs, num_nodes, add_time_in_day, add_day_in_week):
+        """
+        Expands the compact time features, see lib.utils.generate_time_features, to the layout of
+        lib.utils.generate_graph_features_with_time.
+        :param time_inputs: (batch_size, timesteps, num_time_features)
+        :return: (batch_size, timesteps, num_nodes, time_dim)
+        """
+        features = []
+        if add_time_in_day:
+            features.append(time_inputs[..., :1])
+        if add_day_in_week:
+            features.append(tf.one_hot(tf.cast(time_inputs[..., -1], tf.int32), depth=7))
+        features = tf.concat(features, axis=-1)
+        return tf.tile(tf.expand_dims(features, axis=2), [1, 1, num_nodes, 1])
+
     @staticmethod
     def _compute_sampling_threshold(global_step, k):
         """
@@ -2,13 +2,17 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import time
 
 import numpy as np
 import pandas as pd
 import tensorflow as tf
 
-from lib.utils import generate_graph_seq2seq_io_data_with_time
+from lib import data_cache
+from lib import dcrnn_utils
+from lib.utils import generate_graph_features_from_chunks, generate_graph_features_with_time
+from lib.utils import generate_seq2seq_windows, WindowSampler
 from model.dcrnn_model import DCRNNModel
 from model.tf_model_supervisor import TFModelSupervisor
 
@@ -20,89 +24,272 @@ class DCRNNSupervisor(TFModelSupervisor):
 
     def __init__(self, traffic_reading_df, adj_mx, config):
         self._adj_mx = adj_mx
+        # lib.dcrnn_utils.GraphPartition if the training model runs on subgraphs, see num_clusters.
+        self._graph_partition = None
+        # Configuration of the models, and the inference models on subgraphs by number of nodes, see predict_sensors.
+        self._model_config = None
+        self._receptive_field_extractor = None
+        self._subgraph_models = {}
         super(DCRNNSupervisor, self).__init__(config, df_data=traffic_reading_df)
 
     def _prepare_train_val_test_data(self):
         # Parsing model parameters.
         batch_size = self._get_config('batch_size')
+        data_mode = self._get_config('data_mode')
         horizon = self._get_config('horizon')
         seq_len = self._get_config('seq_len')
 
+        # The testing data is one continuous sequence, whose windows are batched in test_and_write_result.
         test_batch_size = 1
-        add_time_in_day = self._get_config('add_time_in_day')
-
-        num_nodes = self._df_train.shape[-1]
-        x_train, y_train = generate_graph_seq2seq_io_data_with_time(self._df_train,
-                                                                    batch_size=batch_size,
-                                                                    seq_len=seq_len,
-                                                                    horizon=horizon,
-                                                                    num_nodes=num_nodes,
-                                                                    scaler=self._scaler,
-                                                                    add_time_in_day=add_time_in_day,
-                                                                    add_day_in_week=False)
-        x_val, y_val = generate_graph_seq2seq_io_data_with_time(self._df_val, batch_size=batch_size,
-                                                                seq_len=seq_len,
-                                                                horizon=horizon,
-                                                                num_nodes=num_nodes,
-                                                                scaler=self._scaler,
-                                                                add_time_in_day=add_time_in_day,
-                                                                add_day_in_week=False)
-        x_test, y_test = generate_graph_seq2seq_io_data_with_time(self._df_test,
-                                                                  batch_size=test_batch_size,
-                                                                  seq_len=seq_len,
-                                                                  horizon=horizon,
-                                                                  num_nodes=num_nodes,
-                                                                  scaler=self._scaler,
-                                                                  add_time_in_day=add_time_in_day,
-                                                                  add_day_in_week=False)
+        # In random mode, the training and validation data are continuous series, which are sampled by WindowSampler.
+        train_batch_size = batch_size if data_mode == 'sequential' else 1
+        if self._cached_data is not None:
+            data = self._cached_data[0]
+        else:
+            arrays = {}
+            for split, df, split_batch_size in [('train', self._df_train, train_batch_size),
+                                                ('val', self._df_val, train_batch_size),
+                                                ('test', self._df_test, test_batch_size)]:
+                arrays[split], time_data = self._generate_graph_data(df, batch_size=split_batch_size, split=split)
+                if time_data is not None:
+                    arrays['%s_time' % split] = time_data
+            data = self._save_cached_data(arrays)
+        compact_time_features = self._use_compact_time_features()
+        if data_mode == 'random':
+            time_train, time_val = None, None
+            if compact_time_features:
+                time_train, time_val = data['train_time'][0], data['val_time'][0]
+            x_train = WindowSampler(data['train'][0], batch_size=batch_size, seq_len=seq_len, horizon=horizon,
+                                    shuffle=self._get_config('shuffle'), time_data=time_train)
+            x_val = WindowSampler(data['val'][0], batch_size=batch_size, seq_len=seq_len, horizon=horizon,
+                                  shuffle=False, time_data=time_val)
+            y_train, y_val = None, None
+        else:
+            x_train, y_train = generate_seq2seq_windows(data['train'], seq_len=seq_len, horizon=horizon)
+            x_val, y_val = generate_seq2seq_windows(data['val'], seq_len=seq_len, horizon=horizon)
+            if compact_time_features:
+                # Each time window covers both the inputs and the labels.
+                self._time_train, _ = generate_seq2seq_windows(data['train_time'], seq_len=seq_len + horizon, horizon=0)
+                self._time_val, _ = generate_seq2seq_windows(data['val_time'], seq_len=seq_len + horizon, horizon=0)
+        x_test, y_test = generate_seq2seq_windows(data['test'], seq_len=seq_len, horizon=horizon)
+        if compact_time_features:
+            self._time_test, _ = generate_seq2seq_windows(data['test_time'], seq_len=seq_len + horizon, horizon=0)
         return x_train, y_train, x_val, y_val, x_test, y_test
 
+    def _use_compact_time_features(self):
+        return bool(self._get_config('compact_time_features')) and (
+            bool(self._get_config('add_time_in_day')) or bool(self._get_config('add_day_in_week')))
+
+    def _generate_graph_data(self, df, batch_size, split):
+        """
+        Generates the node features of one split, either from the DataFrame or out-of-core from the reader.
+        :return: (data, time_data), data: (batch_size, batch_len, num_nodes, input_dim), data[i, :] is a continuous
+        sequence, time_data: (batch_size, batch_len, num_time_features) with compact time features, otherwise None.
+        """
+        add_day_in_week = self._get_config('add_day_in_week')
+        add_time_in_day = self._get_config('add_time_in_day')
+        compact_time_features = self._use_compact_time_features()
+        num_nodes = self._df_test.shape[-1]
+        if df is not None:
+            batch_len = df.shape[0] // batch_size
+            data = generate_graph_features_with_time(df, num_nodes=num_nodes,
+                                                     scaler=self._scaler,
+                                                     add_time_in_day=add_time_in_day,
+                                                     add_day_in_week=add_day_in_week,
+                                                     compact_time_features=compact_time_features,
+                                                     dtype=self._dtype)
+        else:
+            start, stop = self._train_range if split == 'train' else self._val_range
+            batch_len = (stop - start) // batch_size
+            filename = None
+            data_mmap_dir = self._get_config('data_mmap_dir')
+            if data_mmap_dir is not None:
+                if not os.path.exists(data_mmap_dir):
+                    os.makedirs(data_mmap_dir)
+                filename = os.path.join(data_mmap_dir, '%s.npy' % split)
+            data = generate_graph_features_from_chunks(self._reader.iter_chunks(start, stop),
+                                                       num_samples=batch_size * batch_len,
+                                                       num_nodes=num_nodes,
+                                                       scaler=self._scaler,
+                                                       add_time_in_day=add_time_in_day,
+                                                       add_day_in_week=add_day_in_week,
+                                                       filename=filename,
+                                                       compact_time_features=compact_time_features,
+                                                       dtype=self._dtype)
+        data, time_data = data if compact_time_features else (data, None)
+        data = data[:batch_size * batch_len]
+        data = data.reshape((batch_size, batch_len) + data.shape[1:])
+        if time_data is not None:
+            time_data = time_data[:batch_size * batch_len]
+            time_data = time_data.reshape((batch_size, batch_len) + time_data.shape[1:])
+        return data, time_data
+
     def _build_train_val_test_models(self):
         # Builds the model.
-        input_dim = self._x_train.shape[-1]
+        input_dim = self._x_test.shape[-1]
         num_nodes = self._df_test.shape[-1]
-        output_dim = self._y_train.shape[-1]
-        test_batch_size = self._get_config('test_batch_size')
-        train_config = dict(self._config)
-        train_config.update({
-            'input_dim': input_dim,
-            'num_nodes': num_nodes,
-            'output_dim': output_dim,
-        })
-        test_config = dict(self._config)
-        test_config.update({
-            'batch_size': test_batch_size,
+        output_dim = self._y_test.shape[-1]
+        num_clusters = self._get_config('num_clusters')
+        if num_clusters > 1:
+            self._graph_partition = self._create_graph_partition(num_clusters)
+        if self._config.get('filter_type', 'laplacian') == 'laplacian':
+            self._load_lambda_max()
+        model_config = dict(self._config)
+        model_config.update({
+            'add_day_in_week': self._get_config('add_day_in_week'),
+            'add_time_in_day': self._get_config('add_time_in_day'),
+            # Variable batch size, i.e., the same graphs run training, validation and testing batches of any size.
+            'batch_size': None,
+            'compact_time_features': self._use_compact_time_features(),
             'input_dim': input_dim,
             'num_nodes': num_nodes,
             'output_dim': output_dim,
         })
+        self._model_config = model_config
 
+        train_config = dict(model_config)
+        if self._graph_partition is not None:
+            train_config['subgraph_num_nodes'] = self._graph_partition.num_nodes
+        # The multi-step training loop reads the variables inside a tf.while_loop, where only reads of resource
+        # variables see the updates of the previous steps. Checkpoints are the same for both kinds of variables.
+        use_resource = int(self._get_config('steps_per_run')) > 1
         with tf.name_scope('Train'):
-            with tf.variable_scope('DCRNN', reuse=False):
+            with tf.variable_scope('DCRNN', reuse=False, use_resource=use_resource):
                 train_model = DCRNNModel(is_training=True, config=train_config, scaler=self._scaler,
                                          adj_mx=self._adj_mx)
 
-        with tf.name_scope('Val'):
+        # One model on the full graph for both validation and testing.
+        with tf.name_scope('Eval'):
             with tf.variable_scope('DCRNN', reuse=True):
-                val_model = DCRNNModel(is_training=False, config=train_config, scaler=self._scaler,
-                                       adj_mx=self._adj_mx)
-
-        with tf.name_scope('Test'):
-            with tf.variable_scope('DCRNN', reuse=True):
-                test_model = DCRNNModel(is_training=False, config=test_config, scaler=self._scaler,
+                eval_model = DCRNNModel(is_training=False, config=model_config, scaler=self._scaler,
                                         adj_mx=self._adj_mx)
 
-        return train_model, val_model, test_model
+        support_backend = self._config.get('support_backend', 'auto')
+        backends = dcrnn_utils.support_registry.get_backends(self._adj_mx,
+                                                             filter_type=self._config.get('filter_type', 'laplacian'),
+                                                             backend=support_backend,
+                                                             lambda_max_method=self._config.get('lambda_max_method',
+                                                                                                'eigsh'))
+        self._logger.info('Support backend: %s, selected: %s' % (support_backend, ', '.join(backends)))
+        return train_model, eval_model, eval_model
+
+    def _load_lambda_max(self):
+        """
+        Loads the lambda_max of the graph from the data cache, or computes and saves it, i.e., the eigensolve of the
+        laplacian filter runs once per graph instead of once per process, e.g., per tuning trial.
+        """
+        if self._data_cache is None:
+            return
+        lambda_max_method = self._config.get('lambda_max_method', 'eigsh')
+        key = data_cache.make_cache_key(graph=dcrnn_utils.support_registry.get_fingerprint(self._adj_mx),
+                                        lambda_max_method=lambda_max_method)
+        cached = self._data_cache.load(key)
+        if cached is not None:
+            lambda_max = cached[1]['lambda_max']
+            dcrnn_utils.support_registry.set_lambda_max(self._adj_mx, lambda_max, lambda_max_method=lambda_max_method)
+            self._logger.info('Loading lambda_max of the graph from cache: %.6f' % lambda_max)
+        else:
+            lambda_max = dcrnn_utils.support_registry.get_lambda_max(self._adj_mx,
+                                                                     lambda_max_method=lambda_max_method)
+            self._data_cache.save(key, {}, meta={'lambda_max': lambda_max})
+
+    def _create_graph_partition(self, num_clusters):
+        """
+        Partitions the graph for training on subgraphs, i.e., on sampled clusters with their halo.
+        """
+        halo_depth = self._get_config('halo_depth')
+        if halo_depth is None:
+            # Covers the diffusion of one step.
+            halo_depth = self._config.get('max_diffusion_step', 2)
+        graph_partition = dcrnn_utils.GraphPartition(self._adj_mx, num_clusters=num_clusters,
+                                                     halo_depth=halo_depth,
+                                                     clusters_per_step=self._get_config('clusters_per_step'),
+                                                     method=self._get_config('partition_method'),
+                                                     filter_type=self._config.get('filter_type', 'laplacian'),
+                                                     lambda_max_method=self._config.get('lambda_max_method', 'eigsh'))
+        self._logger.info('Graph partition: %d clusters of %s nodes, halo depth: %d, %d nodes per training step' % (
+            graph_partition.num_clusters, '/'.join(str(len(cluster)) for cluster in graph_partition.clusters),
+            halo_depth, graph_partition.num_nodes))
+        return graph_partition
+
+    def _get_train_inputs(self):
+        if self._graph_partition is None:
+            return super(DCRNNSupervisor, self)._get_train_inputs()
+        return self._iterate_subgraph_batches(), None, None
+
+    def _iterate_subgraph_batches(self):
+        """
+        Restricts each training batch to a sampled subgraph.
+        :return: iterator of (inputs, labels[, time_inputs], subgraph), see DCRNNModel.get_feed_dict.
+        """
+        if self._y_train is None:
+            batches = self._x_train
+        elif self._time_train is None:
+            batches = zip(self._x_train, self._y_train)
+        else:
+            batches = zip(self._x_train, self._y_train, self._time_train)
+        for batch in batches:
+            subgraph = self._graph_partition.sample()
+            yield (subgraph.take(batch[0]), subgraph.take(batch[1])) + tuple(batch[2:]) + (subgraph,)
+
+    def predict_sensors(self, sess, sensor_ids, inputs, time_inputs=None):
+        """
+        Predicts the target sensors by running the model only on the subgraph of their receptive field, which gives
+        the same outputs as the full graph, i.e., the cost depends on the size of the receptive field instead of the
+        size of the network.
+        :param sess: session with the trained or restored variables.
+        :param sensor_ids: ids of the distinct target sensors, i.e., columns of the traffic DataFrame.
+        :param inputs: (batch_size, seq_len, num_nodes, input_dim) of the full graph, e.g., windows of the test data.
+        :param time_inputs: (batch_size, seq_len + horizon, num_time_features), required with compact time features.
+        :return: (batch_size, horizon, len(sensor_ids), output_dim) outputs of the model, i.e., normalized readings.
+        """
+        sensor_id_to_ind = dict((sensor_id, i) for i, sensor_id in enumerate(self._df_test.columns))
+        target_nodes = [sensor_id_to_ind[sensor_id] for sensor_id in sensor_ids]
+        if self._receptive_field_extractor is None:
+            num_hops = DCRNNModel.get_receptive_field_hops(self._model_config)
+            self._receptive_field_extractor = dcrnn_utils.ReceptiveFieldExtractor(
+                self._adj_mx, num_hops=num_hops, filter_type=self._config.get('filter_type', 'laplacian'),
+                lambda_max_method=self._config.get('lambda_max_method', 'eigsh'))
+            self._logger.info('Receptive field of the outputs: %d hops' % num_hops)
+        subgraph = self._receptive_field_extractor.get_subgraph(target_nodes)
+        model = self._get_subgraph_model(subgraph.num_nodes)
+        # Labels are not used by the decoder at inference time.
+        labels = np.zeros((inputs.shape[0], self._get_config('horizon'), subgraph.num_nodes, self._y_test.shape[-1]),
+                          dtype=np.float32)
+        batch = (subgraph.take(inputs), labels)
+        if time_inputs is not None:
+            batch += (time_inputs,)
+        outputs = sess.run(model.outputs, feed_dict=model.get_feed_dict(batch + (subgraph,)))
+        return outputs[:, :, :len(target_nodes)]
+
+    def _get_subgraph_model(self, num_nodes):
+        """
+        Builds the inference model on subgraphs with num_nodes nodes once, which shares the variables of the other
+        models.
+        """
+        if num_nodes not in self._subgraph_models:
+            config = dict(self._model_config)
+            config.update({
+                'input_pipeline': 'feed_dict',
+                'subgraph_num_nodes': num_nodes,
+            })
+            with tf.name_scope('Inference_%d' % num_nodes):
+                with tf.variable_scope('DCRNN', reuse=True):
+                    self._subgraph_models[num_nodes] = DCRNNModel(is_training=False, config=config,
+                                                                  scaler=self._scaler, adj_mx=self._adj_mx)
+        return self._subgraph_models[num_nodes]
+
+    @property
+    def graph_partition(self):
+        return self._graph_partition
 
     def _convert_model_outputs_to_eval_df(self, y_preds):
-        y_preds = np.stack(y_preds, axis=1)
-        # y_preds: (batch_size, epoch_size, horizon, num_nodes, output_dim)
-        # horizon = y_preds.shape[2]
+        # y_preds: (num_windows, horizon, num_nodes, output_dim), the scaler casts them to self._dtype.
+        # horizon = y_preds.shape[1]
         horizon = self._get_config('horizon')
-        num_nodes = self._df_train.shape[-1]
         df_preds = {}
         for horizon_i in range(horizon):
-            y_pred = np.reshape(y_preds[:, :, horizon_i, :, 0], self._eval_dfs[horizon_i].shape)
+            y_pred = np.reshape(y_preds[:, horizon_i, :, 0], self._eval_dfs[horizon_i].shape)
             df_pred = pd.DataFrame(self._scaler.inverse_transform(y_pred), index=self._eval_dfs[horizon_i].index,
                                    columns=self._eval_dfs[horizon_i].columns)
             df_preds[horizon_i] = df_pred
@@ -5,9 +5,15 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import contextlib
+import time
+
 import numpy as np
 import tensorflow as tf
 
+from lib import tf_utils
+
 
 class TFModel(object):
     def __init__(self, config, scaler=None, **kwargs):
@@ -23,6 +29,10 @@ class TFModel(object):
         self._inputs = None
         self._labels = None
         self._outputs = None
+        # Time features shared by all the nodes, if they are not part of the inputs.
+        self._time_inputs = None
+        # lib.tf_utils.BatchPrefetcher, if inputs and labels are read from an input queue instead of placeholders.
+        self._prefetcher = None
 
         # Scaler for data normalization.
         self._scaler = scaler
@@ -31,6 +41,15 @@ class TFModel(object):
         self._loss = None
         self._mae = None
         self._train_op = None
+        # Multi-step training, i.e., several optimizer steps per sess.run, see run_epoch.
+        self._num_steps = None
+        self._multi_step_loss = None
+        self._multi_step_mae = None
+        # Data-parallel training, i.e., the gradients are averaged over the workers between computing and applying
+        # them, see run_epoch.
+        self._flat_grads = None
+        self._flat_grads_input = None
+        self._apply_grads_op = None
 
         # Learning rate.
         learning_rate = config.get('learning_rate', 0.001)
@@ -43,9 +62,32 @@ class TFModel(object):
         self._merged = None
 
     @staticmethod
-    def run_epoch(sess, model, inputs, labels, return_output=False, train_op=None, writer=None):
+    def run_epoch(sess, model, inputs, labels, return_output=False, train_op=None, writer=None, time_inputs=None,
+                  steps_per_run=1, all_reduce=None, rank=0):
+        """
+        Runs the model over all the batches of one epoch.
+        :param inputs: (epoch_size, batch_size, ...), usually read-only strided views, i.e., a batch is only
+        copied when it is fed. If labels is None, an iterable of (x, y) batches, e.g., lib.utils.WindowSampler.
+        :param labels: (epoch_size, batch_size, ...)
+        :param time_inputs: (epoch_size, batch_size, seq_len + horizon, num_time_features), required by models with
+        compact time features, in which case batches from an iterable inputs are (x, y, time).
+        :param steps_per_run: number of training steps per sess.run, > 1 requires a model with a multi-step train op,
+        which reads its batches from the input queue.
+        :param all_reduce: lib.parallel_utils.SharedMemoryAllReduce for data-parallel training, where every worker
+        runs the same number of steps on its own shard of the batches and applies the average gradients.
+        :param rank: rank of the worker for data-parallel training.
+        :return: dict with loss, mae, number of steps, wall time of the epoch and, when the model reads from an input
+        queue, the time spent waiting for data.
+        """
+        if train_op is not None and steps_per_run > 1:
+            return TFModel._run_multi_step_epoch(sess, model, inputs, labels, steps_per_run, time_inputs=time_inputs,
+                                                 writer=writer)
+        if train_op is not None and all_reduce is not None:
+            return TFModel._run_data_parallel_epoch(sess, model, inputs, labels, all_reduce, rank,
+                                                    time_inputs=time_inputs)
         losses = []
         maes = []
+        batch_sizes = []
         outputs = []
 
         fetches = {
@@ -66,29 +108,185 @@ class TFModel(object):
                 'outputs': model.outputs
             })
 
-        for _, (x, y) in enumerate(zip(inputs, labels)):
-            feed_dict = {
-                model.inputs: x,
-                model.labels: y,
-            }
+        start_time = time.time()
+        # Closing the generator stops the prefetcher right away if a step fails.
+        with contextlib.closing(TFModel._generate_feed_dicts(sess, model, inputs, labels, time_inputs)) as feed_dicts:
+            for feed_dict, batch_size in feed_dicts:
+                vals = sess.run(fetches, feed_dict=feed_dict)
 
-            vals = sess.run(fetches, feed_dict=feed_dict)
-
-            losses.append(vals['loss'])
-            maes.append(vals['mae'])
-            if writer is not None and 'merged' in vals:
-                writer.add_summary(vals['merged'], global_step=vals['global_step'])
-            if return_output:
-                outputs.append(vals['outputs'])
+                losses.append(vals['loss'])
+                maes.append(vals['mae'])
+                batch_sizes.append(batch_size)
+                if writer is not None and 'merged' in vals:
+                    writer.add_summary(vals['merged'], global_step=vals['global_step'])
+                if return_output:
+                    outputs.append(vals['outputs'])
 
+        # The loss and mae of each batch are means over its windows, e.g., the last batch may be smaller.
         results = {
-            'loss': np.mean(losses),
-            'mae': np.mean(maes)
+            'loss': np.average(losses, weights=batch_sizes),
+            'mae': np.average(maes, weights=batch_sizes),
+            'steps': len(losses),
+            'time': time.time() - start_time,
         }
+        if model.prefetcher is not None:
+            results['wait_time'] = model.prefetcher.wait_time
         if return_output:
             results['outputs'] = outputs
         return results
 
+    @staticmethod
+    def _run_multi_step_epoch(sess, model, inputs, labels, steps_per_run, time_inputs=None, writer=None):
+        """
+        Trains the model over all the batches of one epoch with steps_per_run optimizer steps per sess.run, whose
+        loss and mae are averaged in the graph, i.e., there is one round trip to python per steps_per_run batches.
+        The writer gets the loss and mae of each run at the global step after the run. The time spent waiting for data
+        is the time waiting for the first batch of each run, later batches are waited for inside the run.
+        """
+        if model.num_steps is None:
+            raise ValueError('The model has no multi-step train op, see steps_per_run.')
+        global_step = None
+        if writer is not None:
+            if model.merged is not None:
+                # The summaries are built on the single-step model, whose inputs would dequeue another batch.
+                tf.logging.warn('The summaries of the model are not written with steps_per_run > 1, only the loss '
+                                'and mae of each run.')
+            global_step = sess.run(tf.train.get_or_create_global_step())
+        # The last run has fewer steps if the number of batches is not a multiple of steps_per_run, as a dequeue
+        # without batches left would block.
+        num_batches = len(inputs)
+        fetches = {
+            'mae': model.multi_step_mae,
+            'loss': model.multi_step_loss,
+        }
+        losses = []
+        maes = []
+        num_steps = []
+        start_time = time.time()
+        model.prefetcher.start(sess, TFModel._generate_batches(inputs, labels, time_inputs))
+        try:
+            for step in range(0, num_batches, steps_per_run):
+                num_steps.append(min(steps_per_run, num_batches - step))
+                model.prefetcher.wait()
+                vals = sess.run(fetches, feed_dict={model.num_steps: num_steps[-1]})
+                # The other batches of the run have been enqueued, i.e., these do not block.
+                for _ in range(num_steps[-1] - 1):
+                    model.prefetcher.wait()
+                losses.append(vals['loss'])
+                maes.append(vals['mae'])
+                if writer is not None:
+                    global_step += num_steps[-1]
+                    tf_utils.add_simple_summary(writer, ['loss/train_run_loss', 'metric/train_run_mae'],
+                                                [vals['loss'], vals['mae']], global_step=global_step)
+            model.prefetcher.join()
+        except tf.errors.OutOfRangeError:
+            # The input queue is closed if enqueueing fails, whose error is raised instead.
+            model.prefetcher.join()
+            raise
+        finally:
+            model.prefetcher.stop(sess)
+        return {
+            'loss': np.average(losses, weights=num_steps),
+            'mae': np.average(maes, weights=num_steps),
+            'steps': num_batches,
+            'time': time.time() - start_time,
+            'wait_time': model.prefetcher.wait_time,
+        }
+
+    @staticmethod
+    def _run_data_parallel_epoch(sess, model, inputs, labels, all_reduce, rank, time_inputs=None):
+        """
+        Trains the replica of one worker over its batches of one epoch. The loss and mae of each step are averaged
+        over the workers together with the gradients, i.e., all the workers return the same results.
+        """
+        if model.flat_grads is None:
+            raise ValueError('The model has no data-parallel train op, see num_workers.')
+        fetches = {
+            'flat_grads': model.flat_grads,
+            'mae': model.mae,
+            'loss': model.loss,
+        }
+        losses = []
+        maes = []
+        all_reduce_time = 0.
+        start_time = time.time()
+        with contextlib.closing(TFModel._generate_feed_dicts(sess, model, inputs, labels, time_inputs)) as feed_dicts:
+            for feed_dict, _ in feed_dicts:
+                vals = sess.run(fetches, feed_dict=feed_dict)
+                all_reduce_start_time = time.time()
+                values = all_reduce.all_reduce(rank, np.concatenate([vals['flat_grads'], [vals['loss'], vals['mae']]]))
+                all_reduce_time += time.time() - all_reduce_start_time
+                sess.run(model.apply_grads_op, feed_dict={model.flat_grads_input: values[:-2]})
+                losses.append(values[-2])
+                maes.append(values[-1])
+        train_time = time.time() - start_time
+        # Gathers the compute and all-reduce time of every worker, each sets its own slot of the averaged vector.
+        worker_times = np.zeros((all_reduce.num_workers, 2), dtype=np.float32)
+        worker_times[rank] = [train_time - all_reduce_time, all_reduce_time]
+        worker_times = all_reduce.all_reduce(rank, worker_times).reshape((-1, 2)) * all_reduce.num_workers
+        results = {
+            'all_reduce_time': all_reduce_time,
+            # (num_workers, 2) seconds of each worker computing and in the all-reduce, i.e., exchanging the
+            # gradients or waiting for the slower workers.
+            'worker_times': worker_times,
+            'loss': np.mean(losses),
+            'mae': np.mean(maes),
+            # Steps of all the workers.
+            'steps': len(losses) * all_reduce.num_workers,
+            'time': train_time,
+        }
+        if model.prefetcher is not None:
+            results['wait_time'] = model.prefetcher.wait_time
+        return results
+
+    @staticmethod
+    def _generate_batches(inputs, labels, time_inputs=None):
+        if labels is None:
+            return inputs
+        elif time_inputs is None:
+            return zip(inputs, labels)
+        return zip(inputs, labels, time_inputs)
+
+    @staticmethod
+    def _generate_feed_dicts(sess, model, inputs, labels, time_inputs=None):
+        """
+        Generates (feed_dict, batch_size) per step, where feed_dict is None if batches are prefetched into the input
+        queue of the model.
+        """
+        batches = TFModel._generate_batches(inputs, labels, time_inputs)
+        if model.prefetcher is not None:
+            # Sizes of the enqueued batches, which are dequeued in the same order.
+            batch_sizes = collections.deque()
+
+            def enqueue_batches():
+                for batch in batches:
+                    batch_sizes.append(len(batch[0]))
+                    yield batch
+
+            model.prefetcher.start(sess, enqueue_batches())
+            try:
+                while model.prefetcher.wait():
+                    yield None, batch_sizes.popleft()
+            finally:
+                # The consumer may stop before the end of the epoch, e.g., if a step fails.
+                model.prefetcher.stop(sess)
+        else:
+            for batch in batches:
+                yield model.get_feed_dict(batch), len(batch[0])
+
+    def get_feed_dict(self, batch):
+        """
+        :param batch: (inputs, labels), followed by the time inputs for models with compact time features.
+        :return: feed_dict of the batch.
+        """
+        feed_dict = {
+            self._inputs: batch[0],
+            self._labels: batch[1],
+        }
+        if self._time_inputs is not None:
+            feed_dict[self._time_inputs] = batch[2]
+        return feed_dict
+
     def get_lr(self, sess):
         return np.asscalar(sess.run(self._lr))
 
@@ -97,6 +295,18 @@ class TFModel(object):
             self._new_lr: lr
         })
 
+    @property
+    def apply_grads_op(self):
+        return self._apply_grads_op
+
+    @property
+    def flat_grads(self):
+        return self._flat_grads
+
+    @property
+    def flat_grads_input(self):
+        return self._flat_grads_input
+
     @property
     def inputs(self):
         return self._inputs
@@ -105,6 +315,14 @@ class TFModel(object):
     def labels(self):
         return self._labels
 
+    @property
+    def time_inputs(self):
+        return self._time_inputs
+
+    @property
+    def prefetcher(self):
+        return self._prefetcher
+
     @property
     def loss(self):
         return self._loss
@@ -117,6 +335,18 @@ class TFModel(object):
     def mae(self):
         return self._mae
 
+    @property
+    def multi_step_loss(self):
+        return self._multi_step_loss
+
+    @property
+    def multi_step_mae(self):
+        return self._multi_step_mae
+
+    @property
+    def num_steps(self):
+        return self._num_steps
+
     @property
     def merged(self):
         return self._merged
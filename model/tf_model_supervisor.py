@@ -10,10 +10,14 @@ import sys
 import tensorflow as tf
 import time
 
+from lib import checkpoint_utils
+from lib import data_cache
 from lib import log_helper
 from lib import metrics
+from lib import parallel_utils
 from lib import tf_utils
 from lib import utils
+from lib.hdf_utils import HDFChunkReader
 from lib.utils import StandardScaler
 from model.tf_model import TFModel
 
@@ -24,8 +28,16 @@ class TFModelSupervisor(object):
     """
 
     def __init__(self, config, df_data, **kwargs):
+        """
+        :param config:
+        :param df_data: pandas.DataFrame, or lib.hdf_utils.HDFChunkReader to prepare the train/val data out-of-core.
+        :param kwargs:
+        """
         self._config = dict(config)
         self._epoch = 0
+        # Data-parallel training, see train_data_parallel.
+        self._rank = 0
+        self._all_reduce = None
 
         # logging.
         self._init_logging()
@@ -34,9 +46,38 @@ class TFModelSupervisor(object):
         # Data preparation
         test_ratio = self._get_config('test_ratio')
         validation_ratio = self._get_config('validation_ratio')
-        self._df_train, self._df_val, self._df_test = utils.train_val_test_split_df(df_data, val_ratio=validation_ratio,
-                                                                                    test_ratio=test_ratio)
-        self._scaler = StandardScaler(mean=self._df_train.values.mean(), std=self._df_train.values.std())
+        # dtype of the prepared data on the host, e.g., float32 avoids a conversion when the data is fed.
+        self._dtype = np.dtype(self._get_config('dtype'))
+        self._reader = None
+        if isinstance(df_data, HDFChunkReader):
+            # Only the testing data, which is required for evaluation, is loaded into memory.
+            self._reader = df_data
+            self._train_range, self._val_range, self._test_range = utils.train_val_test_split_ranges(
+                df_data.shape[0], val_ratio=validation_ratio, test_ratio=test_ratio)
+            self._df_train, self._df_val = None, None
+            self._df_test = df_data.read(*self._test_range).astype(self._dtype)
+        else:
+            df_data = df_data.astype(self._dtype)
+            self._df_train, self._df_val, self._df_test = utils.train_val_test_split_df(df_data,
+                                                                                        val_ratio=validation_ratio,
+                                                                                        test_ratio=test_ratio)
+        self._data_cache, self._data_cache_key = self._init_data_cache(df_data)
+        self._cached_data = None
+        if self._data_cache is not None:
+            self._cached_data = self._data_cache.load(self._data_cache_key)
+        if self._cached_data is not None:
+            self._logger.info('Loading prepared data from cache: %s' % self._data_cache_key)
+            meta = self._cached_data[1]
+            self._scaler = StandardScaler(mean=meta['scaler_mean'], std=meta['scaler_std'], dtype=self._dtype)
+        elif self._reader is not None:
+            self._scaler = utils.fit_standard_scaler(self._reader.iter_chunks(*self._train_range), dtype=self._dtype)
+        else:
+            # Statistics are computed in float64 regardless of the dtype of the data.
+            values = self._df_train.values
+            self._scaler = StandardScaler(mean=values.mean(dtype=np.float64), std=values.std(dtype=np.float64),
+                                          dtype=self._dtype)
+        # Time features of each window, which are only separated from the inputs with compact time features.
+        self._time_train, self._time_val, self._time_test = None, None, None
         self._x_train, self._y_train, self._x_val, self._y_val, self._x_test, self._y_test = self._prepare_train_val_test_data()
         self._eval_dfs = self._prepare_eval_df()
 
@@ -53,9 +94,18 @@ class TFModelSupervisor(object):
         default_config = {
             'add_day_in_week': False,
             'add_time_in_day': True,
+            'async_checkpoint': False,
+            'async_eval': False,
+            'checkpoint_compression': False,
             'dropout': 0.,
             'batch_size': 64,
+            'clusters_per_step': 1,
+            'compact_time_features': False,
+            'data_mode': 'sequential',
+            'data_cache_max_size_gb': 20,
+            'dtype': 'float32',
             'horizon': 12,
+            'keep_best_checkpoints': 5,
             'learning_rate': 1e-3,
             'lr_decay': 0.1,
             'lr_decay_epoch': 50,
@@ -63,11 +113,16 @@ class TFModelSupervisor(object):
             'max_to_keep': 100,
             'min_learning_rate': 2e-6,
             'null_val': 0.,
+            'num_clusters': 1,
+            'num_workers': 1,
             'output_type': 'range',
+            'partition_method': 'bfs',
             'patience': 20,
             'save_model': 1,
             'seq_len': 12,
-            'test_batch_size': 1,
+            'shuffle': True,
+            'steps_per_run': 1,
+            'test_batch_size': 64,
             'test_every_n_epochs': 10,
             'test_ratio': 0.2,
             'use_cpu_only': False,
@@ -93,10 +148,62 @@ class TFModelSupervisor(object):
         self._logger = log_helper.get_logger(self._log_dir, run_id)
         self._writer = tf.summary.FileWriter(self._log_dir)
 
-    def train(self, sess, **kwargs):
-        history = []
-        min_val_loss = float('inf')
-        wait = 0
+    def _init_data_cache(self, df_data):
+        """
+        Opens the cache of prepared data, whose key covers everything the prepared data depends on.
+        :return: (cache, key), or (None, None) if the cache is disabled.
+        """
+        data_cache_dir = self._get_config('data_cache_dir')
+        if data_cache_dir is None:
+            return None, None
+        traffic_df_filename = self._get_config('traffic_df_filename')
+        if isinstance(df_data, HDFChunkReader):
+            data_id = data_cache.file_fingerprint(df_data.filename)
+        elif traffic_df_filename is not None:
+            data_id = data_cache.file_fingerprint(traffic_df_filename)
+        else:
+            data_id = data_cache.dataframe_fingerprint(df_data)
+        key_config = {}
+        # The test windows are prepared one at a time and rebatched, i.e., test_batch_size is not part of the key.
+        for name in ['add_day_in_week', 'add_time_in_day', 'compact_time_features', 'data_mode', 'dtype', 'horizon',
+                     'seq_len', 'test_ratio', 'validation_ratio']:
+            key_config[name] = self._get_config(name)
+        if self._get_config('data_mode') == 'sequential':
+            # Random access data is not laid out by batch.
+            key_config['batch_size'] = self._get_config('batch_size')
+        key = data_cache.make_cache_key(model=self.__class__.__name__, data=data_id,
+                                        sensor_ids=[str(column) for column in df_data.columns], **key_config)
+        max_size_bytes = int(self._get_config('data_cache_max_size_gb') * 1024 ** 3)
+        return data_cache.DatasetCache(data_cache_dir, max_size_bytes=max_size_bytes), key
+
+    def _save_cached_data(self, arrays):
+        """
+        Saves the prepared arrays together with the scaler to the cache.
+        :return: the cached arrays as read-only memory-mapped arrays, or the input arrays if the cache is disabled.
+        """
+        if self._data_cache is None:
+            return arrays
+        self._logger.info('Saving prepared data to cache: %s' % self._data_cache_key)
+        self._data_cache.save(self._data_cache_key, arrays, meta={
+            'scaler_mean': float(self._scaler.mean),
+            'scaler_std': float(self._scaler.std),
+        })
+        return self._data_cache.load(self._data_cache_key)[0]
+
+    def train(self, sess, epoch_callback=None, **kwargs):
+        """
+        :param sess:
+        :param epoch_callback: epoch_callback(epoch, val_mae) is called with the validation results of every epoch,
+        and returns whether to stop training, e.g., by the scheduler of a hyperparameter search.
+        :return: the minimum val_mae.
+        """
+        # Validation results, see _process_eval_result.
+        state = {
+            'epoch_callback': epoch_callback,
+            'history': [],
+            'min_val_loss': float('inf'),
+            'wait': 0,
+        }
 
         epochs = self._get_config('epochs')
         initial_lr = self._get_config('learning_rate')
@@ -104,19 +211,33 @@ class TFModelSupervisor(object):
         lr_decay_epoch = self._get_config('lr_decay_epoch')
         lr_decay = self._get_config('lr_decay')
         lr_decay_interval = self._get_config('lr_decay_interval')
-        patience = self._get_config('patience')
         test_every_n_epochs = self._get_config('test_every_n_epochs')
-        save_model = self._get_config('save_model')
+        steps_per_run = self._get_config('steps_per_run')
 
-        max_to_keep = self._get_config('max_to_keep')
-        saver = tf.train.Saver(tf.global_variables(), max_to_keep=max_to_keep)
+        if self._get_config('async_checkpoint'):
+            # Checkpoints are written in the background, see save_model.
+            saver = checkpoint_utils.AsyncCheckpointWriter(keep_best=self._get_config('keep_best_checkpoints'),
+                                                           compress=self._get_config('checkpoint_compression'))
+        else:
+            max_to_keep = self._get_config('max_to_keep')
+            saver = tf.train.Saver(tf.global_variables(), max_to_keep=max_to_keep)
         model_filename = self._get_config('model_filename')
         if model_filename is not None:
-            saver.restore(sess, model_filename)
+            self._restore_model(sess, model_filename)
             self._train_model.set_lr(sess, self._get_config('learning_rate'))
             self._epoch = self._get_config('epoch') + 1
         else:
             sess.run(tf.global_variables_initializer())
+        if self._all_reduce is not None:
+            self._broadcast_variables(sess)
+        evaluator, eval_sess = None, None
+        if self._get_config('async_eval') and self._rank == 0:
+            if not isinstance(saver, checkpoint_utils.AsyncCheckpointWriter):
+                raise ValueError('async_eval requires async_checkpoint, which saves the evaluated snapshots.')
+            # A second session on the same graph validates and tests snapshots of the variables while training
+            # continues, whose results arrive in later epochs.
+            eval_sess = tf.Session(graph=sess.graph, config=self._get_eval_session_config())
+            evaluator = parallel_utils.BackgroundEvaluator(lambda snapshot: self._evaluate(eval_sess, snapshot))
 
         while self._epoch <= epochs:
             # Learning rate schedule.
@@ -125,54 +246,225 @@ class TFModelSupervisor(object):
                                                  lr_decay_interval=lr_decay_interval,
                                                  min_lr=min_learning_rate)
             if new_lr != initial_lr:
-                self._logger.info('Updating learning rate to: %.6f' % new_lr)
+                if self._rank == 0:
+                    self._logger.info('Updating learning rate to: %.6f' % new_lr)
                 self._train_model.set_lr(sess=sess, lr=new_lr)
             sys.stdout.flush()
 
             start_time = time.time()
+            inputs, labels, time_inputs = self._get_train_inputs()
+            if self._all_reduce is not None:
+                inputs, labels, time_inputs = self._shard_train_inputs(inputs, labels, time_inputs)
             train_results = TFModel.run_epoch(sess, self._train_model,
-                                              inputs=self._x_train, labels=self._y_train,
-                                              train_op=self._train_model.train_op, writer=self._writer)
+                                              inputs=inputs, labels=labels,
+                                              train_op=self._train_model.train_op,
+                                              writer=self._writer if self._rank == 0 else None,
+                                              time_inputs=time_inputs, steps_per_run=steps_per_run,
+                                              all_reduce=self._all_reduce, rank=self._rank)
             train_loss, train_mae = train_results['loss'], train_results['mae']
+            # The same for all the data-parallel workers.
             if train_loss > 1e5:
                 self._logger.warn('Gradient explosion detected. Ending...')
                 break
+            if self._rank != 0:
+                # Validation, testing, checkpointing and early stopping are on rank 0.
+                if self._sync_stop(False):
+                    break
+                self._epoch += 1
+                continue
 
             global_step = sess.run(tf.train.get_or_create_global_step())
-            # Compute validation error.
-            val_results = TFModel.run_epoch(sess, self._val_model, inputs=self._x_val, labels=self._y_val,
-                                            train_op=None)
-            val_loss, val_mae = val_results['loss'], val_results['mae']
-
-            tf_utils.add_simple_summary(self._writer,
-                                        ['loss/train_loss', 'metric/train_mae', 'loss/val_loss', 'metric/val_mae'],
-                                        [train_loss, train_mae, val_loss, val_mae], global_step=global_step)
-            end_time = time.time()
-            message = 'Epoch %d (%d) train_loss: %.4f, train_mae: %.4f, val_loss: %.4f, val_mae: %.4f %ds' % (
-                self._epoch, global_step, train_loss, train_mae, val_loss, val_mae, (end_time - start_time))
-            self._logger.info(message)
-            if self._epoch % test_every_n_epochs == test_every_n_epochs - 1:
-                self.test_and_write_result(sess=sess, global_step=global_step, epoch=self._epoch)
-
-            if val_loss <= min_val_loss:
-                wait = 0
-                if save_model > 0:
-                    model_filename = self.save_model(sess, saver, val_loss)
-                self._logger.info(
-                    'Val loss decrease from %.4f to %.4f, saving to %s' % (min_val_loss, val_loss, model_filename))
-                min_val_loss = val_loss
+            tf_utils.add_simple_summary(self._writer, ['loss/train_loss', 'metric/train_mae'], [train_loss, train_mae],
+                                        global_step=global_step)
+            snapshot = {
+                'epoch': self._epoch,
+                'global_step': global_step,
+                'test': self._epoch % test_every_n_epochs == test_every_n_epochs - 1,
+            }
+            if evaluator is None:
+                # Compute validation error.
+                eval_results = [self._evaluate(sess, snapshot)]
+                message = 'Epoch %d (%d) train_loss: %.4f, train_mae: %.4f, val_loss: %.4f, val_mae: %.4f %ds' % (
+                    self._epoch, global_step, train_loss, train_mae, eval_results[0]['val_loss'],
+                    eval_results[0]['val_mae'], (time.time() - start_time))
             else:
-                wait += 1
-                if wait > patience:
-                    self._logger.warn('Early stopping at epoch: %d' % self._epoch)
-                    break
+                snapshot['values'] = tf_utils.get_variable_values(sess)
+                evaluator.submit(snapshot)
+                eval_results = evaluator.poll()
+                message = 'Epoch %d (%d) train_loss: %.4f, train_mae: %.4f %ds' % (
+                    self._epoch, global_step, train_loss, train_mae, (time.time() - start_time))
+            # Training throughput, to compare e.g. different steps_per_run.
+            message += ', %.1f steps/s with %d steps per run' % (train_results['steps'] / train_results['time'],
+                                                                 steps_per_run)
+            if 'worker_times' in train_results:
+                # The all-reduce time is spent exchanging the gradients or waiting for the slower workers, i.e., the
+                # efficiency is the fraction of the train time the workers compute, which limits the scaling.
+                worker_times = train_results['worker_times']
+                message += ', %d workers, compute/all-reduce per worker: %s, efficiency: %.0f%%' % (
+                    self._all_reduce.num_workers, ' '.join('%.1fs/%.1fs' % tuple(times) for times in worker_times),
+                    100. * np.mean(worker_times[:, 0]) / train_results['time'])
+            if 'wait_time' in train_results:
+                message += ', waiting for data: %.1fs of %.1fs train time' % (train_results['wait_time'],
+                                                                             train_results['time'])
+            self._logger.info(message)
 
-            history.append(val_mae)
+            stop = False
+            for result in eval_results:
+                stop = self._process_eval_result(sess, saver, result, state)
+                if stop:
+                    break
+            if self._sync_stop(stop):
+                break
             # Increases epoch.
             self._epoch += 1
 
             sys.stdout.flush()
-        return np.min(history)
+        if evaluator is not None:
+            # The evaluations of the last epochs, which may still improve the saved model.
+            for result in evaluator.close():
+                if self._process_eval_result(sess, saver, result, state):
+                    break
+            self._logger.info('%d snapshots were not evaluated as newer ones were available.' % evaluator.num_skipped)
+            eval_sess.close()
+        if isinstance(saver, checkpoint_utils.AsyncCheckpointWriter):
+            saver.close()
+        if self._rank != 0:
+            return None
+        return np.min(state['history'])
+
+    def _evaluate(self, sess, snapshot):
+        """
+        Validates, and tests if snapshot['test'], the model.
+        :param sess: the training session, or the session of the background evaluator, into which the values of the
+        variables in the snapshot are loaded.
+        :param snapshot: dict with epoch, global_step, test and optionally the values of the variables.
+        :return: the snapshot with val_loss, val_mae and the evaluation time.
+        """
+        start_time = time.time()
+        if 'values' in snapshot:
+            tf_utils.load_variable_values(sess, snapshot['values'])
+        val_results = TFModel.run_epoch(sess, self._val_model, inputs=self._x_val, labels=self._y_val,
+                                        train_op=None, time_inputs=self._time_val)
+        if snapshot['test']:
+            self.test_and_write_result(sess=sess, global_step=snapshot['global_step'], epoch=snapshot['epoch'])
+        result = dict(snapshot)
+        result.update({
+            'eval_time': time.time() - start_time,
+            'val_loss': val_results['loss'],
+            'val_mae': val_results['mae'],
+        })
+        return result
+
+    def _process_eval_result(self, sess, saver, result, state):
+        """
+        Writes the validation summaries, saves the model if it improves, and decides on early stopping.
+        :param result: see _evaluate.
+        :param state: dict with the history of val_mae, min_val_loss, the number of epochs without improvement and the
+        epoch_callback of train.
+        :return: whether to stop training.
+        """
+        patience = self._get_config('patience')
+        save_model = self._get_config('save_model')
+        val_loss, val_mae = result['val_loss'], result['val_mae']
+        tf_utils.add_simple_summary(self._writer, ['loss/val_loss', 'metric/val_mae'], [val_loss, val_mae],
+                                    global_step=result['global_step'])
+        if 'values' in result:
+            self._logger.info('Evaluated epoch %d (%d) val_loss: %.4f, val_mae: %.4f %ds, training is at epoch %d' % (
+                result['epoch'], result['global_step'], val_loss, val_mae, result['eval_time'], self._epoch))
+        model_filename = None
+        if val_loss <= state['min_val_loss']:
+            state['wait'] = 0
+            if save_model > 0:
+                model_filename = self.save_model(sess, saver, val_loss, snapshot=result)
+            self._logger.info('Val loss decrease from %.4f to %.4f, saving to %s' % (state['min_val_loss'], val_loss,
+                                                                                     model_filename))
+            state['min_val_loss'] = val_loss
+        else:
+            state['wait'] += 1
+            if save_model > 0 and isinstance(saver, checkpoint_utils.AsyncCheckpointWriter):
+                # Kept as the latest checkpoint, e.g., to resume training, until the next one.
+                self.save_model(sess, saver, val_loss, snapshot=result)
+            if state['wait'] > patience:
+                self._logger.warn('Early stopping at epoch: %d' % result['epoch'])
+                return True
+        state['history'].append(val_mae)
+        if state['epoch_callback'] is not None and state['epoch_callback'](result['epoch'], val_mae):
+            self._logger.info('Stopped by the epoch callback at epoch: %d' % result['epoch'])
+            return True
+        return False
+
+    def _get_eval_session_config(self):
+        """
+        :return: tf.ConfigProto of the session of the background evaluator.
+        """
+        if self._get_config('use_cpu_only'):
+            eval_session_config = tf.ConfigProto(device_count={'GPU': 0})
+        else:
+            eval_session_config = tf.ConfigProto()
+        eval_session_config.gpu_options.allow_growth = True
+        return eval_session_config
+
+    def train_data_parallel(self, session_config=None, **kwargs):
+        """
+        Trains with num_workers data-parallel processes, which are forked from this process after the graph and the
+        data have been prepared, i.e., they share the data. Each worker has its own session with a replica of the
+        train model, trains it on its shard of the batches, and averages the gradients of every step with the other
+        workers through shared memory. This process is rank 0, which also validates, tests and saves the model.
+        :param session_config: tf.ConfigProto of the sessions of the workers.
+        :return: see train.
+        """
+        num_workers = self._get_config('num_workers')
+        if num_workers > 1:
+            # Gradients, loss and mae.
+            size = self._train_model.flat_grads.get_shape()[0].value + 2
+            self._all_reduce = parallel_utils.SharedMemoryAllReduce(num_workers, size=size)
+
+        def run_worker(rank):
+            self._rank = rank
+            with tf.Session(config=session_config) as sess:
+                return self.train(sess, **kwargs)
+
+        return parallel_utils.run_workers(num_workers, run_worker, all_reduce=self._all_reduce)
+
+    def _broadcast_variables(self, sess):
+        """
+        Sets the trainable variables of all the data-parallel workers to those of rank 0.
+        """
+        variables = tf.trainable_variables()
+        values = np.concatenate([value.ravel() for value in sess.run(variables)])
+        values = self._all_reduce.broadcast(self._rank, values)
+        offsets = np.cumsum([variable.get_shape().num_elements() for variable in variables])[:-1]
+        for variable, value in zip(variables, np.split(values, offsets)):
+            variable.load(value.reshape(variable.get_shape().as_list()), sess)
+
+    def _sync_stop(self, stop):
+        """
+        Tells the data-parallel workers whether rank 0 stops training.
+        """
+        if self._all_reduce is not None:
+            stop = bool(self._all_reduce.broadcast(self._rank, [float(stop)])[0])
+        return stop
+
+    def _get_train_inputs(self):
+        """
+        :return: (inputs, labels, time_inputs) of one training epoch, see TFModel.run_epoch.
+        """
+        return self._x_train, self._y_train, self._time_train
+
+    def _shard_train_inputs(self, inputs, labels, time_inputs):
+        """
+        :return: (batches, None, None) of the shard of this worker, see lib.utils.ShardedBatches.
+        """
+        if isinstance(inputs, utils.WindowSampler):
+            # Only gathers the batches of this worker.
+            return inputs.shard(self._rank, self._all_reduce.num_workers), None, None
+        if labels is not None:
+            batches = list(zip(*[data for data in [inputs, labels, time_inputs] if data is not None]))
+        elif hasattr(inputs, '__len__'):
+            batches = inputs
+        else:
+            raise ValueError('Data-parallel training requires training batches with a length, e.g., no clusters.')
+        return utils.ShardedBatches(batches, self._rank, self._all_reduce.num_workers), None, None
 
     @staticmethod
     def calculate_scheduled_lr(initial_lr, epoch, lr_decay, lr_decay_epoch, lr_decay_interval,
@@ -197,35 +489,70 @@ class TFModelSupervisor(object):
         :param config:
         :return:
         """
-        model_filename = config['model_filename']
-        max_to_keep = self._get_config('max_to_keep')
-        saver = tf.train.Saver(tf.global_variables(), max_to_keep=max_to_keep)
-        saver.restore(sess, model_filename)
+        self._restore_model(sess, config['model_filename'])
+
+    def _restore_model(self, sess, model_filename):
+        """
+        Restores the variables from a checkpoint of either tf.train.Saver or lib.checkpoint_utils.AsyncCheckpointWriter.
+        """
+        if model_filename.endswith('.npz'):
+            tf_utils.load_variable_values(sess, checkpoint_utils.load_checkpoint(model_filename))
+        else:
+            max_to_keep = self._get_config('max_to_keep')
+            saver = tf.train.Saver(tf.global_variables(), max_to_keep=max_to_keep)
+            saver.restore(sess, model_filename)
 
-    def save_model(self, sess, saver, val_loss):
-        config_filename = TFModelSupervisor._get_config_filename(self._epoch)
+    def save_model(self, sess, saver, val_loss, snapshot=None):
+        """
+        Saves the variables and the configuration to restore them.
+        :param saver: tf.train.Saver, or lib.checkpoint_utils.AsyncCheckpointWriter, in which case training only waits
+        for the snapshot of the variables.
+        :param snapshot: see _evaluate, whose values of the variables are saved instead of the current ones if any.
+        :return: filename of the checkpoint.
+        """
+        start_time = time.time()
+        epoch = snapshot['epoch'] if snapshot is not None else self._epoch
+        config_filename = os.path.join(self._log_dir, TFModelSupervisor._get_config_filename(epoch))
         config = dict(self._config)
         global_step = sess.run(tf.train.get_or_create_global_step())
-        config['epoch'] = int(self._epoch)
+        values = None
+        if snapshot is not None and 'values' in snapshot:
+            global_step, values = snapshot['global_step'], snapshot['values']
+        config['epoch'] = int(epoch)
         config['global_step'] = int(global_step)
         config['log_dir'] = self._log_dir
+        if isinstance(saver, checkpoint_utils.AsyncCheckpointWriter):
+            if values is None:
+                values = tf_utils.get_variable_values(sess)
+            config['model_filename'] = os.path.join(self._log_dir, 'models-%.4f-%d.npz' % (val_loss, global_step))
+            saver.save(values, config['model_filename'], loss=val_loss, extra_files={config_filename: config})
+            # The writing time is what synchronous saving would have added to training.
+            self._logger.info('Checkpoint snapshot: %.2fs, %d checkpoints written in the background: %.2fs' % (
+                time.time() - start_time, saver.num_written, saver.write_time))
+            return config['model_filename']
         config['model_filename'] = saver.save(sess, os.path.join(self._log_dir, 'models-%.4f' % val_loss),
                                               global_step=global_step, write_meta_graph=False)
-        with open(os.path.join(self._log_dir, config_filename), 'w') as f:
+        with open(config_filename, 'w') as f:
             json.dump(config, f)
+        self._logger.info('Checkpoint saved: %.2fs' % (time.time() - start_time))
         return config['model_filename']
 
     def test_and_write_result(self, sess, global_step, **kwargs):
         null_val = self._config.get('null_val')
         start_time = time.time()
-        test_results = TFModel.run_epoch(sess, self._test_model, self._x_test, self._y_test, return_output=True,
+        # The test model has a variable batch size, i.e., the test windows are evaluated test_batch_size at a time.
+        test_batch_size = self._get_config('test_batch_size')
+        test_data = [self._x_test, self._y_test]
+        if self._time_test is not None:
+            test_data.append(self._time_test)
+        batches = zip(*[utils.rebatch_windows(data, test_batch_size) for data in test_data])
+        test_results = TFModel.run_epoch(sess, self._test_model, inputs=batches, labels=None, return_output=True,
                                          train_op=None)
 
-        # y_preds:  a list of (batch_size, horizon, num_nodes, output_dim)
-        test_loss, y_preds = test_results['loss'], test_results['outputs']
+        # y_preds: (num_windows, horizon, num_nodes, output_dim)
+        test_loss, y_preds = test_results['loss'], np.concatenate(test_results['outputs'], axis=0)
         tf_utils.add_simple_summary(self._writer, ['loss/test_loss'], [test_loss], global_step=global_step)
 
-        # Reshapes to (batch_size, epoch_size, horizon, num_node)
         df_preds = self._convert_model_outputs_to_eval_df(y_preds)
 
         for horizon_i in df_preds:
@@ -265,14 +592,15 @@ class TFModelSupervisor(object):
     def _build_train_val_test_models(self):
         """
         Buids models for train, val and test.
-        :return:
+        :return: (train_model, val_model, test_model), the test model must support a variable batch size, and may be
+        the same as the validation model.
         """
         raise NotImplementedError
 
     def _convert_model_outputs_to_eval_df(self, y_preds):
         """
         Convert the outputs to a dict, with key: horizon, value: the corresponding dataframe.
-        :param y_preds:
+        :param y_preds: (num_windows, horizon, ...), in the order of the rows of the evaluation dataframes.
         :return:
         """
         raise NotImplementedError
@@ -11,9 +11,11 @@ flags = tf.app.flags
 FLAGS = flags.FLAGS
 
 flags.DEFINE_bool('use_cpu_only', False, 'Whether to run tensorflow on cpu.')
+flags.DEFINE_string('data_cache_dir', None, 'Directory to cache the prepared train/val/test data.')
+flags.DEFINE_string('traffic_df_filename', 'data/df_highway_2012_4mon_sample.h5', 'Path to hdf5 pandas.DataFrame.')
 
 
-def run_dcrnn(traffic_reading_df):
+def run_dcrnn(traffic_reading_df, traffic_df_filename=None):
     run_id = 'dcrnn_DR_2_h_12_64-64_lr_0.01_bs_64_d_0.00_sl_12_MAE_1207002222'
 
     log_dir = os.path.join('data/model', run_id)
@@ -22,6 +24,9 @@ def run_dcrnn(traffic_reading_df):
     graph_pkl_filename = 'data/sensor_graph/adj_mx.pkl'
     with open(os.path.join(log_dir, config_filename)) as f:
         config = json.load(f)
+    config['traffic_df_filename'] = traffic_df_filename
+    if FLAGS.data_cache_dir:
+        config['data_cache_dir'] = FLAGS.data_cache_dir
     tf_config = tf.ConfigProto()
     if FLAGS.use_cpu_only:
         tf_config = tf.ConfigProto(device_count={'GPU': 0})
@@ -65,7 +70,7 @@ def run_dcrnn(traffic_reading_df):
 
 if __name__ == '__main__':
     sys.path.append(os.getcwd())
-    traffic_df_filename = 'data/df_highway_2012_4mon_sample.h5'
+    traffic_df_filename = FLAGS.traffic_df_filename
     traffic_reading_df = pd.read_hdf(traffic_df_filename)
-    run_dcrnn(traffic_reading_df)
+    run_dcrnn(traffic_reading_df, traffic_df_filename=traffic_df_filename)
     # run_fc_lstm(traffic_reading_df)